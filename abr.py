@@ -0,0 +1,147 @@
+import collections
+import random
+import struct
+from protocol import pack_packet, FLAG_REPORT
+
+# Adaptive bitrate.
+# Clients that ask for abr=1 send a reception report about once a second to the
+# address the stream comes from: the share of packets missing on first arrival
+# (before FEC or NACKs repaired them), the interarrival jitter and how much audio
+# their player has buffered. The server steps the session along its bitrate
+# ladder (the codecs the client accepts, highest bitrate first, see
+# audio_codecs.bitrate_ladder) using next_state() below. Packets carry their codec id,
+# and a switch only happens at an FEC group boundary, so playback never stops
+# and every group is protected in a single codec.
+
+REPORT = struct.Struct("!HHH")  # Loss in 1/1000, jitter in ms, buffered audio in ms
+REPORT_INTERVAL = 1.0           # Seconds between a client's reports
+
+# Control law thresholds
+LOSS_DOWN = 0.05        # Step down at once when this share of packets is lost
+LOSS_UP = 0.01          # Only step up while loss stays below this...
+JITTER_UP_MS = 30       # ...and jitter below this...
+BUFFER_LOW_MS = 100     # Step down at once when the client's buffer runs this low
+UP_AFTER_REPORTS = 5    # ...for this many reports in a row
+MAX_UP_AFTER_REPORTS = 60  # Cap for the wait, which doubles each time a step up fails
+
+Report = collections.namedtuple("Report", ["loss", "jitter_ms", "buffer_ms"])
+
+# State of the control law for one session:
+#   level         position on the ladder, 0 being the highest bitrate
+#   good_reports  good reports in a row at this level
+#   up_after      good reports needed before the next step up
+#   probing       the last report stepped up, so the next one tells whether it held
+AbrState = collections.namedtuple("AbrState", ["level", "good_reports", "up_after", "probing"])
+
+def initial_state(level):
+    return AbrState(level, 0, UP_AFTER_REPORTS, False)
+
+def pack_report(stream_id, report):
+    payload = REPORT.pack(min(1000, round(report.loss * 1000)), min(0xFFFF, round(report.jitter_ms)),
+                          min(0xFFFF, round(report.buffer_ms)))
+    return pack_packet(stream_id, 0, 0, payload, FLAG_REPORT)
+
+def unpack_report(payload):
+    loss, jitter_ms, buffer_ms = REPORT.unpack_from(payload)
+    return Report(loss / 1000, jitter_ms, buffer_ms)
+
+# The control law: the state after `report`, on a ladder of `levels` levels.
+# Steps down at once and up one level after a run of good reports; a step up that
+# is followed straight away by a step down doubles the run needed for the next
+# one, so a link just below a level's bitrate does not flap around it.
+def next_state(state, levels, report):
+    if report.loss >= LOSS_DOWN or report.buffer_ms < BUFFER_LOW_MS:
+        up_after = min(state.up_after * 2, MAX_UP_AFTER_REPORTS) if state.probing else state.up_after
+        return AbrState(min(state.level + 1, levels - 1), 0, up_after, False)
+    up_after = UP_AFTER_REPORTS if state.probing else state.up_after  # The step up held
+    if report.loss > LOSS_UP or report.jitter_ms > JITTER_UP_MS:
+        return AbrState(state.level, 0, up_after, False)
+    good_reports = state.good_reports + 1
+    if good_reports >= up_after and state.level > 0:
+        return AbrState(state.level - 1, 0, up_after, True)
+    return AbrState(state.level, good_reports, up_after, False)
+
+# Server-side state of one adaptive session
+class BitrateController:
+    def __init__(self, ladder, codec):
+        self.ladder = list(ladder)  # Codec names, highest bitrate first
+        self.state = initial_state(self.ladder.index(codec))
+        self.switches = 0
+        self.last_report = None
+
+    @property
+    def codec(self):
+        return self.ladder[self.state.level]
+
+    def update(self, report):
+        level = self.state.level
+        self.state = next_state(self.state, len(self.ladder), report)
+        self.last_report = report
+        if self.state.level != level:
+            self.switches += 1
+            print(f"Switching to {self.codec} (loss {report.loss:.1%}, jitter {report.jitter_ms} ms, "
+                  f"buffer {report.buffer_ms} ms)")  # Debugging line
+
+# Client-side measurements for the reports.
+# on_packet() is called for every data packet on its first arrival; report() gives
+# the figures since the previous report. Jitter is the RFC 3550 interarrival
+# jitter, from the packets' frame timestamps; buffer_ms is a callable returning
+# how much audio the player holds.
+class ReceptionMonitor:
+    def __init__(self, frame_rate, buffer_ms, interval=REPORT_INTERVAL):
+        self.frame_rate = frame_rate
+        self.buffer_ms = buffer_ms
+        self.interval = interval
+        self.next_report = None
+        self.jitter = 0.0     # In frames
+        self.transit = None
+        self.highest_seq = -1
+        self.reported_seq = -1
+        self.arrived = 0      # Since the previous report
+
+    def on_packet(self, seq, timestamp, now):
+        if self.next_report is None:
+            self.next_report = now + self.interval
+            self.reported_seq = seq - 1
+        transit = now * self.frame_rate - timestamp
+        if self.transit is not None:
+            self.jitter += (abs(transit - self.transit) - self.jitter) / 16
+        self.transit = transit
+        self.highest_seq = max(self.highest_seq, seq)
+        self.arrived += 1
+
+    def due(self, now):
+        return self.next_report is not None and now >= self.next_report
+
+    def report(self, now):
+        expected = self.highest_seq - self.reported_seq
+        loss = max(0.0, 1 - self.arrived / expected) if expected > 0 else 0.0
+        self.reported_seq = self.highest_seq
+        self.arrived = 0
+        self.next_report = now + self.interval
+        return Report(loss, self.jitter * 1000 / self.frame_rate, self.buffer_ms())
+
+# Run the control law against a simulated link: `capacity` is the share of the
+# top level's bitrate the link carries in each report interval; whatever a level
+# sends beyond it is lost, on top of random `base_loss`. Returns the level chosen
+# after each report. For example, a link that drops to a third of the PCM rate
+# for 20 seconds:
+#
+#   python abr.py
+def simulate(ladder_ratios, capacity, base_loss=0.002, buffer_ms=500, seed=1):
+    rng = random.Random(seed)
+    state = initial_state(0)
+    levels = []
+    for share in capacity:
+        excess = max(0.0, 1 - share / ladder_ratios[state.level])
+        loss = min(1.0, excess + base_loss * rng.random() * 2)
+        state = next_state(state, len(ladder_ratios), Report(loss, 10, buffer_ms))
+        levels.append(state.level)
+    return levels
+
+if __name__ == "__main__":
+    ratios = [1.0, 0.7, 0.27]  # pcm, flac, adpcm
+    capacity = [1.2] * 10 + [0.35] * 20 + [1.2] * 20
+    levels = simulate(ratios, capacity)
+    print("capacity " + " ".join(f"{c:.2f}" for c in capacity))
+    print("level    " + " ".join(f"{level:>4}" for level in levels))
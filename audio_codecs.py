@@ -0,0 +1,247 @@
+import io
+import struct
+import types
+import numpy as np
+
+try:
+    import soundfile
+except ImportError:  # FLAC is optional
+    soundfile = None
+
+# Payload codecs: how the PCM of one packet is put on the wire.
+# Every packet is encoded on its own, so a packet can be lost, rebuilt by FEC,
+# concealed or skipped by a seek without affecting the packets around it, and a
+# stream can switch codecs between any two packets (see abr.py). Each packet
+# names its codec by `id` in the header flags (see protocol.codec_flags).
+# A codec encodes a whole track's payloads at once (see FrameCache, which keeps
+# the result so each track is encoded once, not once per listener) and hands
+# clients a decoder that turns payloads back into PCM one packet at a time.
+# `ratio` is the typical encoded size relative to PCM, used to order bitrate ladders.
+
+# Plain PCM: payloads are sent as they are
+class PcmCodec:
+    name = "pcm"
+    id = 0
+    lossless = True
+    ratio = 1.0
+
+    def supports(self, info):
+        return True
+
+    def encode(self, payloads, info):
+        return list(payloads)
+
+    def decoder(self, info):
+        return None  # Nothing to decode
+
+# IMA ADPCM step sizes and step index changes
+IMA_STEPS = np.array([
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45,
+    50, 55, 60, 66, 73, 80, 88, 97, 107, 118, 130, 143, 157, 173, 190, 209, 230,
+    253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796, 876, 963,
+    1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327,
+    3660, 4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442, 11487,
+    12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794, 32767,
+], dtype=np.int32)
+IMA_INDEX_CHANGES = [-1, -1, -1, -1, 2, 4, 6, 8] * 2
+
+# Lookup tables indexed [step index][4-bit code], shared by encoder and decoder so
+# both reconstruct exactly the same samples
+IMA_DIFFS = np.array([
+    [(-1 if code & 8 else 1) * ((step >> 3) + (step if code & 4 else 0) +
+                                (step >> 1 if code & 2 else 0) + (step >> 2 if code & 1 else 0))
+     for code in range(16)]
+    for step in IMA_STEPS.tolist()
+], dtype=np.int32)
+IMA_NEXT_INDEX = np.array([
+    [min(88, max(0, index + IMA_INDEX_CHANGES[code])) for code in range(16)]
+    for index in range(89)
+], dtype=np.int32)
+
+ADPCM_FRAMES = struct.Struct("<H")         # Sample frames in the packet
+ADPCM_CHANNEL = struct.Struct("<hBx")      # Per channel: first sample, initial step index
+
+# IMA ADPCM, 4 bits per 16-bit sample (about 4:1).
+# Payload: frame count, then per channel the first sample and a step index,
+# then one 4-bit code per remaining sample (frame-major, low nibble first).
+# Encoding runs in NumPy over every packet of the track at once; decoding is a
+# table lookup per sample, cheap enough for real-time playback in Python.
+class AdpcmCodec:
+    name = "adpcm"
+    id = 1
+    lossless = False
+    ratio = 0.27
+
+    def supports(self, info):
+        return info.sample_width == 2
+
+    def encode(self, payloads, info):
+        payloads = list(payloads)
+        encoded = [None] * len(payloads)
+        by_size = {}  # All packets but the last have the same size
+        for i, payload in enumerate(payloads):
+            by_size.setdefault(len(payload), []).append(i)
+        for indexes in by_size.values():
+            for i, payload in zip(indexes, self._encode_batch([payloads[i] for i in indexes], info.channels)):
+                encoded[i] = payload
+        return encoded
+
+    def decoder(self, info):
+        return AdpcmDecoder(info.channels)
+
+    # Encode equally sized payloads together, one vector step per sample position
+    def _encode_batch(self, payloads, channels):
+        blob = b"".join(bytes(p) for p in payloads)
+        samples = np.frombuffer(blob, dtype="<i2").astype(np.int32).reshape(len(payloads), -1, channels)
+        frames = samples.shape[1]
+
+        predicted = samples[:, 0, :].copy()
+        # Start each packet at the step closest to its first sample-to-sample change
+        first_change = np.abs(samples[:, 1, :] - samples[:, 0, :]) if frames > 1 else np.zeros_like(predicted)
+        index = np.minimum(np.searchsorted(IMA_STEPS, first_change), 88).astype(np.int32)
+        start_index = index.copy()
+
+        codes = np.zeros((len(payloads), max(frames - 1, 0), channels), dtype=np.uint8)
+        for n in range(1, frames):
+            diff = samples[:, n, :] - predicted
+            step = IMA_STEPS[index]
+            code = np.where(diff < 0, 8, 0)
+            diff = np.abs(diff)
+            for bit, shift in ((4, 0), (2, 1), (1, 2)):
+                hit = diff >= (step >> shift)
+                code |= np.where(hit, bit, 0)
+                diff = np.where(hit, diff - (step >> shift), diff)
+            predicted = np.clip(predicted + IMA_DIFFS[index, code], -32768, 32767)
+            index = IMA_NEXT_INDEX[index, code]
+            codes[:, n - 1, :] = code
+
+        nibbles = codes.reshape(len(payloads), -1)
+        if nibbles.shape[1] % 2:
+            nibbles = np.pad(nibbles, ((0, 0), (0, 1)))
+        packed = nibbles[:, 0::2] | (nibbles[:, 1::2] << 4)
+
+        encoded = []
+        for p in range(len(payloads)):
+            header = ADPCM_FRAMES.pack(frames) + b"".join(
+                ADPCM_CHANNEL.pack(int(predicted_start), int(step_index))
+                for predicted_start, step_index in zip(samples[p, 0, :], start_index[p]))
+            encoded.append(header + packed[p].tobytes())
+        return encoded
+
+class AdpcmDecoder:
+    def __init__(self, channels):
+        self.channels = channels
+        self.diffs = IMA_DIFFS.tolist()
+        self.next_index = IMA_NEXT_INDEX.tolist()
+
+    def decode(self, payload):
+        channels = self.channels
+        frames, = ADPCM_FRAMES.unpack_from(payload)
+        out = np.empty((frames, channels), dtype="<i2")
+        packed = np.frombuffer(payload, dtype=np.uint8, offset=ADPCM_FRAMES.size + ADPCM_CHANNEL.size * channels)
+        nibbles = np.empty(len(packed) * 2, dtype=np.uint8)
+        nibbles[0::2] = packed & 0x0F
+        nibbles[1::2] = packed >> 4
+
+        diffs = self.diffs
+        next_index = self.next_index
+        for ch in range(channels):
+            predicted, index = ADPCM_CHANNEL.unpack_from(payload, ADPCM_FRAMES.size + ADPCM_CHANNEL.size * ch)
+            decoded = [predicted]
+            append = decoded.append
+            for code in nibbles[ch:(frames - 1) * channels:channels].tolist():
+                predicted += diffs[index][code]
+                if predicted > 32767:
+                    predicted = 32767
+                elif predicted < -32768:
+                    predicted = -32768
+                index = next_index[index][code]
+                append(predicted)
+            out[:, ch] = decoded
+        return out.tobytes()
+
+# FLAC (lossless) through the soundfile library, when it is installed.
+# Each packet is a complete FLAC stream, so the per-packet overhead is a few
+# dozen bytes of headers; worthwhile for tracks with quiet or simple passages.
+class FlacCodec:
+    name = "flac"
+    id = 2
+    lossless = True
+    ratio = 0.7
+
+    def supports(self, info):
+        return info.sample_width == 2
+
+    def encode(self, payloads, info):
+        encoded = []
+        for payload in payloads:
+            samples = np.frombuffer(payload, dtype="<i2").reshape(-1, info.channels)
+            buffer = io.BytesIO()
+            soundfile.write(buffer, samples, info.frame_rate, format="FLAC", subtype="PCM_16")
+            encoded.append(buffer.getvalue())
+        return encoded
+
+    def decoder(self, info):
+        return FlacDecoder(info)
+
+class FlacDecoder:
+    def __init__(self, info):
+        self.info = info
+
+    def decode(self, payload):
+        samples, _ = soundfile.read(io.BytesIO(payload), dtype="int16", always_2d=True)
+        return samples.tobytes()
+
+PCM = PcmCodec()
+
+# Codecs this installation can encode and decode, by name and by wire id
+CODECS = {codec.name: codec for codec in (PCM, AdpcmCodec(), FlacCodec() if soundfile else None) if codec}
+CODECS_BY_ID = {codec.id: codec for codec in CODECS.values()}
+
+# Client side: turns each packet's payload back into PCM with the codec its header
+# names, given the /stream response's format. Decoders are made on first use.
+# Any payload that cannot be decoded (unknown codec id, corrupt data) raises
+# ValueError, so the receiver can conceal that one packet and carry on.
+class PacketDecoder:
+    def __init__(self, audio_format):
+        self.info = types.SimpleNamespace(**audio_format)
+        self.decoders = {}
+
+    def decode(self, codec_id, payload):
+        if codec_id == PCM.id:
+            return payload
+        decoder = self.decoders.get(codec_id)
+        if decoder is None:
+            codec = CODECS_BY_ID.get(codec_id)
+            if codec is None:
+                raise ValueError(f"Unsupported codec id {codec_id}")
+            decoder = self.decoders[codec_id] = codec.decoder(self.info)
+        try:
+            return decoder.decode(payload)
+        except (struct.error, IndexError, RuntimeError) as e:  # Truncated header, step index out of range, libsndfile
+            raise ValueError(f"Corrupt {CODECS_BY_ID[codec_id].name} payload: {e}") from e
+
+    # Whether any payload so far arrived in a lossy codec (decoders exist only for codecs that arrived)
+    @property
+    def lossy(self):
+        return any(not CODECS_BY_ID[codec_id].lossless for codec_id in self.decoders)
+
+# Pick the first codec in a client's comma-separated preference list that is
+# available here and suits the track; plain PCM otherwise
+def negotiate(preferences, info):
+    for codec in acceptable(preferences, info):
+        return codec
+    return PCM
+
+# Bitrate ladder for adaptive streaming: every codec in the preference list that is
+# available here and suits the track, highest bitrate first
+def bitrate_ladder(preferences, info):
+    return sorted(acceptable(preferences, info), key=lambda codec: codec.ratio, reverse=True)
+
+def acceptable(preferences, info):
+    codecs = []
+    for name in (preferences or "").split(","):
+        codec = CODECS.get(name.strip().lower())
+        if codec and codec.supports(info) and codec not in codecs:
+            codecs.append(codec)
+    return codecs
@@ -0,0 +1,238 @@
+import ctypes
+import ctypes.util
+import errno
+import socket
+import struct
+
+UDP_SEGMENT = 103           # Linux >= 4.18, see <linux/udp.h>
+MAX_GSO_SEGMENTS = 64       # UDP_MAX_SEGMENTS
+MAX_GSO_BYTES = 65000       # One GSO send must fit in a single UDP datagram
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(iovec)), ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+MMSGHDR_SIZE = ctypes.sizeof(mmsghdr)
+MSG_NAME = struct.Struct("P")  # msg_name, the first field of an mmsghdr
+SOCKADDR_IN_SIZE = 16
+
+# libc with a sendmmsg() symbol, or None (not Linux/glibc/musl)
+def load_sendmmsg():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.sendmmsg.restype = ctypes.c_int
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+# Whether the kernel accepts UDP_SEGMENT (UDP generic segmentation offload) on `sock`
+def gso_supported(sock):
+    if not hasattr(sock, "sendmsg"):
+        return False
+    try:
+        sock.setsockopt(socket.SOL_UDP, UDP_SEGMENT, 0)
+    except OSError:
+        return False
+    return True
+
+# sockaddr_in bytes for an IPv4 (ip, port)
+def pack_sockaddr(dest):
+    return struct.pack("=H", socket.AF_INET) + struct.pack("!H", dest[1]) + socket.inet_aton(dest[0]) + bytes(8)
+
+# Size in bytes of a datagram given as one buffer or as a tuple of buffers
+def datagram_size(datagram):
+    if isinstance(datagram, tuple):
+        return sum(len(part) for part in datagram)
+    return len(datagram)
+
+# Buffers making up a list of datagrams, in order, for a gathering send
+def datagram_parts(datagrams):
+    parts = []
+    for datagram in datagrams:
+        if isinstance(datagram, tuple):
+            parts.extend(datagram)
+        else:
+            parts.append(datagram)
+    return parts
+
+# Send one datagram given as a tuple of buffers (e.g. a header and a slice of a
+# mapped file) without first joining them, where the platform has sendmsg()
+def send_parts(sock, parts, dest):
+    if hasattr(sock, "sendmsg"):
+        sock.sendmsg(parts, [], 0, dest)
+    else:
+        sock.sendto(b"".join(parts), dest)
+
+# Queues datagrams and sends them with as few syscalls as the platform allows.
+# mode is one of:
+#   "gso"      runs of equal-sized datagrams to one client become a single
+#              sendmsg() with UDP_SEGMENT; the kernel splits them on the way out
+#   "sendmmsg" up to max_batch datagrams, to any mix of clients, per syscall
+#   "loop"     one sendto() per datagram
+# The default picks the first that works here; "gso" falls back to sendmmsg
+# (or the loop) for datagrams that do not form a run.
+# A datagram is a bytes-like object or a tuple of them (header, payload), which
+# GSO and the loop hand to the kernel without joining.
+# Datagrams are sent in the order they were added. When the socket buffer is
+# full, flush() keeps what is left and returns False so the caller can retry.
+# The queue holds at most about max_pending datagrams: callers check full()
+# and hold back new data until it drains, and resends queued through sendto()
+# while it is full are dropped (the client asks again).
+class BatchSender:
+    def __init__(self, sock, max_batch=64, mode=None, max_pending=1024):
+        self.sock = sock
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.libc = load_sendmmsg() if mode in (None, "gso", "sendmmsg") else None
+        self.gso = gso_supported(sock) if mode in (None, "gso") else False
+        if mode is None:
+            mode = "gso" if self.gso else "sendmmsg" if self.libc else "loop"
+        self.mode = mode
+        self.pending = []     # (datagram, size, dest) not yet sent
+        self.addresses = {}   # dest -> (address, buffer) of its sockaddr_in, for sendmmsg
+        self.mmsg_arrays = None
+        self.syscalls = 0
+        self.sent = 0
+        self.dropped = 0
+
+    def add(self, datagram, dest):
+        self.pending.append((datagram, datagram_size(datagram), dest))
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+
+    # Socket-style alias, so code written against a socket (SendWindow.resend) can queue here
+    def sendto(self, datagram, dest):
+        if self.full():
+            self.dropped += 1
+            return
+        self.add(datagram, dest)
+
+    # Whether the queue is at its cap because the socket buffer is not draining
+    def full(self):
+        return len(self.pending) >= self.max_pending
+
+    # Send everything queued; False if the socket buffer filled up first
+    def flush(self):
+        try:
+            while self.pending:
+                run = self._gso_run() if self.gso else 1
+                if run > 1:
+                    self._send_gso(run)
+                elif self.libc:
+                    self._send_mmsg()
+                else:
+                    self._send_one()
+        except BlockingIOError:
+            return False
+        return True
+
+    # Length of the GSO-able run at the head of the queue: same client, same size
+    # (the last one may be shorter), within the segment and byte limits
+    def _gso_run(self, start=0):
+        _, size, dest = self.pending[start]
+        run = 1
+        total = size
+        for _, other_size, other in self.pending[start + 1:start + MAX_GSO_SEGMENTS]:
+            if other != dest or other_size > size or total + other_size > MAX_GSO_BYTES:
+                break
+            run += 1
+            total += other_size
+            if other_size < size:
+                break  # A shorter datagram can only end a run
+        return run
+
+    def _send_gso(self, run):
+        batch = self.pending[:run]
+        _, segment, dest = batch[0]
+        self.syscalls += 1
+        try:
+            self.sock.sendmsg(datagram_parts(datagram for datagram, _, _ in batch),
+                              [(socket.SOL_UDP, UDP_SEGMENT, struct.pack("=H", segment))], 0, dest)
+        except BlockingIOError:
+            raise
+        except OSError as e:
+            print(f"Dropped {run} datagrams to {dest[0]}:{dest[1]}: {e}")
+        del self.pending[:run]
+        self.sent += run
+
+    # One sendmmsg() over the datagrams at the head of the queue, stopping
+    # before a GSO run so it keeps its place in the order
+    def _send_mmsg(self):
+        batch = []
+        for entry in self.pending[:self.max_batch]:
+            if batch and self.gso and self._gso_run(len(batch)) > 1:
+                break
+            batch.append(entry)
+        count = len(batch)
+
+        # Filling ctypes fields one by one costs more than the syscalls saved, so the
+        # datagrams are joined into one buffer and the iovec array and message names
+        # are written with struct into arrays preallocated in _mmsg_arrays()
+        msgs, iovs = self._mmsg_arrays()
+        blob = b"".join(datagram_parts(datagram for datagram, _, _ in batch))
+        base = ctypes.cast(ctypes.c_char_p(blob), ctypes.c_void_p).value
+        iov_values = []
+        names = []
+        for _, size, dest in batch:
+            iov_values.append(base)
+            iov_values.append(size)
+            base += size
+            address = self.addresses.get(dest)
+            if address is None:
+                buffer = ctypes.create_string_buffer(pack_sockaddr(dest), SOCKADDR_IN_SIZE)
+                address = self.addresses[dest] = (ctypes.addressof(buffer), buffer)
+            names.append(address[0])
+        struct.pack_into(f"{2 * count}N", iovs, 0, *iov_values)
+        for i, name in enumerate(names):
+            MSG_NAME.pack_into(msgs, i * MMSGHDR_SIZE, name)
+
+        self.syscalls += 1
+        sent = self.libc.sendmmsg(self.sock.fileno(), msgs, count, 0)
+        if sent < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                raise BlockingIOError(err, "sendmmsg")
+            # The first datagram failed (e.g. unreachable client); drop it and carry on
+            _, _, dest = self.pending.pop(0)
+            print(f"Dropped datagram to {dest[0]}:{dest[1]}: {errno.errorcode.get(err, err)}")
+            return
+        del self.pending[:sent]
+        self.sent += sent
+
+    # mmsghdr/iovec arrays for max_batch messages, with the fields that never change filled in
+    def _mmsg_arrays(self):
+        if self.mmsg_arrays is None:
+            msgs = (mmsghdr * self.max_batch)()
+            iovs = (iovec * self.max_batch)()
+            for i in range(self.max_batch):
+                msgs[i].msg_hdr.msg_namelen = SOCKADDR_IN_SIZE
+                msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovs[i])
+                msgs[i].msg_hdr.msg_iovlen = 1
+            self.mmsg_arrays = (msgs, iovs)
+        return self.mmsg_arrays
+
+    def _send_one(self):
+        datagram, _, dest = self.pending[0]
+        self.syscalls += 1
+        try:
+            if isinstance(datagram, tuple):
+                send_parts(self.sock, datagram, dest)
+            else:
+                self.sock.sendto(datagram, dest)
+        except BlockingIOError:
+            raise
+        except OSError as e:
+            print(f"Dropped datagram to {dest[0]}:{dest[1]}: {e}")
+        del self.pending[0]
+        self.sent += 1
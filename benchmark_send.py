@@ -0,0 +1,82 @@
+import argparse
+import socket
+import time
+from protocol import pack_packet
+from batching import BatchSender, load_sendmmsg, gso_supported
+
+# Measure UDP send throughput of the plain sendto() loop against the batched
+# send paths, in packets per second of CPU time (i.e. per core).
+# Datagrams go to local sink sockets that are never read; the kernel drops
+# what does not fit, which costs the sender the same as a real client would.
+#
+#   python benchmark_send.py --packets 200000 --clients 50 --burst 16
+
+def make_sinks(count):
+    sinks = []
+    for _ in range(count):
+        sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink.bind(("127.0.0.1", 0))
+        sinks.append(sink)
+    return sinks
+
+# Send `packets` datagrams, `burst` at a time to each client in turn (like the
+# engine visiting each due session), flushing once per round over all clients
+def run(mode, packets, dests, burst, chunk_size):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    payload = bytes(chunk_size)
+    datagrams = [pack_packet(1, seq, seq, payload) for seq in range(burst)]
+
+    sender = None if mode == "sendto" else BatchSender(sock, mode=mode)
+    sent = 0
+    start_cpu = time.process_time()
+    start_wall = time.perf_counter()
+    while sent < packets:
+        for dest in dests:
+            for datagram in datagrams:
+                if sender:
+                    sender.add(datagram, dest)
+                else:
+                    try:
+                        sock.sendto(datagram, dest)  # What stream_audio does per chunk
+                    except BlockingIOError:
+                        pass
+            sent += burst
+        if sender:
+            sender.flush()
+            sender.pending.clear()  # Drop anything the socket buffer refused, as the loop does
+    cpu = time.process_time() - start_cpu
+    wall = time.perf_counter() - start_wall
+    sock.close()
+    syscalls = sender.syscalls if sender else sent
+    return sent / cpu, sent / wall, sent / syscalls
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark batched UDP sending")
+    parser.add_argument("--packets", type=int, default=200000)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--burst", type=int, default=16, help="datagrams per client per round")
+    parser.add_argument("--chunk-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    sinks = make_sinks(args.clients)
+    dests = [sink.getsockname() for sink in sinks]
+
+    modes = ["sendto"]
+    if load_sendmmsg():
+        modes.append("sendmmsg")
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if gso_supported(probe):
+        modes.append("gso")
+    probe.close()
+
+    print(f"{args.packets} packets of {args.chunk_size} bytes, {args.clients} clients, bursts of {args.burst}")
+    print(f"{'mode':<10}{'pkt/s/core':>14}{'pkt/s wall':>14}{'pkt/syscall':>13}{'speedup':>10}")
+    baseline = None
+    for mode in modes:
+        per_core, per_wall, per_syscall = run(mode, args.packets, dests, args.burst, args.chunk_size)
+        baseline = baseline or per_core
+        print(f"{mode:<10}{per_core:>14.0f}{per_wall:>14.0f}{per_syscall:>13.1f}{per_core / baseline:>9.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+import collections
+import hmac
+import ipaddress
+import secrets
+import select
+import socket
+import threading
+import time
+from wav_utils import byte_rate, frame_bytes, frame_chunk_size
+from pacing import Pacer
+from protocol import pack_packet, pack_header, unpack_packet, FLAG_END, FLAG_PARITY, FLAG_REPORT
+from fec import build_parity
+from batching import BatchSender, datagram_size
+from track_maps import TrackMaps
+
+# Per-channel counters, totalled over every channel in ChannelManager.metrics
+CHANNEL_COUNTERS = ["joins", "leaves", "expired", "packets_sent", "datagrams_sent", "bytes_sent"]
+SUBSCRIBER_TIMEOUT = 5.0  # Seconds without a reception report (or since joining) before a fan-out listener is dropped
+
+# One broadcast of a track, shared by every listener who asks for it while it runs.
+# The track's PCM data is sent once, in packets that each hold whole sample frames,
+# either to a multicast group or (fan-out) to each subscriber from the same
+# datagram. Listeners join at whatever packet comes next, so the join point is
+# always a frame boundary. The channel ends after the last packet of the track.
+# Fan-out listeners leave with the token their join returned (see leave()); those
+# that send no reception report (abr.pack_report) for SUBSCRIBER_TIMEOUT, counted
+# from their join until the first one, are dropped as gone, so a crashed client
+# is not sent the rest of the track. A fan-out channel with no listeners left
+# ends early and frees its slot.
+class Channel(threading.Thread):
+    def __init__(self, track, stream_id, group, fec_group, chunk_size, lead_seconds, maps, on_end):
+        super().__init__(name=f"channel-{track.track_id}", daemon=True)
+        self.track = track
+        self.stream_id = stream_id
+        self.group = group              # (address, port) for multicast, None for fan-out
+        self.fec_group = fec_group
+        self.frame_size = frame_bytes(track)
+        self.chunk_size = frame_chunk_size(track, chunk_size)  # Whole frames per packet
+        self.lead_seconds = lead_seconds
+        self.maps = maps
+        self.on_end = on_end
+        self.lock = threading.Lock()
+        self.subscribers = {}           # (ip, port) of fan-out listeners -> [token, time of their last report or join]
+        self.seq = 0                    # Next packet to be sent
+        self.offset = 0                 # Byte offset of that packet in the PCM data
+        self.started = time.time()
+        self.ended = False
+
+        # Statistics; written by the channel's thread only (joins and leaves under the lock)
+        self.joins = 0
+        self.leaves = 0
+        self.expired = 0         # Listeners dropped after their reports stopped
+        self.packets_sent = 0    # Data packets of the track, each counted once
+        self.datagrams_sent = 0  # Datagrams handed to the socket: one per subscriber when fanning out
+        self.bytes_sent = 0      # Bytes of those datagrams
+
+    # Add a listener and return where it joins; None once the channel has ended
+    def join(self, client=None):
+        with self.lock:
+            if self.ended:
+                return None
+            token = None
+            if client and self.group is None:
+                token = secrets.token_hex(8)
+                self.subscribers[client] = [token, time.monotonic()]
+            self.joins += 1
+            return {
+                "stream_id": self.stream_id,
+                "seq": self.seq,
+                "offset_ms": int(self.offset / byte_rate(self.track) * 1000),
+                "token": token,  # For leave(); None on multicast, where the server sends to nobody in particular
+            }
+
+    # Stop sending to the fan-out listener whose join returned `token`; False if there is none
+    def leave(self, token):
+        with self.lock:
+            for client, (subscriber_token, _) in self.subscribers.items():
+                if hmac.compare_digest(subscriber_token.encode(), str(token).encode()):
+                    del self.subscribers[client]
+                    self.leaves += 1
+                    return True
+        return False
+
+    def run(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.group:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)   # Stay on the local network
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)  # Listeners on this host too
+        sender = BatchSender(sock)
+        pacer = Pacer(byte_rate(self.track), self.lead_seconds)
+        group = []
+        print(f"Channel {self.stream_id} broadcasting track {self.track.track_id} to {self._describe()}")
+        try:
+            with self.maps.open(self.track) as data:
+                pcm = data[self.track.data_offset:self.track.data_offset + self.track.data_size]
+                while self.offset < len(pcm):
+                    chunk = pcm[self.offset:self.offset + self.chunk_size]
+                    pacer.wait(len(chunk))
+                    datagram = (pack_header(self.stream_id, self.seq, self.offset // self.frame_size), chunk)
+                    self._send(sender, datagram)
+                    with self.lock:
+                        self.seq += 1
+                        self.offset += len(chunk)
+                    self.packets_sent += 1
+                    if self.group is None:
+                        self._read_reports(sock)
+                        with self.lock:
+                            if not self.subscribers:
+                                self.ended = True  # Under the lock, so no one joins a channel about to stop
+                                print(f"Channel {self.stream_id} has no listeners left")  # Debugging line
+                                break
+
+                    if self.fec_group:
+                        group.append(chunk)
+                        if len(group) == self.fec_group:
+                            self._send(sender, pack_packet(self.stream_id, self.seq - len(group), 0, build_parity(group), FLAG_PARITY))
+                            group = []
+
+                if group:
+                    self._send(sender, pack_packet(self.stream_id, self.seq - len(group), 0, build_parity(group), FLAG_PARITY))
+                with self.lock:
+                    self.ended = True
+                self._send(sender, pack_packet(self.stream_id, self.seq, self.offset // self.frame_size, flags=FLAG_END))
+        except Exception as e:
+            print(f"Channel {self.stream_id} failed: {e}")
+        finally:
+            with self.lock:
+                self.ended = True
+            sock.close()
+            self.on_end(self)
+            print(f"Channel {self.stream_id} ended after {self.seq} packets")
+
+    # Send one datagram to the group or to every subscriber, in as few syscalls as possible
+    def _send(self, sender, datagram):
+        if self.group:
+            destinations = [self.group]
+        else:
+            with self.lock:
+                destinations = list(self.subscribers)
+        for destination in destinations:
+            sender.add(datagram, destination)
+        self.datagrams_sent += len(destinations)
+        self.bytes_sent += datagram_size(datagram) * len(destinations)
+        sender.flush()
+
+    # Note the reception reports fan-out listeners sent back, and drop the listeners
+    # that sent none for SUBSCRIBER_TIMEOUT
+    def _read_reports(self, sock):
+        now = time.monotonic()
+        while select.select([sock], [], [], 0)[0]:
+            try:
+                data, addr = sock.recvfrom(4096)
+                flags, stream_id, _, _, _ = unpack_packet(data)
+            except (OSError, ValueError):
+                continue  # e.g. ICMP port unreachable reported on Windows, or a malformed packet
+            if stream_id == self.stream_id and flags & FLAG_REPORT:
+                with self.lock:
+                    subscriber = self.subscribers.get(addr)
+                    if subscriber:
+                        subscriber[1] = now
+        with self.lock:
+            gone = [client for client, (_, last_report) in self.subscribers.items()
+                    if now - last_report > SUBSCRIBER_TIMEOUT]
+            for client in gone:
+                del self.subscribers[client]
+                self.expired += 1
+                print(f"Channel {self.stream_id} dropped {client[0]}:{client[1]}, no report for {SUBSCRIBER_TIMEOUT} s")  # Debugging line
+
+    def _describe(self):
+        if self.group:
+            return f"group {self.group[0]}:{self.group[1]}"
+        return "its subscribers"
+
+# Shared broadcasts, at most one running per track.
+# With a multicast base address (e.g. "239.255.77.0") every channel gets its own
+# group address from that /24 and the same port, so server egress grows with the
+# number of channels, not listeners. Without one, channels fan out each packet
+# to their subscribers; the track is still read, framed and protected once.
+class ChannelManager:
+    def __init__(self, max_channels, multicast_base=None, port=5006, fec_group=0,
+                 chunk_size=1024, lead_seconds=0.5, maps=None):
+        self.max_channels = max_channels
+        self.port = port
+        self.fec_group = fec_group
+        self.chunk_size = chunk_size
+        self.lead_seconds = lead_seconds
+        self.maps = maps or TrackMaps()
+        self.lock = threading.RLock()  # join() calls new_stream_id(), which may ask stream_ids()
+        self.channels = {}  # track_id -> running Channel
+        self.free_groups = []
+
+        # Totals of the channels that ended, for /metrics
+        self.started = 0
+        self.ended = collections.Counter()  # joins, packets_sent, datagrams_sent, bytes_sent
+        if multicast_base:
+            network = ipaddress.ip_network(f"{multicast_base}/24", strict=False)
+            self.free_groups = [str(address) for address in network.hosts()][:max_channels]
+
+    # Join the channel of `track`, starting one if none is running with an id from
+    # new_stream_id(). Returns the join info for the /stream response, or None when
+    # max_channels are busy or no stream id is free.
+    def join(self, track, new_stream_id, client=None):
+        with self.lock:
+            while True:
+                channel = self.channels.get(track.track_id)
+                new = channel is None
+                if new:
+                    stream_id = new_stream_id() if len(self.channels) < self.max_channels else None
+                    if stream_id is None:
+                        return None
+                    group = (self.free_groups.pop(0), self.port) if self.free_groups else None
+                    channel = Channel(track, stream_id, group, self.fec_group, self.chunk_size,
+                                      self.lead_seconds, self.maps, self._ended)
+                    self.channels[track.track_id] = channel
+                    self.started += 1
+                info = channel.join(client)
+                if new:
+                    channel.start()  # After the first join, so a fan-out channel never starts out empty
+                if info is not None:
+                    break
+                del self.channels[track.track_id]  # Ended just now; start a fresh one
+
+        return {
+            **info,
+            "group": channel.group[0] if channel.group else None,
+            "port": channel.group[1] if channel.group else None,
+            "fec": channel.fec_group,
+            "format": {
+                "channels": track.channels,
+                "sample_width": track.sample_width,
+                "frame_rate": track.frame_rate,
+            },
+        }
+
+    # Ids of the running channels
+    def stream_ids(self):
+        with self.lock:
+            return {channel.stream_id for channel in self.channels.values()}
+
+    # Let a fan-out listener leave the channel `stream_id` (see Channel.leave); False if it is not in one
+    def leave(self, stream_id, token):
+        with self.lock:
+            channels = [channel for channel in self.channels.values() if channel.stream_id == stream_id]
+        return any(channel.leave(token) for channel in channels)
+
+    def snapshot(self):
+        with self.lock:
+            channels = list(self.channels.values())
+        return {
+            "max_channels": self.max_channels,
+            "channels": [{
+                "stream_id": channel.stream_id,
+                "track_id": channel.track.track_id,
+                "group": channel.group[0] if channel.group else None,
+                "seq": channel.seq,
+                "listeners": len(channel.subscribers) if channel.group is None else None,
+                "started": channel.started,
+                "joins": channel.joins,
+                "leaves": channel.leaves,
+                "expired": channel.expired,
+                "packets_sent": channel.packets_sent,
+                "datagrams_sent": channel.datagrams_sent,
+                "bytes_sent": channel.bytes_sent,
+            } for channel in channels],
+        }
+
+    # Totals for metrics.render_metrics: ended channels plus the running ones so far
+    def metrics(self):
+        with self.lock:
+            channels = list(self.channels.values())
+            stats = {"started": self.started, "live": len(channels), **{name: self.ended[name] for name in CHANNEL_COUNTERS}}
+            for channel in channels:  # Read without the channel thread's cooperation; off by a packet at most
+                for name in CHANNEL_COUNTERS:
+                    stats[name] += getattr(channel, name)
+        return stats
+
+    def _ended(self, channel):
+        with self.lock:
+            if self.channels.get(channel.track.track_id) is channel:
+                del self.channels[channel.track.track_id]
+            for name in CHANNEL_COUNTERS:
+                self.ended[name] += getattr(channel, name)
+            if channel.group:
+                self.free_groups.append(channel.group[0])
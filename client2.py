@@ -3,10 +3,12 @@ from tkinter import messagebox
 import pygame
 import socket
 import threading
-import io
 import requests
-import os
-import wave  # For creating a WAV header
+from receiver import receive_stream
+from playback import StreamPlayer
+from local_cache import LocalTrackCache, DamagedCopy
+from audio_codecs import CODECS, PacketDecoder
+from qos import PlaybackQos, append_jsonl
 
 # Initialize pygame
 pygame.mixer.init()
@@ -17,33 +19,106 @@ FLASK_SERVER_URL = "http://127.0.0.1:5000"  # Replace with your Flask server's U
 # UDP settings
 UDP_IP = "127.0.0.1"  # Replace with the server's IP address
 UDP_PORT = 5005       # Replace with the server's port
+PREFERRED_CODECS = ["pcm", "adpcm"]  # Payload codecs to ask for, best first; put "adpcm" first on slow links (lossy, so not cached)
+
+# Playback settings
+CANCEL_TIMEOUT = 1.0  # Seconds to wait for the server to cancel a stream we no longer play
+PREBUFFER_MS = 200  # Audio buffered before playback starts
+
+# QoS telemetry settings (see qos.py)
+QOS_LOG = "qos.jsonl"      # Each stream's playback QoS record is appended here (None disables)
+REPORT_QOS = True          # Also send the record to the server's /qos route
+QOS_LABELS = {}            # Added to every record, e.g. {"release": "1.4.0", "site": "berlin"} (keys from qos.RECORD_LABELS)
+QOS_REPORT_TIMEOUT = 2.0   # Seconds to wait for the server to take a record
+
+# Local cache settings
+CACHE_FOLDER = "cache"                    # Verified copies of streamed tracks
+CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024  # Least recently played copies are deleted beyond this
+
+# Track list settings
+TRACK_PAGE_SIZE = 100      # Tracks fetched per /tracks request
+TRACK_REFRESH_MS = 30000   # How often to check the server for a changed track list
+
+# Track list state
+track_list = []            # Tracks shown in the listbox, in order
+next_cursor = None         # Cursor of the next page, None once everything is loaded
+track_list_etag = None     # ETag of the first page, for cheap revalidation
+page_loading = False       # The next page is being fetched in the background
 
 # Global variable to track if audio is paused
 is_paused = False
 
+# Player for the track that is currently playing
+player = None
+
+# Playback state, for seeking and switching tracks
+current_track = None       # /tracks entry of the track that is playing
+playback_thread = None     # Thread receiving or reading it into the player
+playback_stop = None       # Set to end that thread
+current_stream = None      # /stream response of the last stream requested, cancelled when playback ends
+playback_start_ms = 0      # Position of the first audio written to the player since it was (re)started or flushed
+resume_ms = None           # Position to carry on from when a pause ended the playback thread
+
+# Tracks played before, replayed from disk instead of the network
+track_cache = LocalTrackCache(CACHE_FOLDER, CACHE_MAX_BYTES)
+
 # Function to stop the currently playing audio
 def stop_audio():
-    pygame.mixer.music.stop()
+    global is_paused, resume_ms
+    if player:
+        player.stop()
+    is_paused, resume_ms = False, None
     print("Audio stopped.")  # Debugging line
 
-# Function to pause the currently playing audio
+# Function to pause the currently playing audio.
+# The thread feeding the player is ended so the stream does not pile up while
+# nothing plays; the buffered audio is kept and resume_audio carries on after it.
 def pause_audio():
-    global is_paused
-    if pygame.mixer.music.get_busy():  # Check if audio is playing
-        pygame.mixer.music.pause()
+    global is_paused, resume_ms
+    if player and player.started and not is_paused:  # Check if audio is playing
+        player.pause()
         is_paused = True
+        end_playback()
+        if not player.finished and not player.stopped:
+            resume_ms = playback_start_ms + int(player.written_ms())
         print("Audio paused.")  # Debugging line
 
 # Function to resume the paused audio
 def resume_audio():
     global is_paused
     if is_paused:  # Check if audio is paused
-        pygame.mixer.music.unpause()
+        player.resume()
         is_paused = False
+        if resume_ms is not None and current_track is not None:
+            start_track(current_track, resume_ms, resume=True)  # Continues after the buffered audio
         print("Audio resumed.")  # Debugging line
 
-# Function to receive audio data via UDP
-def receive_audio(track_id):
+# Export a stream's playback QoS record: append it to QOS_LOG and send it to the server
+def export_qos(record):
+    if QOS_LOG:
+        try:
+            append_jsonl(QOS_LOG, record)
+        except OSError as e:
+            print(f"Error writing QoS record: {e}")  # Debugging line
+    if REPORT_QOS:
+        try:
+            requests.post(f"{FLASK_SERVER_URL}/qos", json=record, timeout=QOS_REPORT_TIMEOUT)
+        except requests.RequestException as e:
+            print(f"Error reporting QoS: {e}")  # Debugging line
+
+# Function to receive audio data via UDP and play it while it arrives
+# `stream` is the /stream response: stream_id, the audio format and codec.
+# `track` is the track's /tracks entry; a complete, verified stream is kept in the local cache.
+# `qos` (qos.PlaybackQos) collects the stream's playback quality, exported when it ends.
+# Setting `stop` ends the receive early and leaves `player` to the next stream.
+# With continue_ms the player already holds the audio up to there (after a pause or
+# a damaged cached copy); encoded streams start at the packet boundary before it,
+# so the overlap is dropped instead of played twice.
+def receive_audio(stream, track, qos, player, stop, continue_ms=None):
+    stream_id = stream["stream_id"]  # Used to ignore packets from earlier streams
+    audio_format = stream["format"]  # Packets carry PCM in this format, encoded with the stream's codec
+    channels, sample_width, frame_rate = audio_format["channels"], audio_format["sample_width"], audio_format["frame_rate"]
+    codec = stream.get("codec", "pcm")
     try:
         # Create a UDP socket
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -52,90 +127,236 @@ def receive_audio(track_id):
 
         print(f"Listening for UDP packets on {UDP_IP}:{UDP_PORT}...")
 
-        # Open a BytesIO object to store the received audio data
-        audio_data = io.BytesIO()
-
-        while True:
-            data, addr = sock.recvfrom(1024)  # Buffer size is 1024 bytes
-            if not data:  # Empty packet signals the end of the stream
-                print("Received end-of-stream marker.")  # Debugging line
-                break  # End of stream
-            print(f"Received {len(data)} bytes from {addr}")  # Debugging line
-            audio_data.write(data)
+        # Configure the output from the advertised format (still set up from before a seek otherwise)
+        if not player.started:
+            player.start(channels, sample_width, frame_rate)
+            print("Playing audio...")  # Debugging line
+        qos.on_player(player)
+
+        # Keep a copy in the local cache while it plays, unless we seeked or get lossy
+        # audio (which would never match the track's hash)
+        cache_writer = None
+        if stream.get("start_ms", 0) == 0 and CODECS[codec].lossless:
+            cache_writer = track_cache.writer(track["id"], track.get("hash"), channels, sample_width, frame_rate)
+
+        skip = 0  # Bytes at the start of the stream the player already has
+        if continue_ms is not None and "start_frame" in stream:
+            skip = max(0, int(continue_ms * frame_rate / 1000) - stream["start_frame"]) * channels * sample_width
+
+        # Called with each payload of PCM in sequence order
+        def on_payload(data):
+            nonlocal skip
+            if skip:
+                dropped = min(skip, len(data))
+                data, skip = data[dropped:], skip - dropped
+            player.write(data)
+            if cache_writer:
+                cache_writer.write(data)
+
+        # Receive the stream in sequence order, with lost packets replaced by silence
+        receive_stream(sock, stream_id, on_payload, stop=stop, decoder=PacketDecoder(audio_format), qos=qos)
+        if not stop.is_set():
+            player.finish()
 
         # Close the socket
         sock.close()
         print("Socket closed.")  # Debugging line
 
-        # Create the Tempo folder if it doesn't exist
-        tempo_folder = "Tempo"
-        print(f"Current working directory: {os.getcwd()}")  # Debugging line
-        if not os.path.exists(tempo_folder):
-            print(f"Creating folder: {tempo_folder}")  # Debugging line
-            os.makedirs(tempo_folder)
-            print(f"Folder created: {tempo_folder}")  # Debugging line
-        else:
-            print(f"Folder already exists: {tempo_folder}")  # Debugging line
-
-        # Save the received data to a file in the Tempo folder
-        file_path = os.path.join(tempo_folder, f"received_audio_{track_id}.wav")
-        with open(file_path, "wb") as f:
-            f.write(audio_data.getvalue())  # Write the contents of BytesIO to the file
-        print(f"Audio saved to {file_path}")  # Debugging line
-
-        # Add a WAV header to the received audio data
-        wav_buffer = io.BytesIO()
-        with wave.open(wav_buffer, 'wb') as wav_file:
-            wav_file.setnchannels(2)  # Stereo
-            wav_file.setsampwidth(2)  # 16-bit
-            wav_file.setframerate(44100)  # 44.1 kHz
-            wav_file.writeframes(audio_data.getvalue())
-
-        # Rewind the buffer
-        wav_buffer.seek(0)
-
-        # Play the audio using pygame
-        pygame.mixer.music.load(wav_buffer)
-        print("Audio data loaded into Pygame.")  # Debugging line
-        pygame.mixer.music.play()
-        print("Playing audio...")  # Debugging line
-        while pygame.mixer.music.get_busy():  # Wait until the audio finishes playing
-            pygame.time.Clock().tick(10)
+        if cache_writer:
+            if stop.is_set():
+                cache_writer.discard()
+            else:
+                cache_writer.close()
+
+        export_qos(qos.record(completed=not stop.is_set()))
 
     except Exception as e:
         print(f"Error receiving data: {e}")  # Debugging line
         messagebox.showerror("Error", str(e))
 
+# Function to play a track from the local cache, streaming the rest of it if the copy is damaged
+def play_cached_track(track, start_ms, player, stop):
+    try:
+        print(f"Playing track {track['id']} from the local cache")  # Debugging line
+        track_cache.play(track["id"], track["hash"], player, start_ms, stop)
+    except DamagedCopy as e:
+        if stop.is_set():
+            return
+        qos = PlaybackQos(track["id"], QOS_LABELS)
+        stream = request_stream(track, e.position_ms)
+        if stream is not None:
+            qos.on_response(stream)
+            receive_audio(stream, track, qos, player, stop, continue_ms=e.position_ms)
+    except Exception as e:
+        print(f"Error playing cached track: {e}")  # Debugging line
+        messagebox.showerror("Error", str(e))
+
+# Ask the server to stream `track` from start_ms; returns the /stream response, or None
+def request_stream(track, start_ms=0):
+    global current_stream
+    # Send an HTTP request to the Flask server to start streaming the selected track
+    try:
+        params = {"codec": ",".join(name for name in PREFERRED_CODECS if name in CODECS)}
+        if start_ms:
+            params["start_ms"] = start_ms
+        response = requests.get(f"{FLASK_SERVER_URL}/stream/{track['id']}", params=params)
+        if response.status_code == 200:
+            print(f"Requested track {track['id']} from the server.")
+            current_stream = response.json()
+            return current_stream
+        if response.status_code == 503:
+            retry_after = response.headers.get("Retry-After", "a few")
+            messagebox.showerror("Server busy", f"The server is at capacity, try again in {retry_after} seconds.")
+        else:
+            messagebox.showerror("Error", f"Failed to request track {track['id']} from the server.")
+    except Exception as e:
+        messagebox.showerror("Error", str(e))
+    return None
+
+# Play `track` from start_ms, from the local cache when it holds a copy and streamed
+# otherwise. On a seek the current player is reused with its output still set up;
+# with resume=True the audio is appended to what the player still holds (after a pause).
+def start_track(track, start_ms=0, resume=False):
+    global player, current_track, playback_thread, playback_stop, playback_start_ms, resume_ms, is_paused
+    if player is None or player.stopped:
+        player = StreamPlayer(PREBUFFER_MS)
+        is_paused = False
+    if not resume:
+        playback_start_ms = start_ms
+    if is_paused:
+        current_track, resume_ms = track, start_ms  # Seeked while paused: start once resumed
+        return
+    resume_ms = None
+
+    kwargs = {}
+    if track_cache.lookup(track["id"], track.get("hash")):
+        target, args = play_cached_track, (track, start_ms)  # Played before: no need to touch the network
+    else:
+        qos = PlaybackQos(track["id"], QOS_LABELS)  # Started before the request, which counts towards latency
+        stream = request_stream(track, start_ms)
+        if stream is None:
+            return
+        qos.on_response(stream)
+        target, args = receive_audio, (stream, track, qos)
+        if resume:
+            kwargs = {"continue_ms": start_ms}
+        else:
+            playback_start_ms = stream.get("start_ms", start_ms)  # Encoded streams start at a packet boundary
+
+    # Start a new thread to receive (or read) and play the audio
+    current_track = track
+    playback_stop = threading.Event()
+    playback_thread = threading.Thread(target=target, args=args + (player, playback_stop), kwargs=kwargs)
+    playback_thread.start()
+
+# End the thread feeding the player. On a seek the player is flushed first, which
+# also releases a writer blocked on a full jitter buffer.
+def end_playback(flush=False):
+    if playback_thread is None:
+        return
+    playback_stop.set()
+    if flush and not player.stopped:
+        player.flush()
+    playback_thread.join()
+    cancel_stream()
+
+# Tell the server to stop sending the last stream requested, so it does not hold
+# a session slot (and bandwidth) until the track would have ended
+def cancel_stream():
+    global current_stream
+    stream, current_stream = current_stream, None
+    if stream is None or "token" not in stream:
+        return  # Nothing streaming, or a server that cannot cancel
+    try:
+        requests.delete(f"{FLASK_SERVER_URL}/stream/{stream['stream_id']}", params={"token": stream["token"]},
+                        timeout=CANCEL_TIMEOUT)
+    except requests.RequestException as e:
+        print(f"Error cancelling stream {stream['stream_id']}: {e}")  # Debugging line
+
 # Function to play the selected track
 def play_selected_track():
     selected_track_index = track_listbox.curselection()  # Get the selected track index
     if selected_track_index:
-        selected_track_id = selected_track_index[0]  # Get the first selected index
-        # Send an HTTP request to the Flask server to start streaming the selected track
-        try:
-            response = requests.get(f"{FLASK_SERVER_URL}/stream/{selected_track_id}")
-            if response.status_code == 200:
-                print(f"Requested track {selected_track_id} from the server.")
-            else:
-                messagebox.showerror("Error", f"Failed to request track {selected_track_id} from the server.")
-        except Exception as e:
-            messagebox.showerror("Error", str(e))
-
-        # Start a new thread to receive and play the audio
-        threading.Thread(target=receive_audio, args=(selected_track_id,)).start()
-
-# Fetch the list of tracks from the server
-def fetch_track_list():
+        selected_track = track_list[selected_track_index[0]]
+        stop_audio()  # Only one track plays at a time
+        end_playback()
+        seek_scale.config(to=int(selected_track["duration"]))
+        seek_scale.set(0)
+        start_track(selected_track)
+
+# Function to jump to the position chosen on the seek bar.
+# Buffered audio is dropped and playback resumes after one prebuffer of the new position.
+def seek_audio():
+    if current_track is None:
+        return
+    start_ms = int(seek_scale.get() * 1000)
+    end_playback(flush=True)
+    start_track(current_track, start_ms)
+    print(f"Seeking to {start_ms} ms")  # Debugging line
+
+# Fetch one page of the track list from the server.
+# Returns {"tracks", "next_cursor", "etag"}, or None when etag is given and the list is unchanged.
+# A failed fetch returns no tracks and `cursor` again, so the same page can be retried.
+def fetch_track_list(cursor=None, etag=None, show_errors=True):
     try:
-        response = requests.get(f"{FLASK_SERVER_URL}/tracks")
+        params = {"limit": TRACK_PAGE_SIZE}
+        if cursor:
+            params["cursor"] = cursor
+        headers = {"If-None-Match": etag} if etag else {}
+        response = requests.get(f"{FLASK_SERVER_URL}/tracks", params=params, headers=headers)
+        if response.status_code == 304:
+            return None  # Unchanged since the last fetch
         if response.status_code == 200:
-            return response.json()  # Assume the server returns a JSON list of track names
-        else:
-            messagebox.showerror("Error", "Failed to fetch track list from the server.")
-            return []
+            page = response.json()  # {"tracks": [{"id", "name", "duration", "hash"}, ...], "next_cursor": ...}
+            page["etag"] = response.headers.get("ETag")
+            return page
+        error = "Failed to fetch track list from the server."
     except Exception as e:
-        messagebox.showerror("Error", str(e))
-        return []
+        error = str(e)
+    print(f"Error fetching track list: {error}")  # Debugging line
+    if show_errors:
+        messagebox.showerror("Error", error)
+    return {"tracks": [], "next_cursor": cursor, "etag": None}
+
+# Append a page of tracks to the listbox
+def show_track_page(page):
+    global next_cursor
+    for track in page["tracks"]:
+        track_list.append(track)
+        track_listbox.insert(tk.END, track["name"])  # Add track names to the listbox
+    next_cursor = page["next_cursor"]
+
+# Load the next page once the listbox is scrolled close to its end.
+# The page is fetched on a worker thread so a slow server does not freeze the
+# window; after a failed fetch, scrolling again retries it.
+def on_track_list_scroll(first, last):
+    global page_loading
+    if next_cursor and not page_loading and float(last) >= 0.9:
+        page_loading = True
+        threading.Thread(target=load_track_page, args=(next_cursor,), daemon=True).start()
+
+# Fetch the page at `cursor` and hand it to the Tk thread
+def load_track_page(cursor):
+    page = fetch_track_list(cursor, show_errors=False)
+    root.after(0, add_track_page, cursor, page)
+
+# Show a page fetched by load_track_page, unless the list was reloaded meanwhile
+def add_track_page(cursor, page):
+    global page_loading
+    page_loading = False
+    if cursor == next_cursor:
+        show_track_page(page)
+
+# Periodically revalidate the first page; the list is only reloaded when the server's changed
+def refresh_track_list(show_errors=False):
+    global track_list_etag
+    page = fetch_track_list(etag=track_list_etag, show_errors=show_errors)
+    if page is not None and page["etag"]:
+        track_list.clear()
+        track_listbox.delete(0, tk.END)
+        track_list_etag = page["etag"]
+        show_track_page(page)
+    root.after(TRACK_REFRESH_MS, refresh_track_list)
 
 # Tkinter GUI
 root = tk.Tk()
@@ -167,9 +388,6 @@ description_label = tk.Label(
 )
 description_label.pack(pady=10)
 
-# Fetch the list of tracks from the server
-track_list = fetch_track_list()
-
 # Listbox for track selection
 track_listbox = tk.Listbox(
     root,
@@ -179,10 +397,12 @@ track_listbox = tk.Listbox(
     fg="#FFFFFF",
     selectbackground="#1DB954",  # Spotify green selection background
     selectforeground="#FFFFFF",   # White selection text
-    height=10
+    height=10,
+    yscrollcommand=on_track_list_scroll  # Loads more tracks as the list is scrolled
 )
-for track_name in track_list:
-    track_listbox.insert(tk.END, track_name)  # Add track names to the listbox
+
+# Fetch the first page of tracks from the server; the rest load lazily
+refresh_track_list(show_errors=True)
 track_listbox.pack(pady=20, fill=tk.BOTH, expand=True)
 
 # Button frame
@@ -249,4 +469,37 @@ stop_button = tk.Button(
 )
 stop_button.grid(row=0, column=3, padx=10, pady=5)
 
+# Seek bar: pick a position in seconds and jump there
+seek_frame = tk.Frame(root, bg="#121212")
+seek_frame.pack(pady=10, fill=tk.X)
+
+seek_scale = tk.Scale(
+    seek_frame,
+    from_=0,
+    to=0,  # Set to the track's duration when it starts
+    orient=tk.HORIZONTAL,
+    label="Position (s)",
+    bg="#121212",
+    fg="#FFFFFF",
+    troughcolor="#181818",
+    highlightthickness=0,
+    font=("Arial", 12)
+)
+seek_scale.pack(side=tk.LEFT, padx=10, fill=tk.X, expand=True)
+
+# Seek button
+seek_button = tk.Button(
+    seek_frame,
+    text="Seek",
+    command=seek_audio,
+    bg="#1DB954",  # Spotify green
+    fg="white",
+    font=("Arial", 14),
+    width=20,
+    bd=0,
+    padx=10,
+    pady=10
+)
+seek_button.pack(side=tk.LEFT, padx=10)
+
 root.mainloop()
\ No newline at end of file
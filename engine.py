@@ -0,0 +1,259 @@
+import collections
+import heapq
+import itertools
+import selectors
+import socket
+import struct
+import threading
+import time
+from wav_utils import byte_rate, frame_bytes
+from pacing import Pacer
+from protocol import pack_packet, pack_header, unpack_packet, codec_flags, FLAG_END, FLAG_PARITY, FLAG_NACK, FLAG_REPORT
+from fec import build_parity
+from retransmit import SendWindow, unpack_nack
+from batching import BatchSender
+from sessions import SessionTable
+from audio_codecs import CODECS
+from abr import BitrateController, unpack_report
+from frame_cache import FrameCache
+from packet_store import PacketStore
+
+# Per-session send state for the event-loop engine
+class EngineStream:
+    def __init__(self, session, track, dest, fec_group, nack, start, codec, ladder, engine):
+        self.session = session
+        self.dest = dest
+        self.track = track
+        self.variants = engine.frames.variants(track, fec_group, start)  # Cached frames, or slices of a memory map
+        self.controller = BitrateController(ladder, codec) if ladder else None  # Adaptive bitrate (see abr.py)
+        self.set_codec(codec)
+        self.pacer = Pacer(byte_rate(track), engine.lead_seconds)
+        self.frame_size = frame_bytes(track)
+        self.fec_group = fec_group
+        self.group = []  # Payloads of the current FEC group
+        self.window = SendWindow(engine.retransmit_window, engine.playout_deadline) if nack else None
+        self.seq = 0
+        self.offset = start  # Byte offset in the PCM data; timestamps count frames from the start of the audio
+        self.linger_until = None  # Set once the end marker went out and NACKs are still answered
+
+    # Send the following packets with another codec; only at an FEC group boundary
+    def set_codec(self, codec):
+        self.codec = codec
+        self.prepared = self.variants.get(codec)
+        self.flags = codec_flags(CODECS[codec].id)
+        if self.session.codec is not None:
+            self.session.codec_switches += 1
+        self.session.codec = codec
+
+    def close(self, engine):
+        self.variants.close()
+        self.prepared = None
+
+# Single-threaded streaming engine.
+# One non-blocking UDP socket serves every session. Each session sits in a
+# timer heap keyed by its next send deadline (from its byte rate, see Pacer),
+# and the loop sleeps in select() until the earliest deadline or until a NACK
+# or a new session arrives. Thousands of listeners cost one thread, one socket
+# and one open file each, instead of one thread and one socket each.
+# An error in one session (a bad file, an encoder failure) fails that session
+# only; the loop keeps serving the others.
+class StreamingEngine(threading.Thread):
+    def __init__(self, max_streams, chunk_size=1024, lead_seconds=0.5,
+                 retransmit_window=512, playout_deadline=0.3, burst=16, tick=0.02, lock=None,
+                 sock=None, on_finish=None, send_mode=None, cache_bytes=0, packet_folder=None):
+        super().__init__(name="streaming-engine", daemon=True)
+        self.max_streams = max_streams
+        self.chunk_size = chunk_size
+        self.lead_seconds = lead_seconds
+        self.retransmit_window = retransmit_window
+        self.playout_deadline = playout_deadline
+        self.burst = burst  # Packets sent for one session before others get a turn
+        self.tick = tick    # Packets due within this many seconds go out together, so they can be batched
+        self.on_finish = on_finish  # Called with each Session that ended (used by shard workers)
+
+        self.table = SessionTable(lock)
+        self.streams = {}         # stream_id -> EngineStream
+        self.timers = []          # Heap of (deadline, tiebreak, EngineStream)
+        self.tiebreak = itertools.count()
+        self.frames = FrameCache(cache_bytes, chunk_size, packets=PacketStore(packet_folder) if packet_folder else None)
+        self.inbox = collections.deque()  # New sessions handed over by request threads
+
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(("0.0.0.0", 0))
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.sender = BatchSender(self.sock, mode=send_mode)  # Datagrams of one loop pass go out in a few syscalls
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ, self._on_datagram)
+        self.selector.register(self.wake_r, selectors.EVENT_READ, self._on_wake)
+
+    # Start streaming `track` to dest=(ip, port), from byte `start` of its PCM data when
+    # seeking, encoded with the named codec; safe to call from any thread. With a
+    # ladder (codec names, highest bitrate first) the codec adapts to the client's reports.
+    # Returns False when the engine already serves max_streams sessions.
+    def submit(self, session, track, dest, fec_group=0, nack=False, start=0, codec="pcm", ladder=None):
+        if not self.table.admit(session, self.max_streams):
+            return False
+        self.inbox.append((session, track, dest, fec_group, nack, start, codec, ladder))
+        try:
+            self.wake_w.send(b"\0")
+        except BlockingIOError:
+            pass  # A wake-up is already pending
+        return True
+
+    # Stop a session (see SessionTable.cancel); False if there is none. Safe to call
+    # from any thread: the loop ends the session the next time it is due.
+    def cancel(self, stream_id, token):
+        return self.table.cancel(stream_id, token) is not None
+
+    def snapshot(self):
+        return {"engine": "eventloop", "max_active": self.max_streams, **self.table.snapshot()}
+
+    def run(self):
+        while True:
+            timeout = None
+            if self.sender.pending:
+                timeout = 0.001  # Socket buffer was full; retry shortly
+            elif self.timers:
+                timeout = max(0.0, self.timers[0][0] - time.monotonic())
+            for key, _ in self.selector.select(timeout):
+                key.data()
+
+            now = time.monotonic()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, stream = heapq.heappop(self.timers)
+                self._step(stream, now)
+            self.sender.flush()
+
+    def _schedule(self, stream, deadline):
+        heapq.heappush(self.timers, (deadline, next(self.tiebreak), stream))
+
+    # Pick up sessions handed over by submit()
+    def _on_wake(self):
+        try:
+            while self.wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.inbox:
+            session, track, dest, fec_group, nack, start, codec, ladder = self.inbox.popleft()
+            try:
+                stream = EngineStream(session, track, dest, fec_group, nack, start, codec, ladder, self)
+            except Exception as e:
+                print(f"Session {session.stream_id} failed: {e}")
+                session.state = "failed"
+                session.error = str(e)
+                self._ended(session)
+                continue
+            session.state = "streaming"
+            session.started = time.time()
+            self.streams[session.stream_id] = stream
+            self._schedule(stream, time.monotonic())
+            print(f"Streaming track {session.track_id} via UDP to {dest[0]}:{dest[1]}")
+
+    # Answer NACKs and take reception reports arriving on the shared socket
+    def _on_datagram(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue  # e.g. ICMP port unreachable reported on Windows
+            try:
+                flags, stream_id, _, _, payload = unpack_packet(data)
+            except ValueError:
+                continue
+            stream = self.streams.get(stream_id)
+            if not stream or addr[0] != stream.dest[0]:
+                continue
+            try:
+                if stream.window and flags & FLAG_NACK:
+                    stream.window.resend(self.sender, unpack_nack(payload), stream.dest)
+                elif stream.controller and flags & FLAG_REPORT:
+                    stream.controller.update(unpack_report(payload))
+            except struct.error:
+                continue
+            except Exception as e:
+                print(f"Dropped feedback for stream {stream_id}: {e}")
+
+    # Send whatever is due for one session, then put it back on the timer heap
+    def _step(self, stream, now):
+        if stream.linger_until is not None or stream.session.cancelled:
+            self._finish(stream)  # Retransmission window has run out, or the client moved on
+            return
+        try:
+            for _ in range(self.burst):
+                if self.sender.full():
+                    # The socket buffer is backed up; wait for the queue to drain instead of growing it
+                    self._schedule(stream, now + self.tick)
+                    return
+                if stream.pacer.next_deadline() > now + self.tick:
+                    break
+                if stream.seq >= len(stream.prepared.frames):
+                    self._send_end(stream)
+                    return
+                if stream.controller and stream.controller.codec != stream.codec and not stream.group:
+                    stream.set_codec(stream.controller.codec)  # At a group boundary, so each group has one codec
+                self._send_chunk(stream, stream.prepared.frames[stream.seq], now)
+        except Exception as e:
+            print(f"Session {stream.session.stream_id} failed: {e}")
+            stream.session.error = str(e)
+            self._finish(stream)
+            return
+        # When the burst was used up this puts the session back in line behind ones that were due earlier
+        self._schedule(stream, max(stream.pacer.next_deadline(), now))
+
+    def _send_chunk(self, stream, chunk, now):
+        datagram = (pack_header(stream.session.stream_id, stream.seq, stream.offset // stream.frame_size, stream.flags), chunk)
+        self.sender.add(datagram, stream.dest)
+        if stream.window:
+            stream.window.add(stream.seq, datagram)
+        size = min(stream.prepared.chunk_size, stream.track.data_size - stream.offset)  # PCM bytes in this packet
+        late = stream.pacer.advance(size, now)
+        stream.session.packets_sent += 1
+        stream.session.bytes_sent += len(chunk)
+        stream.session.send_lag.observe(late)
+        stream.seq += 1
+        stream.offset += size
+
+        # Follow every fec_group data packets with an XOR parity packet
+        if stream.fec_group:
+            stream.group.append(chunk)
+            if len(stream.group) == stream.fec_group:
+                self._send_parity(stream)
+
+    def _send_parity(self, stream):
+        group, stream.group = stream.group, []
+        if stream.prepared.parity:
+            parity = stream.prepared.parity[(stream.seq - 1) // stream.fec_group]
+        else:
+            parity = build_parity(group)
+        self.sender.add(pack_packet(stream.session.stream_id, stream.seq - len(group), 0, parity, FLAG_PARITY | stream.flags), stream.dest)
+
+    def _send_end(self, stream):
+        if stream.group:
+            self._send_parity(stream)
+        self.sender.add(pack_packet(stream.session.stream_id, stream.seq, stream.offset // stream.frame_size, flags=FLAG_END), stream.dest)
+        if stream.window:
+            # Keep answering NACKs until the last packets are past their playout deadline
+            stream.linger_until = time.monotonic() + self.playout_deadline
+            self._schedule(stream, stream.linger_until)
+        else:
+            self._finish(stream)
+
+    def _finish(self, stream):
+        stream.close(self)
+        self.streams.pop(stream.session.stream_id, None)
+        stream.session.state = "failed" if stream.session.error else "cancelled" if stream.session.cancelled else "finished"
+        self._ended(stream.session)
+        print(f"Finished streaming to {stream.dest[0]}:{stream.dest[1]}.")
+
+    def _ended(self, session):
+        self.table.finish(session)
+        if self.on_finish:
+            self.on_finish(session)
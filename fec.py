@@ -0,0 +1,126 @@
+import struct
+import numpy as np
+
+# XOR forward error correction.
+# After every `group_size` data packets the server sends one parity packet
+# (flagged FLAG_PARITY, sequence number = first sequence number of the group)
+# whose payload is a small prefix followed by the XOR of the group's payloads,
+# zero-padded to the longest one. Any single lost packet of a group can be
+# rebuilt from the parity packet and the packets that did arrive.
+PARITY_PREFIX = struct.Struct("!HH")  # Packets in the group, XOR of their lengths
+MAX_FEC_GROUP = 32                    # Largest group the server will agree to
+
+# XOR a list of byte strings together, padding the shorter ones with zeros
+def xor_payloads(payloads):
+    size = max(len(p) for p in payloads)
+    padded = (size + 7) // 8 * 8  # Round up so rows can be reduced as 64-bit words
+    rows = np.zeros((len(payloads), padded), dtype=np.uint8)
+    for row, payload in zip(rows, payloads):
+        row[:len(payload)] = np.frombuffer(payload, dtype=np.uint8)
+    return np.bitwise_xor.reduce(rows.view(np.uint64), axis=0).view(np.uint8)[:size].tobytes()
+
+# Build the payload of the parity packet protecting a group of data payloads
+def build_parity(payloads):
+    length_xor = 0
+    for p in payloads:
+        length_xor ^= len(p)
+    return PARITY_PREFIX.pack(len(payloads), length_xor) + xor_payloads(payloads)
+
+# Parity payloads for every group of a whole stream at once, as build_parity would
+# make them one group at a time. `data` is cut into `chunk_size` payloads; the full
+# groups are XORed together in one NumPy pass, only the last one goes through build_parity.
+def build_parities(data, chunk_size, group_size):
+    group_bytes = chunk_size * group_size
+    full_groups = len(data) // group_bytes
+    rows = np.frombuffer(data, dtype=np.uint8, count=full_groups * group_bytes)
+    xors = np.bitwise_xor.reduce(rows.reshape(full_groups, group_size, chunk_size), axis=1)
+    prefix = PARITY_PREFIX.pack(group_size, chunk_size if group_size % 2 else 0)
+    parities = [prefix + row.tobytes() for row in xors]
+
+    tail = data[full_groups * group_bytes:]
+    if len(tail):
+        parities.append(build_parity([tail[i:i + chunk_size] for i in range(0, len(tail), chunk_size)]))
+    return parities
+
+# XOR of the data payloads of one group received so far, with their sequence
+# numbers and the XOR of their lengths
+class GroupAccumulator:
+    def __init__(self):
+        self.xor = np.zeros(0, dtype=np.uint8)
+        self.seqs = set()
+        self.length_xor = 0
+
+    def add(self, seq, payload):
+        if seq in self.seqs:
+            return  # Duplicate; XORing it in again would cancel it out
+        view = np.frombuffer(payload, dtype=np.uint8)
+        if len(view) > len(self.xor):
+            grown = np.zeros(len(view), dtype=np.uint8)
+            grown[:len(self.xor)] = self.xor
+            self.xor = grown
+        self.xor[:len(view)] ^= view
+        self.seqs.add(seq)
+        self.length_xor ^= len(view)
+
+# Client-side recovery of lost packets from parity packets.
+# Data payloads are XORed into a per-group accumulator as they arrive instead of
+# being copied and kept, so the caller may pass views of reused receive buffers.
+class FecDecoder:
+    def __init__(self, group_size):
+        self.group_size = group_size
+        self.groups = {}    # group start seq -> GroupAccumulator
+        self.parity = {}    # group start seq -> parity payload
+        self.done = set()   # groups that are complete or already repaired
+        self.recovered = 0
+
+    # Record a data packet; returns [(seq, payload)] of any packet it made recoverable
+    def add_data(self, seq, payload):
+        start = seq - seq % self.group_size
+        if start in self.done:
+            return []
+        group = self.groups.get(start)
+        if group is None:
+            group = self.groups[start] = GroupAccumulator()
+        group.add(seq, payload)
+        if start not in self.parity:
+            return []
+        return self._try_recover(start)
+
+    # Record a parity packet for the group starting at `start`
+    def add_parity(self, start, payload):
+        if start in self.done:
+            return []
+        self.parity[start] = payload
+        return self._try_recover(start)
+
+    # Drop state for groups that end before `seq` (already played out)
+    def forget_before(self, seq):
+        for table in (self.groups, self.parity):
+            for start in [s for s in table if s + self.group_size <= seq]:
+                del table[start]
+        self.done = {s for s in self.done if s + self.group_size > seq}
+
+    def _try_recover(self, start):
+        parity = self.parity.get(start)
+        if parity is None:
+            return []
+        count, length_xor = PARITY_PREFIX.unpack_from(parity)
+        group = self.groups.get(start) or GroupAccumulator()
+        if len(group.seqs) >= count:
+            self._finish(start)  # Nothing missing
+            return []
+        if len(group.seqs) < count - 1:
+            return []  # More than one loss; XOR parity cannot help (yet)
+
+        missing = next(s for s in range(start, start + count) if s not in group.seqs)
+        rebuilt = np.frombuffer(parity, dtype=np.uint8, offset=PARITY_PREFIX.size).copy()
+        size = min(len(rebuilt), len(group.xor))
+        rebuilt[:size] ^= group.xor[:size]
+        self._finish(start)
+        self.recovered += 1
+        return [(missing, rebuilt[:length_xor ^ group.length_xor].tobytes())]
+
+    def _finish(self, start):
+        self.done.add(start)
+        self.groups.pop(start, None)
+        self.parity.pop(start, None)
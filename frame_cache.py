@@ -0,0 +1,284 @@
+import collections
+import contextlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from fec import build_parity, build_parities
+from audio_codecs import CODECS, PCM
+from wav_utils import frame_chunk_size
+from track_maps import TrackMaps
+from packet_store import SidecarFrames
+
+# A track's PCM data cut into packet payloads, ready to be framed and sent.
+#   frames      sequence of payloads, each holding chunk_size bytes of PCM (the last
+#               one may hold less), encoded with the requested codec
+#   parity      FEC parity payload per group of the requested size, or None when
+#               the caller has to build parity itself (uncached tracks, seeks)
+#   chunk_size  PCM bytes per payload: the cache's chunk_size rounded down to whole
+#               sample frames; what streams pace and timestamp by
+PreparedTrack = collections.namedtuple("PreparedTrack", ["frames", "parity", "chunk_size"])
+
+# Payloads of a track read lazily from its memory map, for tracks not held in the cache
+# and for seeks
+class MappedFrames:
+    def __init__(self, data, chunk_size):
+        self.data = data
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return (len(self.data) + self.chunk_size - 1) // self.chunk_size
+
+    def __getitem__(self, index):
+        start = index * self.chunk_size
+        if index < 0 or start >= len(self.data):
+            raise IndexError(index)
+        return self.data[start:start + self.chunk_size]
+
+# Payloads of a track encoded on demand, for encoded streams of tracks that are
+# neither cached nor pre-encoded. Packets are encoded a block at a time; the
+# codecs vectorise across a block, so a block costs about as much as one packet.
+class EncodedFrames:
+    def __init__(self, pcm_frames, codec, info, block=64):
+        self.pcm_frames = pcm_frames  # MappedFrames of the PCM
+        self.codec = codec
+        self.info = info
+        self.block = block
+        self.block_start = None
+        self.encoded = []
+
+    def __len__(self):
+        return len(self.pcm_frames)
+
+    def __getitem__(self, index):
+        if index < 0 or index >= len(self):
+            raise IndexError(index)
+        start = index - index % self.block
+        if start != self.block_start:
+            end = min(start + self.block, len(self))
+            self.encoded = self.codec.encode([self.pcm_frames[i] for i in range(start, end)], self.info)
+            self.block_start = start
+        return self.encoded[index - start]
+
+# In-memory cache of prepared tracks with a byte budget and LRU eviction.
+# A hit hands out frames (and FEC parity for the requested group size) that are
+# already cut, encoded and computed, so streaming a hot track touches no file,
+# runs no encoder and builds no parity. Each codec of a track is a separate entry.
+# acquire() never prepares anything itself, since it runs on the event loop of
+# the streaming engine: a miss streams straight from the track's memory map (or
+# its sidecar, or encodes a block of packets at a time) while a background worker
+# prepares the entry for later streams, and a hit without parity for the
+# requested group size builds parity as it goes while the worker computes it.
+# Only tracks asked for admit_after times (among the last max_tracked tracks asked
+# for) are prepared, so a one-off scan of the library does not churn the cache;
+# the least recently used ones are evicted once the budget is exceeded. Tracks
+# larger than the whole budget are never cached.
+# With a PacketStore, encoded tracks are loaded from the sidecars prepack.py wrote
+# instead of being encoded (and stream from the sidecar's memory map while they
+# are not cached).
+# Streams keep the frames they started with, so an evicted track stays in
+# memory until its last stream ends.
+class FrameCache:
+    def __init__(self, budget_bytes, chunk_size, maps=None, packets=None, admit_after=2, max_tracked=4096, workers=1):
+        self.budget_bytes = budget_bytes
+        self.chunk_size = chunk_size
+        self.maps = maps or TrackMaps()
+        self.packets = packets  # packet_store.PacketStore, or None to always encode on the fly
+        self.admit_after = admit_after
+        self.max_tracked = max_tracked
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # (path, size, mtime_ns, codec) -> [PCM bytes or None, frames, {group size: parity}, size]
+        self.bytes = 0
+        self.requests = collections.OrderedDict()  # Key -> times asked for while not cached, most recent last
+        self.preparing = set()                     # Keys, and (key, group size) for parity, being prepared
+        self.workers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="frame-cache")  # Threads start on first use
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # PreparedTrack for streaming `track` with FEC groups of fec_group packets (0 for none),
+    # encoded with the named codec (see audio_codecs), from byte `start` of its PCM data
+    # (0, or a position from wav_utils.seek_position; a payload boundary unless "pcm").
+    # Returns at once, without reading or encoding the track. Pair every call with
+    # release(track, prepared).
+    def acquire(self, track, fec_group=0, start=0, codec="pcm"):
+        chunk_size = frame_chunk_size(track, self.chunk_size)
+        if start and codec == PCM.name:
+            return self._acquire_range(track, start, chunk_size)
+        if start:
+            fec_group = 0  # Cached groups do not line up with a seeked stream's
+        key = (track.path, track.size, track.mtime_ns, codec)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                if fec_group and fec_group not in entry[2] and (key, fec_group) not in self.preparing:
+                    self.preparing.add((key, fec_group))
+                    self.workers.submit(self._add_parity, key, entry, chunk_size, fec_group)
+                return self._prepared(entry, fec_group, start, chunk_size)
+            self.misses += 1
+            count = self.requests.pop(key, 0) + 1
+            self.requests[key] = count
+            if len(self.requests) > self.max_tracked:
+                self.requests.popitem(last=False)
+            if count >= self.admit_after and key not in self.preparing:
+                self.preparing.add(key)
+                self.workers.submit(self._add_entry, key, track, chunk_size, codec, fec_group)
+
+        if codec != PCM.name and self.packets:
+            sidecar = self.packets.acquire(track, codec, chunk_size)
+            if sidecar is not None:
+                return PreparedTrack(sidecar.frames(start // chunk_size), None, chunk_size)  # Sidecar released in release()
+        prepared = self._acquire_range(track, start, chunk_size)
+        if codec != PCM.name:
+            prepared = PreparedTrack(EncodedFrames(prepared.frames, CODECS[codec], track), None, chunk_size)
+        return prepared
+
+    # Background job: prepare the entry for `key` (with parity for fec_group) and add it
+    def _add_entry(self, key, track, chunk_size, codec, fec_group):
+        try:
+            entry = None
+            if codec != PCM.name and self.packets:
+                sidecar = self.packets.acquire(track, codec, chunk_size)
+                if sidecar is not None:
+                    try:
+                        if sidecar.nbytes <= self.budget_bytes:
+                            entry = [None, [bytes(frame) for frame in sidecar.frames()], {}, sidecar.nbytes]
+                        else:
+                            return  # Streams from the sidecar's memory map instead
+                    finally:
+                        self.packets.release(sidecar)
+            if entry is None:  # Not pre-encoded: read (and encode) the WAV
+                if codec == PCM.name and track.data_size > self.budget_bytes:
+                    return  # Streams from its memory map instead
+                with self.maps.open(track) as data:
+                    entry = self._prepare(track, data[track.data_offset:track.data_offset + track.data_size],
+                                          chunk_size, CODECS[codec])
+            if fec_group:
+                entry[2][fec_group] = parity = self._parity(entry, chunk_size, fec_group)
+                entry[3] += sum(len(p) for p in parity)
+            with self.lock:
+                self.requests.pop(key, None)
+                if entry[3] <= self.budget_bytes:
+                    self.entries[key] = entry
+                    self.bytes += entry[3]
+                    self._evict()
+        except Exception as e:
+            print(f"Could not prepare {track.path}: {e}")  # Debugging line
+        finally:
+            with self.lock:
+                self.preparing.discard(key)
+
+    # Background job: add parity for another group size to a cached entry
+    def _add_parity(self, key, entry, chunk_size, fec_group):
+        try:
+            parity = self._parity(entry, chunk_size, fec_group)
+            with self.lock:
+                entry[2][fec_group] = parity
+                added = sum(len(p) for p in parity)
+                entry[3] += added
+                if self.entries.get(key) is entry:
+                    self.bytes += added
+                    self._evict()
+        except Exception as e:
+            print(f"Could not build parity for {key[0]}: {e}")  # Debugging line
+        finally:
+            with self.lock:
+                self.preparing.discard((key, fec_group))
+
+    # New cache entry: the PCM cut into payloads, encoded unless the codec is plain PCM
+    def _prepare(self, track, pcm, chunk_size, codec):
+        blob = bytes(pcm)  # The only read of the file while it stays cached
+        view = memoryview(blob)
+        frames = [view[i:i + chunk_size] for i in range(0, len(blob), chunk_size)]
+        if codec is not PCM:
+            frames = codec.encode(frames, track)
+            blob = None  # Only the encoded payloads are kept
+        return [blob, frames, {}, sum(len(frame) for frame in frames)]
+
+    # Parity of every group of an entry; plain PCM in one NumPy pass, encoded payloads
+    # (which differ in size) one group at a time
+    def _parity(self, entry, chunk_size, fec_group):
+        if entry[0] is not None:
+            return build_parities(entry[0], chunk_size, fec_group)
+        frames = entry[1]
+        return [build_parity(frames[i:i + fec_group]) for i in range(0, len(frames), fec_group)]
+
+    def _prepared(self, entry, fec_group, start, chunk_size):
+        frames = entry[1][start // chunk_size:] if start else entry[1]
+        return PreparedTrack(frames, entry[2].get(fec_group), chunk_size)
+
+    # Uncached and seeked streams read straight from the file's memory map; their parity is built as they go
+    def _acquire_range(self, track, start, chunk_size):
+        data = self.maps.acquire(track)
+        return PreparedTrack(MappedFrames(data[track.data_offset + start:track.data_offset + track.data_size], chunk_size), None, chunk_size)
+
+    def release(self, track, prepared):
+        if isinstance(prepared.frames, (MappedFrames, EncodedFrames)):
+            self.maps.release(track)
+        elif isinstance(prepared.frames, SidecarFrames):
+            self.packets.release(prepared.frames.sidecar)
+
+    # TrackVariants of `track` for a stream that may switch codecs (see abr.py)
+    def variants(self, track, fec_group=0, start=0):
+        return TrackVariants(self, track, fec_group, start)
+
+    # `with cache.open(track, fec_group) as prepared:` for streams that live within one call
+    @contextlib.contextmanager
+    def open(self, track, fec_group=0, start=0, codec="pcm"):
+        prepared = self.acquire(track, fec_group, start, codec)
+        try:
+            yield prepared
+        finally:
+            self.release(track, prepared)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "tracks": len(self.entries),
+                "bytes": self.bytes,
+                "budget_bytes": self.budget_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "preparing": len(self.preparing),
+            }
+
+    # Drop least recently used tracks until the cache fits its budget (lock held)
+    def _evict(self):
+        while self.bytes > self.budget_bytes and self.entries:
+            _, entry = self.entries.popitem(last=False)
+            self.bytes -= entry[3]
+            self.evictions += 1
+
+# The PreparedTrack of one stream in each codec it uses, acquired on first use.
+# Every codec cuts the track into the same packets, so a stream can move to
+# another codec at any sequence number. Usable as a context manager; close()
+# releases them all.
+class TrackVariants:
+    def __init__(self, cache, track, fec_group, start):
+        self.cache = cache
+        self.track = track
+        self.fec_group = fec_group
+        self.start = start
+        self.prepared = {}  # codec name -> PreparedTrack
+
+    def get(self, codec):
+        prepared = self.prepared.get(codec)
+        if prepared is None:
+            prepared = self.prepared[codec] = self.cache.acquire(self.track, self.fec_group, self.start, codec)
+        return prepared
+
+    def close(self):
+        for prepared in self.prepared.values():
+            self.cache.release(self.track, prepared)
+        self.prepared.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
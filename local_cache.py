@@ -0,0 +1,174 @@
+import hashlib
+import os
+import threading
+import wave
+
+# Local copies of streamed tracks, so replaying a track plays it from disk.
+# Each copy is a WAV file named after the track's stable id and the SHA-1 of its
+# PCM data as listed by the server (see track_index.content_hash). A track
+# changed on the server gets a new hash and is streamed again; the old copy is
+# removed once the new one is stored.
+# A stream is only kept if the PCM received hashes to the advertised value, so
+# copies with lost (concealed) packets or a truncated end are never cached. Cached
+# copies are checked again while they play and deleted if they no longer match.
+# The folder is kept under max_bytes by deleting the least recently played copies.
+class LocalTrackCache:
+    def __init__(self, folder="cache", max_bytes=2 * 1024 * 1024 * 1024):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, track_id, content_hash):
+        return os.path.join(self.folder, f"{track_id}-{content_hash}.wav")
+
+    # Path of the cached copy of a track, or None on a miss
+    def lookup(self, track_id, content_hash):
+        if not content_hash:
+            return None  # Server too old to advertise hashes
+        path = self.path(track_id, content_hash)
+        try:
+            os.utime(path)  # Mark as recently played for eviction
+        except OSError:
+            return None
+        return path
+
+    # CacheWriter for a stream of the track that is about to be received
+    def writer(self, track_id, content_hash, channels, sample_width, frame_rate):
+        if not content_hash:
+            return None
+        return CacheWriter(self, track_id, content_hash, channels, sample_width, frame_rate)
+
+    # Play the cached copy of a track through a StreamPlayer from start_ms on, until
+    # the end or until `stop` is set. A copy played from the start has its hash
+    # checked on the way; returns False (and deletes it) if it turned out to be corrupt.
+    # A copy that cannot be read or ends early (damaged on disk, removed meanwhile)
+    # is deleted and raises DamagedCopy with the position reached, to stream the rest.
+    def play(self, track_id, content_hash, player, start_ms=0, stop=None, block_frames=4096):
+        path = self.path(track_id, content_hash)
+        digest = hashlib.sha1() if not start_ms else None
+        try:
+            wav_file = wave.open(path, "rb")
+        except (wave.Error, EOFError, OSError) as e:
+            raise self._damaged(track_id, path, e, start_ms)
+        with wav_file:
+            frame_rate = wav_file.getframerate()
+            frame_size = wav_file.getnchannels() * wav_file.getsampwidth()
+            if not player.started:
+                player.start(wav_file.getnchannels(), wav_file.getsampwidth(), frame_rate)
+            position = 0
+            if start_ms:
+                position = min(wav_file.getnframes(), start_ms * frame_rate // 1000)
+                wav_file.setpos(position)
+            while not player.stopped:
+                if stop and stop.is_set():
+                    return True
+                try:
+                    pcm = wav_file.readframes(block_frames)
+                    pcm = pcm[:len(pcm) // frame_size * frame_size]  # A truncated file may end mid-frame
+                except (wave.Error, EOFError, OSError) as e:
+                    raise self._damaged(track_id, path, e, position * 1000 // frame_rate)
+                if not pcm:
+                    if position < wav_file.getnframes():
+                        raise self._damaged(track_id, path, "data ends early", position * 1000 // frame_rate)
+                    break
+                position += len(pcm) // frame_size
+                if digest:
+                    digest.update(pcm)
+                player.write(pcm)
+        player.finish()
+
+        if digest and not player.stopped and digest.hexdigest() != content_hash:
+            print(f"Cached copy of track {track_id} is corrupt, removing it")  # Debugging line
+            self._remove(path)
+            return False
+        return True
+
+    # Delete an unreadable copy; returns the DamagedCopy to raise
+    def _damaged(self, track_id, path, error, position_ms):
+        print(f"Cached copy of track {track_id} is damaged ({error}), removing it")  # Debugging line
+        self._remove(path)
+        return DamagedCopy(track_id, position_ms)
+
+    # Store a completely received copy and make room for it
+    def _commit(self, track_id, part_path, path):
+        with self.lock:
+            os.replace(part_path, path)
+            prefix = f"{track_id}-"
+            for name in os.listdir(self.folder):
+                other = os.path.join(self.folder, name)
+                if name.startswith(prefix) and name.endswith(".wav") and other != path:
+                    self._remove(other)  # Copy of an older version of the track
+            self._evict(keep=path)
+
+    # Delete least recently played copies until the folder fits max_bytes (lock held)
+    def _evict(self, keep):
+        copies = []
+        total = 0
+        for name in os.listdir(self.folder):
+            if not name.endswith(".wav"):
+                continue
+            path = os.path.join(self.folder, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            copies.append((st.st_mtime_ns, st.st_size, path))
+            total += st.st_size
+
+        copies.sort()
+        for _, size, path in copies:
+            if total <= self.max_bytes:
+                break
+            if path != keep:
+                self._remove(path)
+                total -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+# Raised by LocalTrackCache.play for a copy it could not read to the end; the
+# copy is gone and the track should be streamed from position_ms
+class DamagedCopy(Exception):
+    def __init__(self, track_id, position_ms):
+        super().__init__(f"cached copy of track {track_id} is damaged")
+        self.track_id = track_id
+        self.position_ms = position_ms
+
+# Writes a stream's PCM to a temporary file while it plays, hashing it as it goes.
+# close() keeps the file if it matches the advertised hash and discards it otherwise;
+# discard() drops a stream that was cut short.
+class CacheWriter:
+    def __init__(self, cache, track_id, content_hash, channels, sample_width, frame_rate):
+        self.cache = cache
+        self.track_id = track_id
+        self.content_hash = content_hash
+        self.path = cache.path(track_id, content_hash)
+        self.part_path = f"{self.path}.part"
+        self.digest = hashlib.sha1()
+        self.wav_file = wave.open(self.part_path, "wb")
+        self.wav_file.setnchannels(channels)
+        self.wav_file.setsampwidth(sample_width)
+        self.wav_file.setframerate(frame_rate)
+
+    def write(self, pcm):
+        self.digest.update(pcm)
+        self.wav_file.writeframes(pcm)
+
+    # Finish the copy; True if it was verified and stored
+    def close(self):
+        self.wav_file.close()
+        if self.digest.hexdigest() != self.content_hash:
+            print(f"Track {self.track_id} arrived incomplete or damaged, not caching it")  # Debugging line
+            self.cache._remove(self.part_path)
+            return False
+        self.cache._commit(self.track_id, self.part_path, self.path)
+        print(f"Track {self.track_id} cached at {self.path}")  # Debugging line
+        return True
+
+    def discard(self):
+        self.wav_file.close()
+        self.cache._remove(self.part_path)
@@ -0,0 +1,138 @@
+import bisect
+
+# Streaming metrics in the Prometheus text format (GET /metrics).
+# The send loops only bump plain attributes of their own Session (each session
+# has a single writer), so the hot path takes no lock. Totals are folded in
+# when a session ends (SessionTable.finish) and live sessions are added on top
+# at scrape time, which may see a packet or two in flight; that is fine for
+# monitoring.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# How far behind real time packets leave, in seconds (see Pacer.wait)
+SEND_LAG_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+# Cumulative histogram with fixed bucket upper bounds; one writer at a time
+class Histogram:
+    def __init__(self, buckets=SEND_LAG_BUCKETS, counts=None, total=0.0):
+        self.buckets = buckets
+        self.counts = list(counts) if counts else [0] * (len(buckets) + 1)  # Last slot is +Inf
+        self.sum = total
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+
+    def copy(self):
+        return Histogram(self.buckets, self.counts, self.sum)
+
+# Builds one scrape body, metric family by metric family
+class PrometheusText:
+    def __init__(self, prefix="audio_"):
+        self.prefix = prefix
+        self.lines = []
+
+    # samples: [(labels dict, value)], or a bare value for an unlabelled metric
+    def add(self, name, kind, help_text, samples):
+        name = self.prefix + name
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} {kind}")
+        if not isinstance(samples, list):
+            samples = [({}, samples)]
+        for labels, value in samples:
+            self.lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+
+    def add_histogram(self, name, help_text, histogram):
+        name = self.prefix + name
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            self.lines.append(f'{name}_bucket{{le="{format_value(bound)}"}} {cumulative}')
+        cumulative += histogram.counts[-1]
+        self.lines.append(f'{name}_bucket{{le="+Inf"}} {cumulative}')
+        self.lines.append(f"{name}_sum {format_value(histogram.sum)}")
+        self.lines.append(f"{name}_count {cumulative}")
+
+    def render(self):
+        return "\n".join(self.lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels.items()) + "}"
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+# Scrape body for a server: its session table (see SessionTable.metrics) and,
+# when it has one in this process, its frame cache; `qos` adds what clients
+# reported about their playback (see qos.QosStats) and `channels` the shared
+# broadcasts (see channels.ChannelManager)
+def render_metrics(table, frame_cache=None, qos=None, channels=None):
+    stats = table.metrics()
+    text = PrometheusText()
+    text.add("packets_sent_total", "counter", "Data packets sent to stream clients", stats["packets_sent"])
+    text.add("bytes_sent_total", "counter", "Payload bytes sent to stream clients", stats["bytes_sent"])
+    text.add_histogram("send_lag_seconds", "How far behind real time data packets left",
+                       stats["send_lag"])
+    text.add("sessions", "gauge", "Stream sessions by state",
+             [({"state": state}, count) for state, count in sorted(stats["live"].items())])
+    text.add("sessions_ended_total", "counter", "Stream sessions that ended, by final state",
+             [({"state": state}, count) for state, count in sorted(stats["ended"].items())])
+    text.add("sessions_rejected_total", "counter", "Stream requests refused at capacity", stats["rejected"])
+    text.add("codec_switches_total", "counter", "Adaptive bitrate codec switches", stats["codec_switches"])
+    text.add("track_streams_total", "counter", "Streams started per track, for the most streamed tracks",
+             [({"track_id": track_id}, count) for track_id, count in sorted(stats["track_streams"].items())])
+    if channels is not None:
+        broadcast = channels.metrics()
+        text.add("channels", "gauge", "Shared channels broadcasting", broadcast["live"])
+        text.add("channels_started_total", "counter", "Shared channels started", broadcast["started"])
+        text.add("channel_joins_total", "counter", "Listeners that joined a shared channel", broadcast["joins"])
+        text.add("channel_leaves_total", "counter", "Fan-out listeners that left a shared channel", broadcast["leaves"])
+        text.add("channel_expired_total", "counter", "Fan-out listeners dropped after their reports stopped",
+                 broadcast["expired"])
+        text.add("channel_packets_sent_total", "counter", "Data packets broadcast on shared channels",
+                 broadcast["packets_sent"])
+        text.add("channel_datagrams_sent_total", "counter",
+                 "Datagrams sent by shared channels, one per subscriber when fanning out", broadcast["datagrams_sent"])
+        text.add("channel_bytes_sent_total", "counter", "Bytes sent by shared channels", broadcast["bytes_sent"])
+    if frame_cache is not None:
+        cache = frame_cache.stats()
+        text.add("frame_cache_hits_total", "counter", "Frame cache lookups served from memory", cache["hits"])
+        text.add("frame_cache_misses_total", "counter", "Frame cache lookups that prepared the track", cache["misses"])
+        text.add("frame_cache_hit_ratio", "gauge", "Share of frame cache lookups that hit", cache["hit_rate"])
+        text.add("frame_cache_bytes", "gauge", "Memory held by the frame cache", cache["bytes"])
+        text.add("frame_cache_evictions_total", "counter", "Tracks evicted from the frame cache", cache["evictions"])
+    if qos is not None:
+        client = qos.snapshot()
+        text.add("client_reports_total", "counter", "Playback QoS reports received from clients", client["reports"])
+        text.add("client_incomplete_streams_total", "counter", "Reported streams stopped before their end",
+                 client["incomplete"])
+        text.add_histogram("client_first_packet_seconds", "Time from the stream request to the first packet",
+                           client["first_packet"])
+        text.add_histogram("client_first_audio_seconds", "Time from the stream request to the first audio played",
+                           client["first_audio"])
+        text.add("client_underruns_total", "counter", "Player underruns reported by clients", client["underruns"])
+        text.add("client_stall_seconds_total", "counter", "Time clients spent rebuffering after an underrun",
+                 client["stall_seconds"])
+        text.add("client_packets_received_total", "counter", "Data packets clients received", client["packets_received"])
+        text.add("client_packets_lost_total", "counter", "Data packets clients concealed after FEC and NACKs",
+                 client["packets_lost"])
+        text.add("client_fec_recovered_total", "counter", "Data packets clients rebuilt from parity",
+                 client["fec_recovered"])
+        text.add("client_retransmits_total", "counter", "Retransmitted packets clients received", client["retransmits"])
+        text.add_histogram("client_reorder_depth_packets", "Deepest reordering seen per stream, in packets",
+                           client["reorder_depth"])
+    return text.render()
@@ -0,0 +1,43 @@
+import time
+
+# Paces a stream at a fixed byte rate using monotonic-clock deadlines.
+# Each chunk is due at start + bytes_already_sent / byte_rate, minus a lead
+# window so the client can fill its buffer slightly ahead of real time.
+# Deadlines are absolute, so sleep jitter never accumulates into drift.
+class Pacer:
+    def __init__(self, byte_rate, lead_seconds=0.5, max_lag_seconds=1.0):
+        self.byte_rate = float(byte_rate)
+        self.lead_seconds = lead_seconds
+        self.max_lag_seconds = max_lag_seconds  # How far behind (beyond the lead window) we may fall before re-anchoring
+        self.start = time.monotonic()
+        self.bytes_sent = 0
+
+    # Monotonic time at which the next chunk is due on the wire
+    def next_deadline(self):
+        return self.start + self.bytes_sent / self.byte_rate - self.lead_seconds
+
+    # Block until the next chunk is due, then account for its size.
+    # Returns how many seconds behind real time the chunk goes out (0 when on time or ahead).
+    def wait(self, nbytes):
+        deadline = self.next_deadline()
+        now = time.monotonic()
+        if deadline > now:
+            time.sleep(deadline - now)
+            now = time.monotonic()
+        return self.advance(nbytes, now)
+
+    # Account for a chunk sent at `now` without sleeping; for event loops that
+    # schedule on next_deadline() themselves. Returns the lag like wait().
+    def advance(self, nbytes, now=None):
+        if now is None:
+            now = time.monotonic()
+        late = now - self.next_deadline()
+        if late > self.lead_seconds + self.max_lag_seconds:
+            # We stalled (GC, disk, overloaded box); re-anchor so at most one lead window is burst to catch up
+            self.start += late - self.lead_seconds
+        self.bytes_sent += nbytes
+        return max(0.0, late - self.lead_seconds)
+
+    # How many seconds the sender is behind real time (0 when on time or ahead)
+    def lag(self):
+        return max(0.0, time.monotonic() - self.next_deadline() - self.lead_seconds)
@@ -0,0 +1,123 @@
+import collections
+import os
+import struct
+import numpy as np
+from track_maps import TrackMaps
+
+# Sidecar files of pre-encoded packet payloads, written offline by prepack.py so
+# that streaming an encoded track (see audio_codecs) runs no encoder.
+# One file per track, codec and packet size, named after the track's content hash
+# (see track_index.content_hash): a changed track simply has no sidecar until the
+# next prepack run, and streams fall back to encoding it on the fly.
+#
+# Layout, all little-endian:
+#   header      magic, PCM bytes per packet (chunk_size), packet count
+#   seek index  count + 1 file offsets; payload i spans index[i]:index[i + 1]
+#   payloads    the encoded packets, back to back
+# Packet i holds PCM bytes i * chunk_size onwards, so a seek to a PCM byte offset
+# starts at payload offset // chunk_size.
+SIDECAR_MAGIC = b"PKT1"
+SIDECAR_HEADER = struct.Struct("<4sII")
+SIDECAR_OFFSET = struct.Struct("<I")
+
+# Identity of a sidecar file for TrackMaps, which maps anything with these fields
+SidecarFile = collections.namedtuple("SidecarFile", ["path", "size", "mtime_ns"])
+
+# Write payloads to a sidecar at `path`, replacing it atomically
+def write_sidecar(path, payloads, chunk_size):
+    index_size = SIDECAR_OFFSET.size * (len(payloads) + 1)
+    offsets = [SIDECAR_HEADER.size + index_size]
+    for payload in payloads:
+        offsets.append(offsets[-1] + len(payload))
+    part_path = f"{path}.part"
+    with open(part_path, "wb") as f:
+        f.write(SIDECAR_HEADER.pack(SIDECAR_MAGIC, chunk_size, len(payloads)))
+        f.write(np.array(offsets, dtype="<u4").tobytes())
+        for payload in payloads:
+            f.write(payload)
+    os.replace(part_path, path)  # Never truncate a sidecar in place; servers may have it mapped
+
+# A mapped sidecar: its payloads as memoryview slices of the mapping
+class Sidecar:
+    def __init__(self, file, data):
+        magic, self.chunk_size, count = SIDECAR_HEADER.unpack_from(data)
+        if magic != SIDECAR_MAGIC:
+            raise ValueError("not a packet sidecar")
+        self.file = file
+        self.data = data
+        self.offsets = np.frombuffer(data, dtype="<u4", count=count + 1, offset=SIDECAR_HEADER.size).tolist()
+        if self.offsets[-1] != len(data):
+            raise ValueError("truncated packet sidecar")
+        self.nbytes = self.offsets[-1] - self.offsets[0]  # Payload bytes
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    # Payloads from packet `first` on
+    def frames(self, first=0):
+        return SidecarFrames(self, first)
+
+# Lazy sequence of a sidecar's payloads, for tracks streamed straight from the mapping
+class SidecarFrames:
+    def __init__(self, sidecar, first=0):
+        self.sidecar = sidecar
+        self.first = first
+
+    def __len__(self):
+        return max(0, len(self.sidecar) - self.first)
+
+    def __getitem__(self, index):
+        if index < 0 or index >= len(self):
+            raise IndexError(index)
+        offsets = self.sidecar.offsets
+        index += self.first
+        return self.sidecar.data[offsets[index]:offsets[index + 1]]
+
+# The sidecar folder. Sidecars are memory-mapped through TrackMaps, so streams of
+# the same sidecar share one mapping and its pages come from the page cache.
+class PacketStore:
+    def __init__(self, folder, maps=None):
+        self.folder = folder
+        self.maps = maps or TrackMaps()
+
+    def path(self, track, codec, chunk_size):
+        return os.path.join(self.folder, f"{track.content_hash}.{codec}.{chunk_size}.pkt")
+
+    # Mapped Sidecar of `track` for the codec and packet size, or None when there is
+    # none; pair every non-None result with release(sidecar)
+    def acquire(self, track, codec, chunk_size):
+        path = self.path(track, codec, chunk_size)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        file = SidecarFile(path, st.st_size, st.st_mtime_ns)
+        data = self.maps.acquire(file)
+        try:
+            sidecar = Sidecar(file, data)
+            if len(sidecar) != -(-track.data_size // chunk_size):
+                raise ValueError("packet count does not match the track")
+            return sidecar
+        except (ValueError, struct.error) as e:
+            self.maps.release(file)
+            print(f"Ignoring sidecar {path}: {e}")  # Debugging line
+            return None
+
+    def release(self, sidecar):
+        self.maps.release(sidecar.file)
+
+    # Delete sidecars of audio that is no longer in the library, i.e. whose content
+    # hash is not in `hashes`, whatever their codec and packet size, and leftover
+    # partial writes; returns how many were deleted
+    def prune(self, hashes):
+        removed = 0
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            stale = name.endswith(".pkt") and name.split(".", 1)[0] not in hashes
+            if stale or name.endswith(".pkt.part"):
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+        return removed
@@ -0,0 +1,205 @@
+import threading
+import time
+import numpy as np
+import pygame
+
+# Streaming playback engine.
+# Received PCM is written into a bounded jitter buffer; a feeder thread cuts it
+# into fixed-size blocks and queues them on a pygame mixer channel, so playback
+# starts after a short prebuffer instead of after the whole download and memory
+# use does not grow with the length of the track.
+class StreamPlayer:
+    def __init__(self, prebuffer_ms=200, block_ms=40, max_prebuffer_ms=1000, capacity_ms=3000):
+        self.prebuffer_ms = prebuffer_ms          # Audio to buffer before playback starts
+        self.block_ms = block_ms                  # Size of each block handed to the mixer
+        self.max_prebuffer_ms = max_prebuffer_ms  # Ceiling for the adaptive prebuffer
+        self.capacity_ms = capacity_ms            # Writers block once this much audio is buffered (unless paused)
+
+        self.buffer = bytearray()
+        self.cond = threading.Condition()
+        self.started = False
+        self.finished = False   # No more data will be written
+        self.stopped = False    # Playback was cancelled
+        self.paused = False
+        self.thread = None
+        self.generation = 0     # Bumped by flush(), so blocks taken before it are dropped
+        self.draining = False   # Feeder is only playing out the last queued blocks
+        self.written = 0        # Bytes of PCM taken by write() since start or flush
+
+        # Statistics
+        self.underruns = 0
+        self.blocks_played = 0
+        self.stall_seconds = 0.0   # Time spent rebuffering after underruns
+        self.first_audio_at = None # time.monotonic() of the first block handed to the mixer since start or flush
+
+    # Configure the audio output for the stream's format and start the feeder thread
+    def start(self, channels, sample_width, frame_rate):
+        self.sample_width = sample_width
+        self.frame_size = channels * sample_width
+        self.bytes_per_ms = frame_rate * self.frame_size / 1000.0
+        self.block_bytes = self._align(self.block_ms * self.bytes_per_ms)
+        self.target_ms = self.prebuffer_ms
+
+        # pygame plays 8-bit as unsigned and everything wider is converted to signed 16-bit
+        pygame.mixer.quit()
+        pygame.mixer.init(frequency=frame_rate, size=8 if sample_width == 1 else -16, channels=channels, buffer=1024)
+        self.channel = pygame.mixer.Channel(0)
+
+        self.started = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    # Add received PCM to the jitter buffer; blocks while the buffer is full.
+    # While paused a full buffer drops the PCM instead (returning False), so a
+    # writer never hangs on a pause; written_ms() tells where the taken audio ends.
+    def write(self, pcm):
+        with self.cond:
+            capacity = self.capacity_ms * self.bytes_per_ms
+            while len(self.buffer) >= capacity and not self.stopped:
+                if self.paused:
+                    return False
+                self.cond.wait(0.1)
+            if self.stopped:
+                return False
+            self.buffer += pcm
+            self.written += len(pcm)
+            self.cond.notify_all()
+            return True
+
+    # Signal that the stream is complete; buffered audio still plays out
+    def finish(self):
+        with self.cond:
+            self.finished = True
+            self.cond.notify_all()
+
+    # Drop buffered and queued audio, e.g. on seek, keeping the output configured.
+    # Playback carries on with whatever is written next, after a fresh prebuffer, so
+    # the new position is heard within one prebuffer interval of its data arriving.
+    def flush(self):
+        with self.cond:
+            self.buffer.clear()
+            self.finished = False
+            self.target_ms = self.prebuffer_ms
+            self.first_audio_at = None
+            self.written = 0
+            self.generation += 1
+            restart = self.draining
+            self.draining = False
+            self.cond.notify_all()
+        if self.started:
+            self.channel.stop()
+            if restart:
+                # The feeder was ending with the previous stream; start a new one
+                self.thread.join()
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    # Stop playback immediately and drop buffered audio
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.buffer.clear()
+            self.cond.notify_all()
+        if self.started:
+            self.channel.stop()
+
+    def pause(self):
+        with self.cond:
+            self.paused = True
+            self.cond.notify_all()  # Release a writer waiting for room
+        if self.started:
+            self.channel.pause()
+
+    def resume(self):
+        self.paused = False
+        if self.started:
+            self.channel.unpause()
+
+    # Block until playback has finished or was stopped
+    def wait(self):
+        if self.thread:
+            self.thread.join()
+
+    # Milliseconds of audio taken by write() since start or flush
+    def written_ms(self):
+        return self.written / self.bytes_per_ms if self.started else 0.0
+
+    # Milliseconds of audio currently buffered
+    def buffered_ms(self):
+        return len(self.buffer) / self.bytes_per_ms if self.started else 0.0
+
+    # Feeder thread: move blocks from the jitter buffer to the mixer channel
+    def _run(self):
+        rebuffering = True
+        stable_blocks = 0
+        stalled_at = None  # When the current underrun began
+        generation = self.generation
+        while True:
+            with self.cond:
+                if self.generation != generation:
+                    generation = self.generation
+                    rebuffering = True  # Flushed: prebuffer the new position
+                    stable_blocks = 0
+                    stalled_at = None
+
+                # (Re)fill the jitter buffer to the current target before playing on
+                if rebuffering:
+                    target_bytes = self.target_ms * self.bytes_per_ms
+                    while len(self.buffer) < target_bytes and not self.finished and not self.stopped:
+                        self.cond.wait(0.05)
+                    rebuffering = False
+                    if stalled_at is not None:
+                        self.stall_seconds += time.monotonic() - stalled_at
+                        stalled_at = None
+
+                if self.stopped or (self.finished and not self.buffer):
+                    self.draining = True
+                    break
+
+                if len(self.buffer) < self.block_bytes and not self.finished:
+                    # Ran dry: count the underrun and buffer more before the next attempt
+                    self.underruns += 1
+                    self.target_ms = min(self.max_prebuffer_ms, self.target_ms * 1.5)
+                    stable_blocks = 0
+                    rebuffering = True
+                    stalled_at = time.monotonic()
+                    print(f"Playback underrun, rebuffering {self.target_ms:.0f} ms")  # Debugging line
+                    continue
+
+                block = bytes(self.buffer[:self.block_bytes])
+                del self.buffer[:self.block_bytes]
+                self.cond.notify_all()  # Wake a writer waiting for room
+
+            # Slowly shrink the prebuffer again after a long run without underruns
+            stable_blocks += 1
+            if stable_blocks * self.block_ms >= 10000 and self.target_ms > self.prebuffer_ms:
+                self.target_ms = max(self.prebuffer_ms, self.target_ms * 0.8)
+                stable_blocks = 0
+
+            sound = pygame.mixer.Sound(buffer=self._to_mixer(block))
+            while self.channel.get_queue() is not None and not self.stopped:
+                time.sleep(self.block_ms / 4000.0)  # Wait for a free slot in the channel queue
+            if self.stopped:
+                break
+            if self.generation != generation:
+                continue  # Flushed while waiting; this block is from before the seek
+            self.channel.queue(sound)
+            self.blocks_played += 1
+            if self.first_audio_at is None:
+                self.first_audio_at = time.monotonic()
+
+        # Let the last queued blocks play out
+        while not self.stopped and self.channel.get_busy():
+            time.sleep(self.block_ms / 1000.0)
+
+    # Round a byte count down to a whole number of frames (at least one)
+    def _align(self, nbytes):
+        return max(self.frame_size, int(nbytes) // self.frame_size * self.frame_size)
+
+    # Convert a block of PCM to the sample format the mixer was opened with
+    def _to_mixer(self, block):
+        if self.sample_width in (1, 2):
+            return block
+        # Keep the two most significant bytes of each little-endian 24/32-bit sample
+        samples = np.frombuffer(block, dtype=np.uint8).reshape(-1, self.sample_width)
+        return samples[:, -2:].tobytes()
@@ -0,0 +1,90 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from audio_codecs import CODECS, PCM
+from track_index import update_index
+from packet_store import PacketStore, write_sidecar
+from wav_utils import frame_chunk_size
+
+# Pre-encode every track of the music folder into packet sidecars (see
+# packet_store.py), one per encoded codec, so servers send encoded streams
+# without running an encoder on the request path. Tracks are encoded in worker
+# processes. Runs are incremental: sidecars are named after the track's content
+# hash, so only new or changed tracks are encoded, and sidecars of tracks that
+# changed or went away are deleted (sidecars of other codecs or packet sizes
+# than this run's are left alone). Run it with the servers' settings:
+#
+#   python prepack.py --folder music --index playlist_index.db --packets packets
+
+# Encode one track into a sidecar (runs in a worker process); returns the PCM bytes read
+def encode_track(track, codec_name, chunk_size, path):
+    with open(track.path, "rb") as f:
+        f.seek(track.data_offset)
+        pcm = f.read(track.data_size)
+    view = memoryview(pcm)
+    frames = [view[i:i + chunk_size] for i in range(0, len(pcm), chunk_size)]
+    write_sidecar(path, CODECS[codec_name].encode(frames, track), chunk_size)
+    return len(pcm)
+
+def main():
+    encoded_codecs = [name for name in CODECS if name != PCM.name]
+    parser = argparse.ArgumentParser(description="Pre-encode tracks into packet sidecars")
+    parser.add_argument("--folder", default="music", help="music folder (MUSIC_FOLDER)")
+    parser.add_argument("--index", default="playlist_index.db", help="track index (INDEX_FILE)")
+    parser.add_argument("--packets", default="packets", help="sidecar folder (PACKET_FOLDER)")
+    parser.add_argument("--chunk-size", type=int, default=1024, help="PCM bytes per packet (CHUNK_SIZE)")
+    parser.add_argument("--codecs", default=",".join(encoded_codecs), help="comma-separated codecs to encode")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    codecs = [name.strip() for name in args.codecs.split(",") if name.strip()]
+    for name in codecs:
+        if name not in encoded_codecs:
+            parser.error(f"unknown codec {name!r}; available: {', '.join(encoded_codecs)}")
+
+    os.makedirs(args.packets, exist_ok=True)
+    store = PacketStore(args.packets)
+    tracks = update_index(args.folder, args.index)
+
+    # Work out what is missing; everything else in the folder is stale
+    jobs = []
+    keep = set()
+    for track in tracks:
+        chunk_size = frame_chunk_size(track, args.chunk_size)
+        for name in codecs:
+            if not CODECS[name].supports(track):
+                continue
+            path = store.path(track, name, chunk_size)
+            if path in keep:
+                continue  # Same audio as a track already listed
+            keep.add(path)
+            if not os.path.exists(path):
+                jobs.append((track, name, chunk_size, path))
+    removed = store.prune({track.content_hash for track in tracks})  # Other codecs and sizes are kept
+
+    start = time.perf_counter()
+    done_tracks = set()
+    pcm_bytes = 0
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(encode_track, *job): job for job in jobs}
+        for future in as_completed(futures):
+            track, name, _, path = futures[future]
+            try:
+                pcm_bytes += future.result()
+            except Exception as e:
+                print(f"Failed to encode {track.path} as {name}: {e}")
+                failed += 1
+                continue
+            done_tracks.add(track.track_id)
+            print(f"Encoded {os.path.basename(track.path)} as {name}")
+    elapsed = time.perf_counter() - start
+
+    rate = len(done_tracks) / elapsed if elapsed else 0.0
+    print(f"{len(jobs) - failed} sidecars for {len(done_tracks)} tracks in {elapsed:.1f}s "
+          f"({rate:.1f} tracks/s, {pcm_bytes / (elapsed or 1) / 1e6:.1f} MB/s of PCM); "
+          f"{len(keep) - len(jobs)} up to date, {removed} stale removed, {failed} failed")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import struct
+import time
+
+# Wire format shared by the servers and clients.
+# Every UDP datagram starts with a 12-byte header followed by the payload:
+#   version (1 byte), flags (1 byte), stream id (2 bytes),
+#   sequence number (4 bytes), sample-frame timestamp (4 bytes)
+# Data payloads are whole sample frames of PCM, never the WAV header, encoded with
+# the codec named in the top bits of the flags (see audio_codecs; 0 is raw PCM);
+# the timestamp counts frames from the start of the track's audio. Clients learn
+# the format from the /stream response.
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct("!BBHII")
+HEADER_SIZE = HEADER.size
+
+# Packet flags
+FLAG_END = 0x01         # Last packet of the stream, carries no payload
+FLAG_PARITY = 0x02      # FEC parity packet; seq is the first sequence number it protects
+FLAG_NACK = 0x04        # Client -> server request to resend the sequence numbers in the payload
+FLAG_RETRANSMIT = 0x08  # Data packet resent in answer to a NACK
+FLAG_REPORT = 0x10      # Client -> server reception report (see abr.py)
+
+# Codec id of a data or parity packet, kept in the top three bits of the flags
+CODEC_SHIFT = 5
+
+def codec_flags(codec_id):
+    return codec_id << CODEC_SHIFT
+
+def packet_codec(flags):
+    return flags >> CODEC_SHIFT
+
+# Build a datagram from header fields and a payload
+def pack_packet(stream_id, seq, timestamp, payload=b"", flags=0):
+    return pack_header(stream_id, seq, timestamp, flags) + bytes(payload)
+
+# Just the header, for senders that pass the payload as a separate buffer
+# (a (header, payload) datagram, see batching.send_parts) to avoid copying it
+def pack_header(stream_id, seq, timestamp, flags=0):
+    return HEADER.pack(PROTOCOL_VERSION, flags, stream_id, seq, timestamp)
+
+# Split a datagram into (flags, stream_id, seq, timestamp, payload)
+def unpack_packet(data):
+    if len(data) < HEADER_SIZE:
+        raise ValueError(f"Packet too short: {len(data)} bytes")
+    version, flags, stream_id, seq, timestamp = HEADER.unpack_from(data)
+    if version != PROTOCOL_VERSION:
+        raise ValueError(f"Unsupported protocol version {version}")
+    return flags, stream_id, seq, timestamp, data[HEADER_SIZE:]
+
+# Client-side reassembly buffer.
+# Packets are pushed in arrival order and released in sequence order. A packet
+# that is still missing once `window` later packets have arrived is declared
+# lost and replaced with silence of the same size, so one drop never shifts
+# every later sample (which would also swap the stereo channels).
+# With a `deadline` (seconds) a gap is instead given that long after the first
+# packet behind it arrived, so a resend can still fill it however many packets
+# the sender bursts meanwhile; `window` then only bounds what is held back.
+class ReorderBuffer:
+    def __init__(self, window=64, deadline=None):
+        self.window = window
+        self.deadline = deadline
+        self.next_seq = 0           # Next sequence number to release
+        self.highest_seq = -1       # Highest sequence number seen so far
+        self.pending = {}           # seq -> payload, waiting for earlier packets
+        self.arrived = {}           # seq -> monotonic arrival time of pending packets, with a deadline
+        self.packet_size = 0        # Largest payload seen, used to size silence for lost packets
+
+        # Statistics
+        self.received = 0
+        self.lost = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.max_reorder_depth = 0
+
+    # Add a packet and return the list of payloads that are now ready, in order
+    def push(self, seq, payload):
+        if seq < self.next_seq or seq in self.pending:
+            self.duplicates += 1
+            return []
+
+        self.received += 1
+        self.packet_size = max(self.packet_size, len(payload))
+        if seq < self.highest_seq:
+            self.reordered += 1
+            self.max_reorder_depth = max(self.max_reorder_depth, self.highest_seq - seq)
+        self.highest_seq = max(self.highest_seq, seq)
+        self.pending[seq] = payload
+        if self.deadline is not None:
+            self.arrived[seq] = time.monotonic()
+
+        ready = []
+        while True:
+            if self.next_seq in self.pending:
+                ready.append(self.pending.pop(self.next_seq))
+                self.arrived.pop(self.next_seq, None)
+            elif self.highest_seq - self.next_seq >= self.window or self._overdue():
+                ready.append(self._conceal())  # Gave up waiting for this one
+            else:
+                break
+            self.next_seq += 1
+        if seq in self.pending:
+            self.pending[seq] = bytes(payload)  # Held back; the caller's buffer may be reused before release
+        return ready
+
+    # Release everything still buffered up to (but excluding) end_seq, filling gaps
+    def flush(self, end_seq=None):
+        if end_seq is None:
+            end_seq = self.highest_seq + 1
+        ready = []
+        while self.next_seq < end_seq:
+            payload = self.pending.pop(self.next_seq, None)
+            ready.append(payload if payload is not None else self._conceal())
+            self.next_seq += 1
+        self.pending.clear()
+        self.arrived.clear()
+        return ready
+
+    # Sequence numbers from next_seq up to (but excluding) `before` that have not arrived
+    def missing(self, before):
+        return [seq for seq in range(self.next_seq, before) if seq not in self.pending]
+
+    # Whether every packet before end_seq has been released
+    def complete(self, end_seq):
+        return self.next_seq >= end_seq
+
+    # Whether the gap at next_seq has held up later packets past the deadline.
+    # Every pending packet is behind that gap, so the earliest to arrive opened it.
+    def _overdue(self):
+        return (self.deadline is not None and bool(self.arrived)
+                and time.monotonic() - min(self.arrived.values()) > self.deadline)
+
+    # Silence standing in for a lost packet
+    def _conceal(self):
+        self.lost += 1
+        return bytes(self.packet_size)
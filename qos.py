@@ -0,0 +1,237 @@
+import json
+import os
+import threading
+import time
+from metrics import Histogram
+
+# Client-side playback quality (QoS) telemetry.
+# The client keeps a PlaybackQos per stream: time from the /stream request to
+# the first packet and to the first audio handed to the mixer, player underruns
+# and time spent rebuffering, and the receive figures (packets lost after FEC and
+# NACKs, duplicates, reorder depth). When the stream ends its record() is
+# appended to a JSON lines file and/or POSTed to the server's /qos route, which
+# keeps a log of the records and folds them into /metrics (see QosStats).
+# Records carry the client's QOS_LABELS (e.g. release and site) so runs can be
+# compared across releases and deployments.
+# /qos takes reports from anyone, so the server keeps only the fields listed
+# below, with bounded values (see validate_record), and caps the size of its log.
+
+# Latency buckets for time to first packet / first audio, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 2.0, 5.0)
+# Reorder depth buckets, in packets
+REORDER_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64)
+
+# Counters a record must carry, as non-negative numbers
+RECORD_COUNTERS = ["underruns", "stall_ms", "packets_received", "packets_lost", "duplicates", "reordered",
+                   "max_reorder_depth", "fec_recovered", "nacks_sent", "retransmits", "codec_switches"]
+# Latencies a record may carry; None when the stream ended before reaching them
+RECORD_LATENCIES = ["response_ms", "first_packet_ms", "first_audio_ms"]
+# What the stream was, as set by PlaybackQos.record()
+RECORD_FIELDS = ["time", "track_id", "stream_id", "codec", "start_ms", "fec", "nack", "channel", "abr",
+                 "completed", "loss"]
+# Labels a client may add through QOS_LABELS
+RECORD_LABELS = ["release", "site", "platform"]
+
+MAX_RECORD_VALUE = 10 ** 9   # Largest counter or latency accepted (over 11 days in ms)
+MAX_FIELD_NUMBER = 2 ** 53   # Largest magnitude of a number in the other fields
+MAX_LABEL_CHARS = 64         # Longest string accepted in a field or label
+
+# Measurements for one stream, filled in by the client thread receiving it.
+# Created just before the /stream request so its latencies include the request.
+class PlaybackQos:
+    def __init__(self, track_id, labels=None):
+        self.track_id = track_id
+        self.labels = dict(labels or {})
+        self.requested = time.time()
+        self.requested_at = time.monotonic()
+        self.responded_at = None
+        self.first_packet_at = None
+        self.stream = {}
+        self.codec_id = None
+        self.codec_switches = 0
+        self.player = None
+        self.underruns_before = 0
+        self.stall_before = 0.0
+        self.receive = {}
+
+    # The /stream response arrived
+    def on_response(self, stream):
+        self.responded_at = time.monotonic()
+        self.stream = stream
+
+    # The player the stream is written to; its counters are taken relative to now,
+    # since a player is reused across seeks
+    def on_player(self, player):
+        self.player = player
+        self.underruns_before = player.underruns
+        self.stall_before = player.stall_seconds
+
+    # A data packet arrived for the first time (not a retransmission)
+    def on_packet(self, now, codec_id):
+        if self.first_packet_at is None:
+            self.first_packet_at = now
+        elif codec_id != self.codec_id:
+            self.codec_switches += 1
+        self.codec_id = codec_id
+
+    # receive_stream returned (or was stopped), with its ReorderBuffer and repair counts
+    def on_receive_end(self, reorder, fec_recovered=0, nacks_sent=0, retransmits=0):
+        self.receive = {
+            "packets_received": reorder.received,
+            "packets_lost": reorder.lost,
+            "duplicates": reorder.duplicates,
+            "reordered": reorder.reordered,
+            "max_reorder_depth": reorder.max_reorder_depth,
+            "fec_recovered": fec_recovered,
+            "nacks_sent": nacks_sent,
+            "retransmits": retransmits,
+        }
+
+    # Milliseconds from the request to a monotonic timestamp, or None
+    def _since_request(self, at):
+        if at is None or at < self.requested_at:
+            return None
+        return round((at - self.requested_at) * 1000, 1)
+
+    # The record exported once the stream ended; completed=False when it was stopped early
+    def record(self, completed=True):
+        player = self.player
+        received = self.receive.get("packets_received", 0)
+        lost = self.receive.get("packets_lost", 0)
+        record = {
+            **self.labels,
+            "time": self.requested,
+            "track_id": self.track_id,
+            "stream_id": self.stream.get("stream_id"),
+            "codec": self.stream.get("codec", "pcm"),
+            "start_ms": self.stream.get("start_ms", 0),
+            "fec": self.stream.get("fec", 0),
+            "nack": self.stream.get("nack", False),
+            "channel": self.stream.get("channel", False),
+            "abr": bool(self.stream.get("abr")),
+            "completed": completed,
+            "response_ms": self._since_request(self.responded_at),
+            "first_packet_ms": self._since_request(self.first_packet_at),
+            "first_audio_ms": self._since_request(player.first_audio_at if player else None),
+            "underruns": player.underruns - self.underruns_before if player else 0,
+            "stall_ms": round((player.stall_seconds - self.stall_before) * 1000, 1) if player else 0.0,
+            "packets_received": received,
+            "packets_lost": lost,
+            "loss": round(lost / (received + lost), 6) if received + lost else 0.0,
+            "duplicates": 0,
+            "reordered": 0,
+            "max_reorder_depth": 0,
+            "fec_recovered": 0,
+            "nacks_sent": 0,
+            "retransmits": 0,
+            "codec_switches": self.codec_switches,
+        }
+        record.update(self.receive)
+        return record
+
+# Append one record to a JSON lines file
+def append_jsonl(path, record):
+    with open(path, "a") as f:
+        f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+# Check a record POSTed by a client and return the part of it the server keeps:
+# the counters, latencies, fields and labels listed above and nothing else.
+# Raises ValueError if it is not a record or a value is out of bounds, so neither
+# the log nor /metrics can be fed arbitrary data, NaN, infinities or huge numbers.
+def validate_record(record):
+    if not isinstance(record, dict):
+        raise ValueError("QoS record must be a JSON object")
+    kept = {}
+    for name in RECORD_COUNTERS:
+        kept[name] = check_count(name, record.get(name))
+    for name in RECORD_LATENCIES:
+        value = record.get(name)
+        kept[name] = None if value is None else check_count(name, value)
+    for name in RECORD_FIELDS + RECORD_LABELS:
+        if name in record:
+            kept[name] = check_field(name, record[name])
+    return kept
+
+def check_count(name, value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 <= value <= MAX_RECORD_VALUE:
+        raise ValueError(f"{name} must be a number from 0 to {MAX_RECORD_VALUE}")
+    return value
+
+def check_field(name, value):
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        if len(value) > MAX_LABEL_CHARS:
+            raise ValueError(f"{name} must be at most {MAX_LABEL_CHARS} characters")
+        return value
+    if isinstance(value, (int, float)) and -MAX_FIELD_NUMBER <= value <= MAX_FIELD_NUMBER:
+        return value
+    raise ValueError(f"{name} must be a string, a bounded number, a boolean or null")
+
+# Server-side totals of the records clients reported, for /metrics, and with a
+# `log_path` a JSON lines log of every record as received. Once the log reaches
+# max_log_bytes it is renamed to `<log_path>.1` (replacing the previous one) and
+# a new one is started, so it takes at most twice that on disk.
+# Reports arrive once per stream from request handlers, so a plain lock is fine.
+class QosStats:
+    def __init__(self, log_path=None, max_log_bytes=64 * 1024 * 1024):
+        self.log_path = log_path
+        self.max_log_bytes = max_log_bytes
+        self.lock = threading.Lock()
+        self.reports = 0
+        self.incomplete = 0  # Streams stopped before their end (seek, track change)
+        self.underruns = 0
+        self.stall_seconds = 0.0
+        self.packets_received = 0
+        self.packets_lost = 0
+        self.fec_recovered = 0
+        self.retransmits = 0
+        self.first_packet = Histogram(LATENCY_BUCKETS)
+        self.first_audio = Histogram(LATENCY_BUCKETS)
+        self.reorder_depth = Histogram(REORDER_BUCKETS)
+
+    # Fold in a validated record sent by the client at `client` (its address)
+    def add(self, record, client=None):
+        with self.lock:
+            if self.log_path:
+                self._rotate_log()
+                append_jsonl(self.log_path, {**record, "client": client, "received": time.time()})
+            self.reports += 1
+            if not record.get("completed", True):
+                self.incomplete += 1
+            self.underruns += record["underruns"]
+            self.stall_seconds += record["stall_ms"] / 1000
+            self.packets_received += record["packets_received"]
+            self.packets_lost += record["packets_lost"]
+            self.fec_recovered += record["fec_recovered"]
+            self.retransmits += record["retransmits"]
+            if record.get("first_packet_ms") is not None:
+                self.first_packet.observe(record["first_packet_ms"] / 1000)
+            if record.get("first_audio_ms") is not None:
+                self.first_audio.observe(record["first_audio_ms"] / 1000)
+            self.reorder_depth.observe(record["max_reorder_depth"])
+
+    # Start a new log once the current one is full (lock held)
+    def _rotate_log(self):
+        try:
+            if os.path.getsize(self.log_path) >= self.max_log_bytes:
+                os.replace(self.log_path, f"{self.log_path}.1")
+        except OSError:
+            pass  # No log yet
+
+    # Copy of the totals for metrics.render_metrics
+    def snapshot(self):
+        with self.lock:
+            return {
+                "reports": self.reports,
+                "incomplete": self.incomplete,
+                "underruns": self.underruns,
+                "stall_seconds": self.stall_seconds,
+                "packets_received": self.packets_received,
+                "packets_lost": self.packets_lost,
+                "fec_recovered": self.fec_recovered,
+                "retransmits": self.retransmits,
+                "first_packet": self.first_packet.copy(),
+                "first_audio": self.first_audio.copy(),
+                "reorder_depth": self.reorder_depth.copy(),
+            }
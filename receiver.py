@@ -0,0 +1,213 @@
+import socket
+import struct
+import time
+from protocol import unpack_packet, packet_codec, ReorderBuffer, FLAG_END, FLAG_PARITY, FLAG_RETRANSMIT
+from abr import pack_report
+from fec import FecDecoder
+from retransmit import NackTracker, pack_nack
+
+# Receive settings shared by the clients
+PACKET_BUFFER_SIZE = 4096   # Large enough for a header plus one chunk of audio
+RECEIVE_TIMEOUT = 5.0       # Seconds without packets before giving up on the stream
+END_GRACE_TIMEOUT = 0.2     # Seconds to wait for stragglers once the end marker arrived
+RING_SLOTS = 256            # Receive buffers reused in turn (see PacketRing)
+RECEIVE_BUFFER_BYTES = 4 * 1024 * 1024  # Kernel queue for bursts the server sends ahead of real time
+STOP_POLL_INTERVAL = 0.1    # How often a stoppable receive checks its stop event while no packets arrive
+JOIN_PROBE_PACKETS = 4      # Data packets held back on a mid-stream join to find where it starts
+REORDER_WINDOW_PACKETS = 1024  # Most packets held back behind a gap while retransmission may still fill it
+
+# Preallocated receive buffers, reused round-robin.
+# Datagrams are received straight into a slot with recvfrom_into and handed on as
+# memoryviews, so the steady-state receive path copies and allocates no packet data.
+# A view is only valid until its slot comes round again, RING_SLOTS packets later;
+# whatever has to live longer (out-of-order packets, FEC groups) is copied.
+class PacketRing:
+    def __init__(self, slots=RING_SLOTS, slot_size=PACKET_BUFFER_SIZE):
+        self.buffer = bytearray(slots * slot_size)
+        view = memoryview(self.buffer)
+        self.slots = [view[i * slot_size:(i + 1) * slot_size] for i in range(slots)]
+        self.next = 0
+
+    # Receive one datagram into the next slot; returns (memoryview of the datagram, addr)
+    def recv(self, sock):
+        slot = self.slots[self.next]
+        self.next = (self.next + 1) % len(self.slots)
+        nbytes, addr = sock.recvfrom_into(slot)
+        return slot[:nbytes], addr
+
+# Ask the kernel for a larger receive queue; it may grant less (net.core.rmem_max)
+def raise_receive_buffer(sock, size=RECEIVE_BUFFER_BYTES):
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+    except OSError:
+        pass
+    granted = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    if granted < size:
+        print(f"Receive buffer limited to {granted} bytes")  # Debugging line
+
+# Subscribe a bound UDP socket to a multicast group (shared channels, see channels.py)
+def join_multicast(sock, group):
+    membership = struct.pack("4s4s", socket.inet_aton(group), socket.inet_aton("0.0.0.0"))
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+
+# Receive one stream from a bound UDP socket.
+# Payloads are passed to on_payload in sequence order. Lost packets are rebuilt
+# from parity packets when the stream was requested with fec_group > 0, asked
+# for again with NACKs when the server agreed to retransmit, and replaced by
+# silence otherwise. on_payload gets memoryviews that are only valid during the
+# call, so it must copy what it keeps. When the stream is already running (a
+# shared channel) `join` is the seq of the /stream response; playback starts at
+# the lowest packet among the first JOIN_PROBE_PACKETS received, but not before
+# that seq, so a join whose first packet arrives out of order keeps it.
+# Setting the `stop` event (e.g. on seek) ends the receive within STOP_POLL_INTERVAL,
+# without delivering what is still buffered.
+# Streams sent with codecs other than plain PCM need a `decoder`
+# (audio_codecs.PacketDecoder); packets are decoded as they arrive, with the codec
+# their header names, so on_payload always gets PCM and a stream may switch codecs;
+# a packet that does not decode is left out and concealed like a lost one.
+# With `nack`, a missing packet is waited for until `playout_deadline_ms` (from the
+# /stream response) has passed since the packets behind it started arriving,
+# rather than for a fixed number of packets, which the sender's lead burst after
+# every start, seek or resume would use up before the resend arrives.
+# With a `monitor` (abr.ReceptionMonitor) reception reports are sent back to the
+# server for adaptive bitrate.
+# A `qos` (qos.PlaybackQos) is told when packets first arrive and gets the
+# receive statistics at the end, stopped or not.
+# Returns the ReorderBuffer so callers can report statistics.
+def receive_stream(sock, stream_id, on_payload, fec_group=0, nack=False, join=None, stop=None, decoder=None,
+                   monitor=None, qos=None, playout_deadline_ms=None):
+    wait = RECEIVE_TIMEOUT  # Silence tolerated before giving up
+    last_packet = time.monotonic()
+
+    def set_wait(seconds):
+        nonlocal wait
+        wait = seconds
+        sock.settimeout(min(seconds, STOP_POLL_INTERVAL) if stop else seconds)
+
+    set_wait(RECEIVE_TIMEOUT)
+    raise_receive_buffer(sock)
+    ring = PacketRing()
+    if nack and playout_deadline_ms:
+        reorder = ReorderBuffer(REORDER_WINDOW_PACKETS, playout_deadline_ms / 1000)
+    else:
+        reorder = ReorderBuffer()
+    fec = FecDecoder(fec_group) if fec_group else None
+    nacks = NackTracker() if nack else None
+    retransmits = 0
+    undecodable = 0
+    end_seq = None
+    joining = [] if join is not None else None  # (seq, payload, codec_id) held until the join point is known
+
+    # Hand a packet to the reorder buffer (as PCM) and play out whatever became ready
+    def deliver(seq, payload, codec_id):
+        nonlocal undecodable
+        if decoder:
+            try:
+                payload = decoder.decode(codec_id, payload)
+            except ValueError as e:
+                undecodable += 1
+                print(f"Dropped undecodable packet {seq}: {e}")  # Debugging line
+                return  # Stays a gap: resent if NACKs are on, otherwise concealed as silence
+        for chunk in reorder.push(seq, payload):
+            on_payload(chunk)
+
+    # Deliver a data packet, and any packet its FEC group can now rebuild
+    def take(seq, payload, codec_id):
+        deliver(seq, payload, codec_id)
+        if fec:
+            for lost_seq, rebuilt in fec.add_data(seq, payload):  # XORed into its group, not kept
+                deliver(lost_seq, rebuilt, codec_id)
+            fec.forget_before(reorder.next_seq)
+
+    # Start a mid-stream join at the packets held back so far; every packet starts on a frame boundary
+    def start_join():
+        nonlocal joining
+        held, joining = joining, None
+        reorder.next_seq = max(join, min(seq for seq, _, _ in held)) if held else join
+        for seq, payload, codec_id in sorted(held, key=lambda packet: packet[0]):
+            take(seq, payload, codec_id)
+
+    while end_seq is None or not reorder.complete(end_seq):
+        if stop and stop.is_set():
+            print("Stream stopped.")  # Debugging line
+            if qos:
+                qos.on_receive_end(reorder, fec.recovered if fec else 0, nacks.sent if nacks else 0, retransmits)
+            return reorder
+        try:
+            data, addr = ring.recv(sock)
+        except socket.timeout:
+            if stop and time.monotonic() - last_packet < wait:
+                continue  # Only polling the stop event
+            if end_seq is None:
+                print("Timed out waiting for packets.")  # Debugging line
+            break
+        last_packet = time.monotonic()
+
+        try:
+            flags, packet_stream_id, seq, timestamp, payload = unpack_packet(data)
+        except ValueError as e:
+            print(f"Dropped malformed packet from {addr}: {e}")  # Debugging line
+            continue
+        if packet_stream_id != stream_id:
+            continue  # Leftover packets from a previous stream on the same port
+
+        if flags & FLAG_END:
+            print("Received end-of-stream marker.")  # Debugging line
+            if joining is not None:
+                start_join()
+            end_seq = seq
+            set_wait(END_GRACE_TIMEOUT)
+            if nacks:
+                request_missing(sock, stream_id, addr, nacks, reorder, end_seq)
+            continue
+
+        # Every packet of an FEC group, parity included, uses the same codec
+        codec_id = packet_codec(flags)
+        if flags & FLAG_PARITY:
+            if fec:
+                for lost_seq, rebuilt in fec.add_parity(seq, bytes(payload)):
+                    deliver(lost_seq, rebuilt, codec_id)
+            continue
+
+        if flags & FLAG_RETRANSMIT:
+            retransmits += 1
+        else:
+            if qos:
+                qos.on_packet(last_packet, codec_id)
+            if monitor:
+                monitor.on_packet(seq, timestamp, last_packet)
+                if monitor.due(last_packet):
+                    sock.sendto(pack_report(stream_id, monitor.report(last_packet)), addr)
+        if joining is not None:
+            joining.append((seq, bytes(payload), codec_id))  # Copied: held past the reuse of its slot
+            if len(joining) < JOIN_PROBE_PACKETS:
+                continue
+            start_join()
+        else:
+            take(seq, payload, codec_id)
+        if nacks and reorder.pending:
+            request_missing(sock, stream_id, addr, nacks, reorder, end_seq)
+
+    if joining is not None:
+        start_join()  # Timed out with fewer than JOIN_PROBE_PACKETS
+    for chunk in reorder.flush(end_seq):
+        on_payload(chunk)
+
+    if fec:
+        print(f"Packets recovered by FEC: {fec.recovered}")  # Debugging line
+    if nacks:
+        print(f"Packets NACKed: {nacks.sent}, retransmissions received: {retransmits}")  # Debugging line
+    if undecodable:
+        print(f"Packets that could not be decoded: {undecodable}")  # Debugging line
+    print(f"Packets received: {reorder.received}, lost: {reorder.lost}, "
+          f"duplicates: {reorder.duplicates}, reordered: {reorder.reordered} "
+          f"(max depth {reorder.max_reorder_depth})")  # Debugging line
+    if qos:
+        qos.on_receive_end(reorder, fec.recovered if fec else 0, nacks.sent if nacks else 0, retransmits)
+    return reorder
+
+# Send a NACK back to the server for the gaps that are due for a (re)request
+def request_missing(sock, stream_id, server_addr, nacks, reorder, end_seq=None):
+    seqs = nacks.due(reorder, end_seq)
+    if seqs:
+        sock.sendto(pack_nack(stream_id, seqs), server_addr)
@@ -0,0 +1,81 @@
+import struct
+import time
+from protocol import pack_packet, FLAG_NACK, FLAG_RETRANSMIT
+
+# Selective retransmission.
+# The client answers gaps in the sequence numbers with NACK packets sent back
+# to the address the stream comes from. The payload of a NACK is a list of
+# 32-bit sequence numbers. The server keeps its most recently sent datagrams in
+# a ring buffer and resends the ones that can still make their playout deadline.
+MAX_NACK_SEQS = 64  # Sequence numbers per NACK packet
+
+# Build a NACK datagram asking for the given sequence numbers
+def pack_nack(stream_id, seqs):
+    return pack_packet(stream_id, 0, 0, struct.pack(f"!{len(seqs)}I", *seqs), FLAG_NACK)
+
+# Return the list of sequence numbers asked for by a NACK payload
+def unpack_nack(payload):
+    return list(struct.unpack(f"!{len(payload) // 4}I", payload[:len(payload) // 4 * 4]))
+
+# Server-side ring buffer of recently sent datagrams for one stream
+class SendWindow:
+    def __init__(self, size, playout_deadline):
+        self.size = size
+        self.playout_deadline = playout_deadline  # Seconds after the first send that a resend is still useful
+        self.slots = [None] * size                # seq % size -> (seq, sent_at, datagram)
+        self.retransmitted = 0
+        self.expired = 0
+
+    # Remember a datagram that has just been sent
+    def add(self, seq, datagram):
+        self.slots[seq % self.size] = (seq, time.monotonic(), datagram)
+
+    # Datagram to resend for seq, or None if it left the window or would arrive too late
+    def get(self, seq):
+        entry = self.slots[seq % self.size]
+        if entry is None or entry[0] != seq:
+            self.expired += 1
+            return None
+        if time.monotonic() - entry[1] > self.playout_deadline:
+            self.expired += 1
+            return None
+        self.retransmitted += 1
+        data = entry[2]
+        if isinstance(data, tuple):
+            data = b"".join(data)  # Sent as (header, payload) without joining; resends are rare
+        return bytes([data[0], data[1] | FLAG_RETRANSMIT]) + data[2:]
+
+    # Resend whichever of the requested packets can still make their deadline
+    def resend(self, sock, seqs, dest):
+        for seq in seqs:
+            datagram = self.get(seq)
+            if datagram is not None:
+                sock.sendto(datagram, dest)
+
+# Client-side bookkeeping of which missing packets were already NACKed
+class NackTracker:
+    def __init__(self, reorder_threshold=3, retry_interval=0.05, max_attempts=3):
+        self.reorder_threshold = reorder_threshold  # Packets a gap must trail the newest one by before we NACK it
+        self.retry_interval = retry_interval        # Seconds between NACKs for the same packet
+        self.max_attempts = max_attempts
+        self.attempts = {}                          # seq -> (attempts, last NACK time)
+        self.sent = 0
+
+    # Sequence numbers that should be NACKed now, given the reorder buffer's gaps.
+    # Pass end_seq once the end marker arrived so the tail of the stream is covered too.
+    def due(self, reorder, end_seq=None):
+        now = time.monotonic()
+        seqs = []
+        before = end_seq if end_seq is not None else reorder.highest_seq - self.reorder_threshold + 1
+        for seq in reorder.missing(before):
+            attempts, last = self.attempts.get(seq, (0, 0.0))
+            if attempts < self.max_attempts and now - last >= self.retry_interval:
+                self.attempts[seq] = (attempts + 1, now)
+                seqs.append(seq)
+                if len(seqs) == MAX_NACK_SEQS:
+                    break
+        # Forget packets that were delivered or concealed
+        for seq in [s for s in self.attempts if s < reorder.next_seq]:
+            del self.attempts[seq]
+        self.sent += len(seqs)
+        return seqs
@@ -1,28 +1,105 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 import os
+import json
+import hashlib
 import socket
-import threading
+from wav_utils import byte_rate, frame_bytes, frame_chunk_size, seek_position
+from track_index import update_index, make_library, query_tracks
+from watcher import FolderWatcher
+from frame_cache import FrameCache
+from packet_store import PacketStore
+from audio_codecs import negotiate, CODECS, PCM
+from batching import send_parts
+from sessions import Session, SessionScheduler, StreamIds
+from metrics import render_metrics, CONTENT_TYPE
+from qos import QosStats, validate_record
+from engine import StreamingEngine
+from shards import ShardPool
+from channels import ChannelManager
+from pacing import Pacer
+from protocol import pack_packet, pack_header, codec_flags, FLAG_END, FLAG_PARITY
+from fec import build_parity, MAX_FEC_GROUP
 
 app = Flask(__name__)
 
 # Path to the music folder
 MUSIC_FOLDER = "music"  # Replace with your folder path
-playlist = []  # List to store the paths of audio files
+INDEX_FILE = "playlist_index.db"  # On-disk cache of track metadata
+library = make_library([])  # Current playlist snapshot, replaced whole on every reload
+TRACK_PAGE_SIZE = 100       # Default page size for /tracks
+MAX_TRACK_PAGE_SIZE = 1000  # Largest page a client may ask for
+
+# Streaming settings
+CHUNK_SIZE = 1024           # Bytes of audio per UDP datagram
+PACING_LEAD_SECONDS = 0.5   # How far ahead of real time the sender may run
+stream_ids = StreamIds(lambda: (engine or scheduler).table.stream_ids() | channels.stream_ids())  # Per-session stream ids, skipping ones in use
+FRAME_CACHE_BYTES = 256 * 1024 * 1024  # Memory for prepared frames of hot tracks (see frame_cache.py)
+PACKET_FOLDER = "packets"  # Pre-encoded tracks written by prepack.py (see packet_store.py)
+frame_cache = FrameCache(FRAME_CACHE_BYTES, CHUNK_SIZE, packets=PacketStore(PACKET_FOLDER))
+
+# Session limits
+MAX_ACTIVE_STREAMS = 64    # Streams sent concurrently, one worker thread each
+MAX_QUEUED_STREAMS = 16    # Requests that may wait for a free worker before we answer 503
+RETRY_AFTER_SECONDS = 5    # Retry-After sent with 503 responses
+
+# How streams are sent:
+#   "threads"   one worker thread and socket per stream (limits above)
+#   "eventloop" one thread multiplexing every stream on one socket (see engine.py)
+#   "shards"    SHARD_PROCESSES event loops in worker processes, sharing SHARD_PORT (see shards.py)
+STREAM_ENGINE = "threads"
+MAX_ENGINE_STREAMS = 4096  # Streams the event loop(s) serve at once before we answer 503
+SHARD_PROCESSES = os.cpu_count() or 1
+SHARD_PORT = 5001          # UDP port the shards send from and receive NACKs on
+
+# Shared channels, for clients that ask for channel=1: one broadcast per track
+# that every listener joins, instead of one stream per listener
+MAX_CHANNELS = 32
+CHANNEL_MULTICAST_BASE = "239.255.77.0"  # Group addresses come from this /24; None fans out over unicast instead
+CHANNEL_PORT = 5006                      # UDP port of every channel group
+CHANNEL_FEC_GROUP = 8                    # Shared by all listeners, so fixed per server (0 disables FEC)
+channels = ChannelManager(MAX_CHANNELS, CHANNEL_MULTICAST_BASE, CHANNEL_PORT, CHANNEL_FEC_GROUP,
+                          CHUNK_SIZE, PACING_LEAD_SECONDS, frame_cache.maps)
+
+# Worker pool that runs stream_audio with admission control
+scheduler = SessionScheduler(MAX_ACTIVE_STREAMS, MAX_QUEUED_STREAMS)
+
+# Playback QoS reports from clients, one per stream (see qos.py)
+QOS_LOG = "qos_reports.jsonl"   # Every report as a JSON line; None keeps only the /metrics totals
+QOS_LOG_MAX_BYTES = 64 * 1024 * 1024  # Then it moves to qos_reports.jsonl.1 and a new one starts
+MAX_QOS_REPORT_BYTES = 16 * 1024
+qos_stats = QosStats(QOS_LOG, QOS_LOG_MAX_BYTES)
+
+# Single-threaded engine used instead of the pool when STREAM_ENGINE is "eventloop"
+engine = None
+if STREAM_ENGINE == "eventloop":
+    engine = StreamingEngine(MAX_ENGINE_STREAMS, CHUNK_SIZE, PACING_LEAD_SECONDS, cache_bytes=FRAME_CACHE_BYTES,
+                             packet_folder=PACKET_FOLDER)
+    engine.start()
 
 # Load the playlist
 def load_playlist():
-    global playlist
-    playlist = [os.path.join(MUSIC_FOLDER, f) for f in os.listdir(MUSIC_FOLDER) if f.endswith(".wav")]
-    if not playlist:
+    global library
+    library = make_library(update_index(MUSIC_FOLDER, INDEX_FILE))  # Only new or changed files are parsed
+    if not library.tracks:
         print("No .wav files found in the music folder.")
     else:
         print("Playlist loaded successfully:")
-        for track in playlist:
-            print(track)
+        for track in library.tracks:
+            print(f"{track.track_id}  {track.path}")
+
+# Re-index the music folder and publish a new snapshot; called by the folder watcher.
+# Streams already running keep the Track they started with.
+def reload_playlist():
+    global library
+    tracks = update_index(MUSIC_FOLDER, INDEX_FILE)
+    if tuple(tracks) != library.tracks:
+        library = make_library(tracks)
+        print(f"Playlist reloaded: {len(tracks)} tracks")
 
 # Function to stream audio via UDP
-def stream_audio(track_id, client_ip, client_port):
-    if track_id < 0 or track_id >= len(playlist):
+def stream_audio(track_id, client_ip, client_port, stream_id, fec_group=0, start=0, codec="pcm", session=None):
+    track = library.by_id.get(track_id)
+    if track is None:
         print("Invalid track ID")
         return
 
@@ -31,25 +108,61 @@ def stream_audio(track_id, client_ip, client_port):
     print(f"Streaming track {track_id} via UDP to {client_ip}:{client_port}")
 
     try:
-        with open(playlist[track_id], "rb") as f:
-            while True:
-                chunk = f.read(1024)  # Read in chunks of 1024 bytes
-                if not chunk:
-                    break  # End of file
-                sock.sendto(chunk, (client_ip, client_port))
-                print(f"Sent {len(chunk)} bytes to {client_ip}:{client_port}")  # Debugging line
-
-        # Send an empty packet to signal the end of the stream
-        sock.sendto(b"", (client_ip, client_port))
+        # Send at the track's real byte rate instead of as fast as the socket allows;
+        # the format comes from the index, so no header parsing here
+        pacer = Pacer(byte_rate(track), PACING_LEAD_SECONDS)
+        frame_size = frame_bytes(track)
+        seq = 0
+        offset = start  # Byte offset in the PCM data; timestamps count frames from the start of the audio
+        group = []  # Payloads of the current FEC group
+        flags = codec_flags(CODECS[codec].id)  # Every packet names its codec
+        if session:
+            session.codec = codec
+
+        # Frames come from the cache for hot tracks and from the file's memory map otherwise
+        with frame_cache.open(track, fec_group, start, codec) as prepared:
+            for chunk in prepared.frames:
+                if session and session.cancelled:
+                    break
+                size = min(prepared.chunk_size, track.data_size - offset)  # PCM bytes in this packet, however it is encoded
+                late = pacer.wait(size)
+                # Prefix each chunk with a header so the client can detect loss and reordering
+                send_parts(sock, (pack_header(stream_id, seq, offset // frame_size, flags), chunk), (client_ip, client_port))
+                if session:
+                    session.packets_sent += 1
+                    session.bytes_sent += len(chunk)
+                    session.send_lag.observe(late)
+                seq += 1
+                offset += size
+
+                # Follow every fec_group data packets with an XOR parity packet
+                if fec_group:
+                    group.append(chunk)
+                    if len(group) == fec_group:
+                        parity = prepared.parity[(seq - 1) // fec_group] if prepared.parity else build_parity(group)
+                        sock.sendto(pack_packet(stream_id, seq - len(group), 0, parity, FLAG_PARITY | flags), (client_ip, client_port))
+                        group = []
+
+        if session and session.cancelled:
+            print(f"Stream {stream_id} cancelled by the client")  # Debugging line
+            return
+
+        # Protect the last, possibly short, FEC group
+        if group:
+            parity = prepared.parity[-1] if prepared.parity else build_parity(group)
+            sock.sendto(pack_packet(stream_id, seq - len(group), 0, parity, FLAG_PARITY | flags), (client_ip, client_port))
+
+        # Send a header-only packet flagged as the end of the stream
+        sock.sendto(pack_packet(stream_id, seq, offset // frame_size, flags=FLAG_END), (client_ip, client_port))
         print("Sent end-of-stream marker.")  # Debugging line
     finally:
         sock.close()
         print("Finished streaming.")  # Debugging line
 
 # Flask route to start streaming
-@app.route('/stream/<int:track_id>')
+@app.route('/stream/<track_id>')
 def start_stream(track_id):
-    if track_id < 0 or track_id >= len(playlist):
+    if track_id not in library.by_id:
         return "Invalid track ID", 404
 
     # Get the client's IP and port from the request
@@ -59,15 +172,139 @@ def start_stream(track_id):
     if not client_ip or not client_port:
         return "Client IP or port not provided", 400
 
-    # Start streaming in a new thread
-    threading.Thread(target=stream_audio, args=(track_id, client_ip, client_port)).start()
-    return f"Started streaming track {track_id} via UDP to {client_ip}:{client_port}"
+    # Shared broadcast: join the running channel of this track (or start one).
+    # The response says which multicast group to listen on, if any, and the
+    # packet the listener joins at; retransmission is not available on channels.
+    if request.args.get('channel', 0, type=int) == 1:
+        joined = channels.join(library.by_id[track_id], stream_ids.allocate, (client_ip, client_port))
+        if joined is None:
+            return "Server is busy, try again later", 503, {"Retry-After": str(RETRY_AFTER_SECONDS)}
+        return jsonify({"message": f"Joined the channel of track {track_id}", "channel": True, **joined})
+
+    # Optional forward error correction: one parity packet per `fec` data packets
+    fec_group = request.args.get('fec', 0, type=int)
+    if fec_group < 0 or fec_group > MAX_FEC_GROUP:
+        return f"fec must be between 0 and {MAX_FEC_GROUP}", 400
+
+    # Optional seek: start `start_ms` milliseconds into the track, at a frame boundary
+    start_ms = request.args.get('start_ms', 0, type=int)
+    if start_ms < 0:
+        return "start_ms must not be negative", 400
+    track = library.by_id[track_id]
+    start = seek_position(track, start_ms)
 
-# Flask route to fetch the list of tracks
+    # Optional payload codec: the first of the client's comma-separated choices that
+    # suits the track, or plain PCM. Encoded tracks are cut into packets once, so their
+    # seeks start at a packet boundary.
+    codec = negotiate(request.args.get('codec'), track)
+    if codec is not PCM:
+        start -= start % frame_chunk_size(track, CHUNK_SIZE)
+
+    # Hand the stream to the worker pool or the event loop, or ask the client to come back later
+    stream_id = stream_ids.allocate()
+    if stream_id is None:
+        return "Server is busy, try again later", 503, {"Retry-After": str(RETRY_AFTER_SECONDS)}
+    session = Session(stream_id, track_id, f"{client_ip}:{client_port}")
+    if engine:
+        started = engine.submit(session, track, (client_ip, client_port), fec_group, False, start, codec.name)
+    else:
+        started = scheduler.submit(session, stream_audio, (track_id, client_ip, client_port, stream_id, fec_group, start, codec.name))
+    if not started:
+        return "Server is busy, try again later", 503, {"Retry-After": str(RETRY_AFTER_SECONDS)}
+    return jsonify({
+        "message": f"Started streaming track {track_id} via UDP to {client_ip}:{client_port}",
+        "stream_id": stream_id,
+        "token": session.token,  # Proves a DELETE /stream/<stream_id> comes from this client
+        "state": session.state,
+        "start_ms": start * 1000 // byte_rate(track),
+        "start_frame": start // frame_bytes(track),  # Exactly where it starts; start_ms is rounded down
+        # Packets carry whole PCM frames, encoded with `codec`; the client sets up its output from this
+        "format": {"channels": track.channels, "sample_width": track.sample_width, "frame_rate": track.frame_rate},
+        "codec": codec.name,
+        "fec": fec_group,
+    })
+
+# Flask route to cancel a stream the client no longer plays (seek, other track, pause),
+# so its slot frees up at once instead of when the track would have ended, or to
+# leave a fan-out channel. Needs the token from the /stream response.
+@app.route('/stream/<int:stream_id>', methods=['DELETE'])
+def cancel_stream(stream_id):
+    token = request.args.get('token', '')
+    if not (engine or scheduler).cancel(stream_id, token) and not channels.leave(stream_id, token):
+        return "No such stream", 404
+    return "", 204
+
+# Flask route to inspect the stream sessions
+@app.route('/sessions')
+def get_sessions():
+    return jsonify(engine.snapshot() if engine else scheduler.snapshot())
+
+# Flask route to inspect the shared channels
+@app.route('/channels')
+def get_channels():
+    return jsonify(channels.snapshot())
+
+# Flask route to inspect the frame cache
+@app.route('/cache')
+def get_cache():
+    if isinstance(engine, ShardPool):
+        return "Each shard process keeps its own frame cache", 404
+    return jsonify((engine.frames if engine else frame_cache).stats())
+
+# Flask route for Prometheus scrapes: session, traffic, channel, frame cache and client QoS metrics
+@app.route('/metrics')
+def get_metrics():
+    cache = None if isinstance(engine, ShardPool) else (engine.frames if engine else frame_cache)
+    return Response(render_metrics((engine or scheduler).table, cache, qos_stats, channels), mimetype=CONTENT_TYPE)
+
+# Flask route for clients' playback QoS reports (see qos.py)
+@app.route('/qos', methods=['POST'])
+def post_qos():
+    if (request.content_length or 0) > MAX_QOS_REPORT_BYTES:
+        return "QoS report too large", 413
+    body = request.stream.read(MAX_QOS_REPORT_BYTES + 1)  # Bounded even for chunked bodies, which have no Content-Length
+    if len(body) > MAX_QOS_REPORT_BYTES:
+        return "QoS report too large", 413
+    try:
+        record = validate_record(json.loads(body))
+    except ValueError as e:
+        return str(e), 400
+    qos_stats.add(record, request.remote_addr)
+    return "", 204
+
+# Flask route to fetch the list of tracks.
+# Without query parameters it returns the whole list, precomputed when the playlist
+# last changed. With limit/cursor/prefix/q it returns one page:
+# {"tracks": [...], "next_cursor": ...}. Both honour If-None-Match.
 @app.route('/tracks')
 def get_tracks():
-    return jsonify([os.path.basename(track) for track in playlist])
+    snapshot = library  # Read the current snapshot once
+
+    limit = request.args.get('limit', TRACK_PAGE_SIZE, type=int)
+    if limit < 1 or limit > MAX_TRACK_PAGE_SIZE:
+        return f"limit must be between 1 and {MAX_TRACK_PAGE_SIZE}", 400
+
+    # Pages share the playlist's ETag, qualified by the query that produced them
+    etag = snapshot.etag
+    if request.args:
+        etag += "-" + hashlib.sha1(request.query_string).hexdigest()[:8]
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    elif request.args:
+        page = query_tracks(snapshot, request.args.get('cursor'), limit, request.args.get('prefix'), request.args.get('q'))
+        response = Response(json.dumps(page), mimetype="application/json")
+    else:
+        response = Response(snapshot.body, mimetype="application/json")
+    response.set_etag(etag)
+    response.cache_control.no_cache = True  # Clients may cache, but must revalidate
+    return response
 
 if __name__ == "__main__":
     load_playlist()
+    if STREAM_ENGINE == "shards":
+        # Forked here rather than at import, before any other thread starts
+        engine = ShardPool(SHARD_PROCESSES, MAX_ENGINE_STREAMS, SHARD_PORT, CHUNK_SIZE, PACING_LEAD_SECONDS,
+                           cache_bytes=FRAME_CACHE_BYTES, packet_folder=PACKET_FOLDER)
+    FolderWatcher(MUSIC_FOLDER, reload_playlist).start()  # Pick up added/removed files without a restart
     app.run(host="0.0.0.0", port=5000)  # Bind to all available interfaces
\ No newline at end of file
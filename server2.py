@@ -1,32 +1,79 @@
-from flask import Flask, jsonify
-import os
+from flask import Flask, Response, jsonify, request
+import json
+import hashlib
 import socket
-import threading
+from wav_utils import byte_rate, frame_bytes, frame_chunk_size, seek_position
+from track_index import update_index, make_library, query_tracks
+from watcher import FolderWatcher
+from frame_cache import FrameCache
+from packet_store import PacketStore
+from audio_codecs import negotiate, CODECS, PCM
+from batching import send_parts
+from pacing import Pacer
+from sessions import Session, SessionScheduler, StreamIds
+from metrics import render_metrics, CONTENT_TYPE
+from qos import QosStats, validate_record
+from protocol import pack_packet, pack_header, codec_flags, FLAG_END
 
 app = Flask(__name__)
 
 # Path to the music folder
 MUSIC_FOLDER = "music"  # Replace with your folder path
-playlist = []  # List to store the paths of audio files
+INDEX_FILE = "playlist_index.db"  # On-disk cache of track metadata
+library = make_library([])  # Current playlist snapshot, replaced whole on every reload
+TRACK_PAGE_SIZE = 100       # Default page size for /tracks
+MAX_TRACK_PAGE_SIZE = 1000  # Largest page a client may ask for
 
 # UDP settings
 UDP_IP = "127.0.0.1"  # Replace with the client's IP address
 UDP_PORT = 5005       # Replace with the client's port
 
+# Streaming settings
+CHUNK_SIZE = 1024     # Bytes of audio per UDP datagram
+PACING_LEAD_SECONDS = 0.5   # How far ahead of real time the sender may run
+stream_ids = StreamIds(lambda: scheduler.table.stream_ids())  # Per-session stream ids, skipping ones in use
+FRAME_CACHE_BYTES = 256 * 1024 * 1024  # Memory for prepared frames of hot tracks (see frame_cache.py)
+PACKET_FOLDER = "packets"  # Pre-encoded tracks written by prepack.py (see packet_store.py)
+frame_cache = FrameCache(FRAME_CACHE_BYTES, CHUNK_SIZE, packets=PacketStore(PACKET_FOLDER))
+
+# Session limits
+MAX_ACTIVE_STREAMS = 64    # Streams sent concurrently, one worker thread each
+MAX_QUEUED_STREAMS = 16    # Requests that may wait for a free worker before we answer 503
+RETRY_AFTER_SECONDS = 5    # Retry-After sent with 503 responses
+
+# Worker pool that runs stream_audio with admission control
+scheduler = SessionScheduler(MAX_ACTIVE_STREAMS, MAX_QUEUED_STREAMS)
+
+# Playback QoS reports from clients, one per stream (see qos.py)
+QOS_LOG = "qos_reports.jsonl"   # Every report as a JSON line; None keeps only the /metrics totals
+QOS_LOG_MAX_BYTES = 64 * 1024 * 1024  # Then it moves to qos_reports.jsonl.1 and a new one starts
+MAX_QOS_REPORT_BYTES = 16 * 1024
+qos_stats = QosStats(QOS_LOG, QOS_LOG_MAX_BYTES)
+
 # Load the playlist
 def load_playlist():
-    global playlist
-    playlist = [os.path.join(MUSIC_FOLDER, f) for f in os.listdir(MUSIC_FOLDER) if f.endswith(".wav")]
-    if not playlist:
+    global library
+    library = make_library(update_index(MUSIC_FOLDER, INDEX_FILE))  # Only new or changed files are parsed
+    if not library.tracks:
         print("No .wav files found in the music folder.")
     else:
         print("Playlist loaded successfully:")
-        for track in playlist:
-            print(track)
+        for track in library.tracks:
+            print(f"{track.track_id}  {track.path}")
+
+# Re-index the music folder and publish a new snapshot; called by the folder watcher.
+# Streams already running keep the Track they started with.
+def reload_playlist():
+    global library
+    tracks = update_index(MUSIC_FOLDER, INDEX_FILE)
+    if tuple(tracks) != library.tracks:
+        library = make_library(tracks)
+        print(f"Playlist reloaded: {len(tracks)} tracks")
 
 # Function to stream audio via UDP
-def stream_audio(track_id):
-    if track_id < 0 or track_id >= len(playlist):
+def stream_audio(track_id, stream_id, start=0, codec="pcm", session=None):
+    track = library.by_id.get(track_id)
+    if track is None:
         print("Invalid track ID")
         return
 
@@ -35,36 +82,150 @@ def stream_audio(track_id):
     print(f"Streaming track {track_id} via UDP to {UDP_IP}:{UDP_PORT}")
 
     try:
-        with open(playlist[track_id], "rb") as f:
-            while True:
-                chunk = f.read(1024)  # Read in chunks of 1024 bytes
-                if not chunk:
-                    break  # End of file
-                sock.sendto(chunk, (UDP_IP, UDP_PORT))
-                print(f"Sent {len(chunk)} bytes to {UDP_IP}:{UDP_PORT}")  # Debugging line
-
-        # Send an empty packet to signal the end of the stream
-        sock.sendto(b"", (UDP_IP, UDP_PORT))
+        # Send at the track's real byte rate instead of as fast as the socket allows,
+        # so the client's receive queue does not overflow while its player is full;
+        # the format comes from the index, so no header parsing here
+        pacer = Pacer(byte_rate(track), PACING_LEAD_SECONDS)
+        frame_size = frame_bytes(track)
+        seq = 0
+        offset = start  # Byte offset in the PCM data; timestamps count frames from the start of the audio
+        flags = codec_flags(CODECS[codec].id)  # Every packet names its codec
+        if session:
+            session.codec = codec
+
+        # Frames come from the cache for hot tracks and from the file's memory map otherwise
+        with frame_cache.open(track, 0, start, codec) as prepared:
+            for chunk in prepared.frames:
+                if session and session.cancelled:
+                    break
+                size = min(prepared.chunk_size, track.data_size - offset)  # PCM bytes in this packet, however it is encoded
+                late = pacer.wait(size)
+                send_parts(sock, (pack_header(stream_id, seq, offset // frame_size, flags), chunk), (UDP_IP, UDP_PORT))
+                if session:
+                    session.packets_sent += 1
+                    session.bytes_sent += len(chunk)
+                    session.send_lag.observe(late)
+                seq += 1
+                offset += size
+
+        if session and session.cancelled:
+            print(f"Stream {stream_id} cancelled by the client")  # Debugging line
+            return
+
+        # Send a header-only packet flagged as the end of the stream
+        sock.sendto(pack_packet(stream_id, seq, offset // frame_size, flags=FLAG_END), (UDP_IP, UDP_PORT))
         print("Sent end-of-stream marker.")  # Debugging line
     finally:
         sock.close()
         print("Finished streaming.")  # Debugging line
 
 # Flask route to start streaming
-@app.route('/stream/<int:track_id>')
+@app.route('/stream/<track_id>')
 def start_stream(track_id):
-    if track_id < 0 or track_id >= len(playlist):
+    if track_id not in library.by_id:
         return "Invalid track ID", 404
 
-    # Start streaming in a new thread
-    threading.Thread(target=stream_audio, args=(track_id,)).start()
-    return f"Started streaming track {track_id} via UDP to {UDP_IP}:{UDP_PORT}"
+    # Optional seek: start `start_ms` milliseconds into the track, at a frame boundary
+    start_ms = request.args.get('start_ms', 0, type=int)
+    if start_ms < 0:
+        return "start_ms must not be negative", 400
+    track = library.by_id[track_id]
+    start = seek_position(track, start_ms)
+
+    # Optional payload codec: the first of the client's comma-separated choices that
+    # suits the track, or plain PCM. Encoded tracks are cut into packets once, so their
+    # seeks start at a packet boundary.
+    codec = negotiate(request.args.get('codec'), track)
+    if codec is not PCM:
+        start -= start % frame_chunk_size(track, CHUNK_SIZE)
+
+    # Hand the stream to the worker pool, or ask the client to come back later
+    stream_id = stream_ids.allocate()
+    if stream_id is None:
+        return "Server is busy, try again later", 503, {"Retry-After": str(RETRY_AFTER_SECONDS)}
+    session = Session(stream_id, track_id, f"{UDP_IP}:{UDP_PORT}")
+    if not scheduler.submit(session, stream_audio, (track_id, stream_id, start, codec.name)):
+        return "Server is busy, try again later", 503, {"Retry-After": str(RETRY_AFTER_SECONDS)}
+    return jsonify({
+        "message": f"Started streaming track {track_id} via UDP to {UDP_IP}:{UDP_PORT}",
+        "stream_id": stream_id,
+        "token": session.token,  # Proves a DELETE /stream/<stream_id> comes from this client
+        "state": session.state,
+        "start_ms": start * 1000 // byte_rate(track),
+        "start_frame": start // frame_bytes(track),  # Exactly where it starts; start_ms is rounded down
+        # Packets carry whole PCM frames, encoded with `codec`; the client sets up its output from this
+        "format": {"channels": track.channels, "sample_width": track.sample_width, "frame_rate": track.frame_rate},
+        "codec": codec.name,
+    })
 
-# Flask route to fetch the list of tracks
+# Flask route to cancel a stream the client no longer plays (seek, other track, pause),
+# so its slot frees up at once instead of when the track would have ended.
+# Needs the token from the /stream response.
+@app.route('/stream/<int:stream_id>', methods=['DELETE'])
+def cancel_stream(stream_id):
+    if not scheduler.cancel(stream_id, request.args.get('token', '')):
+        return "No such stream", 404
+    return "", 204
+
+# Flask route to inspect the stream sessions
+@app.route('/sessions')
+def get_sessions():
+    return jsonify(scheduler.snapshot())
+
+# Flask route to inspect the frame cache
+@app.route('/cache')
+def get_cache():
+    return jsonify(frame_cache.stats())
+
+# Flask route for Prometheus scrapes: session, traffic, frame cache and client QoS metrics
+@app.route('/metrics')
+def get_metrics():
+    return Response(render_metrics(scheduler.table, frame_cache, qos_stats), mimetype=CONTENT_TYPE)
+
+# Flask route for clients' playback QoS reports (see qos.py)
+@app.route('/qos', methods=['POST'])
+def post_qos():
+    if (request.content_length or 0) > MAX_QOS_REPORT_BYTES:
+        return "QoS report too large", 413
+    body = request.stream.read(MAX_QOS_REPORT_BYTES + 1)  # Bounded even for chunked bodies, which have no Content-Length
+    if len(body) > MAX_QOS_REPORT_BYTES:
+        return "QoS report too large", 413
+    try:
+        record = validate_record(json.loads(body))
+    except ValueError as e:
+        return str(e), 400
+    qos_stats.add(record, request.remote_addr)
+    return "", 204
+
+# Flask route to fetch the list of tracks.
+# Without query parameters it returns the whole list, precomputed when the playlist
+# last changed. With limit/cursor/prefix/q it returns one page:
+# {"tracks": [...], "next_cursor": ...}. Both honour If-None-Match.
 @app.route('/tracks')
 def get_tracks():
-    return jsonify([os.path.basename(track) for track in playlist])
+    snapshot = library  # Read the current snapshot once
+
+    limit = request.args.get('limit', TRACK_PAGE_SIZE, type=int)
+    if limit < 1 or limit > MAX_TRACK_PAGE_SIZE:
+        return f"limit must be between 1 and {MAX_TRACK_PAGE_SIZE}", 400
+
+    # Pages share the playlist's ETag, qualified by the query that produced them
+    etag = snapshot.etag
+    if request.args:
+        etag += "-" + hashlib.sha1(request.query_string).hexdigest()[:8]
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    elif request.args:
+        page = query_tracks(snapshot, request.args.get('cursor'), limit, request.args.get('prefix'), request.args.get('q'))
+        response = Response(json.dumps(page), mimetype="application/json")
+    else:
+        response = Response(snapshot.body, mimetype="application/json")
+    response.set_etag(etag)
+    response.cache_control.no_cache = True  # Clients may cache, but must revalidate
+    return response
 
 if __name__ == "__main__":
     load_playlist()
+    FolderWatcher(MUSIC_FOLDER, reload_playlist).start()  # Pick up added/removed files without a restart
     app.run(host="0.0.0.0", port=5000)
\ No newline at end of file
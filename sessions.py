@@ -0,0 +1,219 @@
+import collections
+import hmac
+import queue
+import secrets
+import threading
+import time
+from metrics import Histogram
+
+# State of one stream session, readable from request handlers.
+# Only the worker running the session writes to it.
+class Session:
+    def __init__(self, stream_id, track_id, client):
+        self.stream_id = stream_id
+        self.track_id = track_id
+        self.client = client          # "ip:port" the stream is sent to
+        self.state = "queued"         # queued -> streaming -> finished | failed | expired | cancelled
+        self.created = time.time()        # Wall clock, for display
+        self.queued_at = time.monotonic() # For queue aging, immune to clock steps
+        self.started = None
+        self.finished = None
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.codec = None             # Codec being sent; changes under adaptive bitrate
+        self.codec_switches = 0
+        self.send_lag = Histogram()   # Seconds behind real time each data packet left
+        self.error = None
+        self.token = secrets.token_hex(8)  # Given only to the client, which needs it to cancel the stream
+        self.cancelled = False        # Set by cancel(); the sender stops before its next packet
+
+    def to_dict(self):
+        return {
+            "stream_id": self.stream_id,
+            "track_id": self.track_id,
+            "client": self.client,
+            "state": self.state,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "packets_sent": self.packets_sent,
+            "bytes_sent": self.bytes_sent,
+            "codec": self.codec,
+            "codec_switches": self.codec_switches,
+            "error": self.error,
+        }
+
+# Sessions that are queued or streaming, plus a short history of ended ones.
+# Shared by the thread pool and the event-loop engine so /sessions looks the same for both.
+class SessionTable:
+    def __init__(self, lock=None, history=100):
+        self.lock = lock or threading.Lock()
+        self.sessions = {}                               # stream_id -> Session (queued or streaming)
+        self.recent = collections.deque(maxlen=history)  # Sessions that ended, newest last
+        self.rejected = 0
+
+        # Totals of every session that ended, for /metrics
+        self.ended = collections.Counter()          # Final state -> sessions
+        self.track_streams = collections.Counter()  # track_id -> sessions admitted
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.codec_switches = 0
+        self.send_lag = Histogram()
+
+    # Register a session unless `limit` sessions are already live; False when saturated
+    def admit(self, session, limit):
+        with self.lock:
+            if len(self.sessions) >= limit:
+                self.rejected += 1
+                return False
+            self.sessions[session.stream_id] = session
+            self.track_streams[session.track_id] += 1
+        return True
+
+    # Ask the sender of a live session to stop. Returns the session, or None when there
+    # is no such session or `token` is not the one its /stream response carried.
+    def cancel(self, stream_id, token):
+        with self.lock:
+            session = self.sessions.get(stream_id)
+            if session is None or not hmac.compare_digest(session.token.encode(), str(token).encode()):
+                return None
+            session.cancelled = True
+        return session
+
+    # Ids of the sessions that are queued or streaming
+    def stream_ids(self):
+        with self.lock:
+            return set(self.sessions)
+
+    # Move a session that ended into the history
+    def finish(self, session):
+        session.finished = time.time()
+        with self.lock:
+            self.sessions.pop(session.stream_id, None)
+            self.recent.append(session)
+            self.ended[session.state] += 1
+            self.packets_sent += session.packets_sent
+            self.bytes_sent += session.bytes_sent
+            self.codec_switches += session.codec_switches
+            self.send_lag.merge(session.send_lag)
+
+    # Counts and per-session state for monitoring
+    def snapshot(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            recent = list(self.recent)
+            rejected = self.rejected
+        return {
+            "active": sum(1 for s in sessions if s.state == "streaming"),
+            "queued": sum(1 for s in sessions if s.state == "queued"),
+            "rejected": rejected,
+            "sessions": [s.to_dict() for s in sessions],
+            "recent": [s.to_dict() for s in recent],
+        }
+
+    # Totals for metrics.render_metrics: ended sessions plus the live ones so far.
+    # Streams per track are only given for the top_tracks most streamed tracks,
+    # which keeps the number of series bounded however large the library is.
+    def metrics(self, top_tracks=20):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            stats = {
+                "packets_sent": self.packets_sent,
+                "bytes_sent": self.bytes_sent,
+                "codec_switches": self.codec_switches,
+                "send_lag": self.send_lag.copy(),
+                "ended": dict(self.ended),
+                "rejected": self.rejected,
+                "track_streams": dict(self.track_streams.most_common(top_tracks)),
+            }
+        live = collections.Counter({"queued": 0, "streaming": 0})
+        for session in sessions:  # Read without their writers' cooperation; off by a packet at most
+            live[session.state] += 1
+            stats["packets_sent"] += session.packets_sent
+            stats["bytes_sent"] += session.bytes_sent
+            stats["codec_switches"] += session.codec_switches
+            stats["send_lag"].merge(session.send_lag)
+        stats["live"] = dict(live)
+        return stats
+
+# Allocator of the 16-bit stream ids in the packet header, which wrap after 65535
+# streams. Ids that `in_use()` reports as taken (live sessions, running channels)
+# are skipped, so a new stream never shares its id, and with it the routing of
+# NACKs and reports, with one still running. 0 is never handed out.
+class StreamIds:
+    def __init__(self, in_use):
+        self.in_use = in_use
+        self.next = 1
+        self.lock = threading.Lock()
+
+    # The next free id, or None when all of them are taken
+    def allocate(self):
+        with self.lock:
+            taken = self.in_use()
+            for _ in range(0xFFFF):
+                stream_id = self.next
+                self.next = self.next % 0xFFFF + 1
+                if stream_id not in taken:
+                    return stream_id
+        return None
+
+# Fixed pool of streaming workers in front of a bounded queue.
+# At most max_active sessions stream at once and at most max_queued wait for a
+# worker; submit() refuses anything beyond that so the caller can answer 503
+# instead of starting yet another thread. Sessions that waited longer than
+# max_wait seconds are dropped, since their client has given up by then.
+# The worker threads start with the first session, so a server that streams
+# through an engine or forks shard processes instead never runs them.
+class SessionScheduler:
+    def __init__(self, max_active, max_queued, max_wait=4.0, lock=None, history=100):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.table = SessionTable(lock, history)
+        self.queue = queue.Queue()  # Bounded by the admission check in submit()
+        self.start_lock = threading.Lock()
+        self.workers_started = False
+
+    # Queue target(*args, session=session) to run on a worker; False when saturated.
+    # Counts queued plus streaming sessions, so idle workers that have not yet
+    # picked up their work do not count against the queue.
+    def submit(self, session, target, args):
+        if not self.table.admit(session, self.max_active + self.max_queued):
+            return False
+        self._start_workers()
+        self.queue.put((session, target, args))
+        return True
+
+    def _start_workers(self):
+        with self.start_lock:
+            if self.workers_started:
+                return
+            for i in range(self.max_active):
+                threading.Thread(target=self._worker, name=f"stream-worker-{i}", daemon=True).start()
+            self.workers_started = True
+
+    # Stop a queued or streaming session (see SessionTable.cancel); False if there is none
+    def cancel(self, stream_id, token):
+        return self.table.cancel(stream_id, token) is not None
+
+    def snapshot(self):
+        return {"max_active": self.max_active, "max_queued": self.max_queued, **self.table.snapshot()}
+
+    def _worker(self):
+        while True:
+            session, target, args = self.queue.get()
+            if session.cancelled:
+                session.state = "cancelled"
+            elif time.monotonic() - session.queued_at > self.max_wait:
+                session.state = "expired"
+            else:
+                session.state = "streaming"
+                session.started = time.time()
+                try:
+                    target(*args, session=session)
+                    session.state = "failed" if session.error else "cancelled" if session.cancelled else "finished"
+                except Exception as e:
+                    session.state = "failed"
+                    session.error = str(e)
+                    print(f"Session {session.stream_id} failed: {e}")
+            self.table.finish(session)
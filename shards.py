@@ -0,0 +1,167 @@
+import ctypes
+import multiprocessing
+import socket
+import struct
+import threading
+from engine import StreamingEngine
+from sessions import Session, SessionTable
+from metrics import Histogram
+
+SO_ATTACH_REUSEPORT_CBPF = 51  # Linux >= 4.5, see <asm-generic/socket.h>
+
+# Classic BPF program that steers each datagram arriving on the shared port to
+# socket (stream_id % shards) of the SO_REUSEPORT group. The kernel runs it with
+# the UDP payload at offset 0, so [2] is the stream_id field of protocol.HEADER.
+def reuseport_program(shards):
+    return [
+        (0x28, 0, 0, 2),       # ldh [2]         A = stream_id
+        (0x94, 0, 0, shards),  # mod #shards     A = A % shards
+        (0x16, 0, 0, 0),       # ret a           deliver to socket A
+    ]
+
+# Attach reuseport_program to `sock`; False where the kernel does not support it
+def attach_reuseport_program(sock, shards):
+    program = reuseport_program(shards)
+    filters = (ctypes.c_ubyte * (8 * len(program)))()
+    for i, instruction in enumerate(program):
+        struct.pack_into("HBBI", filters, 8 * i, *instruction)  # struct sock_filter
+    fprog = struct.pack("HL", len(program), ctypes.addressof(filters))  # struct sock_fprog
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, fprog)
+    except OSError:
+        return False
+    return True
+
+# One UDP socket per shard. On Linux they all bind `port` with SO_REUSEPORT, so
+# clients see a single server address, and the BPF program hands each NACK to
+# the process that owns its stream. Elsewhere every shard gets its own port;
+# clients NACK whatever address the data came from, so that works too.
+def open_shard_sockets(shards, port):
+    socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(shards)]
+    try:
+        for sock in socks:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if attach_reuseport_program(socks[0], shards):
+            for sock in socks:
+                sock.bind(("0.0.0.0", port))  # Bind order is the index the program returns
+            return socks
+    except (AttributeError, OSError):
+        pass  # No SO_REUSEPORT, or the port is taken
+    for sock in socks:
+        sock.close()
+    print("SO_REUSEPORT steering unavailable, shards use separate ports")
+    socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(shards)]
+    for sock in socks:
+        sock.bind(("0.0.0.0", 0))
+    return socks
+
+# Entry point of a shard process: runs a StreamingEngine on the shard's socket and
+# starts ("start", ...) or cancels ("cancel", stream_id) the sessions the control
+# plane sends over `conn`. Ended sessions are reported back as (stream_id, state,
+# packets_sent, bytes_sent, codec, codec_switches, send lag histogram counts and sum, error).
+def run_shard(index, sock, conn, max_streams, engine_args, cache_bytes, packet_folder):
+    send_lock = threading.Lock()
+
+    def report(session):
+        with send_lock:
+            conn.send((session.stream_id, session.state, session.packets_sent, session.bytes_sent,
+                       session.codec, session.codec_switches, session.send_lag.counts, session.send_lag.sum,
+                       session.error))
+
+    engine = StreamingEngine(max_streams, *engine_args, sock=sock, on_finish=report, cache_bytes=cache_bytes,
+                             packet_folder=packet_folder)
+    engine.start()
+    print(f"Shard {index} streaming from port {sock.getsockname()[1]}")
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            return  # Control plane went away
+        if message[0] == "cancel":
+            with engine.table.lock:
+                session = engine.table.sessions.get(message[1])
+            if session:
+                session.cancelled = True  # The control plane checked the token
+            continue
+        _, stream_id, track_id, client, track, dest, fec_group, nack, start, codec, ladder = message
+        session = Session(stream_id, track_id, client)
+        if not engine.submit(session, track, dest, fec_group, nack, start, codec, ladder):
+            session.state = "failed"
+            session.error = "shard is full"
+            report(session)
+
+# Pre-fork streaming: `shards` worker processes, each with its own event loop
+# (engine.StreamingEngine), so sendto throughput is not capped by one GIL.
+# Sessions go to shard stream_id % shards over a pipe; the control plane keeps
+# the session table, so /sessions and admission work as with the other engines.
+# Same submit()/cancel()/snapshot() interface as StreamingEngine. Each shard has its own
+# frame cache of cache_bytes; the file pages behind them are shared by all.
+# Packet counts and send lag of a session reach the table (and /metrics) when it ends.
+class ShardPool:
+    def __init__(self, shards, max_streams, port=0, chunk_size=1024, lead_seconds=0.5,
+                 retransmit_window=512, playout_deadline=0.3, lock=None, cache_bytes=0, packet_folder=None):
+        self.shards = shards
+        self.max_streams = max_streams
+        self.table = SessionTable(lock)
+        self.conns = []
+        self.send_locks = [threading.Lock() for _ in range(shards)]
+
+        engine_args = (chunk_size, lead_seconds, retransmit_window, playout_deadline)
+        socks = open_shard_sockets(shards, port)
+        for index, sock in enumerate(socks):
+            conn, child_conn = multiprocessing.Pipe()
+            multiprocessing.Process(
+                target=run_shard, name=f"stream-shard-{index}", daemon=True,
+                args=(index, sock, child_conn, max_streams, engine_args, cache_bytes, packet_folder),
+            ).start()
+            child_conn.close()
+            sock.close()  # The shard process holds its own copy
+            self.conns.append(conn)
+            threading.Thread(target=self._collect, args=(conn,), name=f"shard-{index}-reports", daemon=True).start()
+
+    # Hand a session to its shard; False when max_streams sessions are already live
+    def submit(self, session, track, dest, fec_group=0, nack=False, start=0, codec="pcm", ladder=None):
+        if not self.table.admit(session, self.max_streams):
+            return False
+        index = session.stream_id % self.shards
+        session.state = "streaming"
+        session.started = session.created
+        with self.send_locks[index]:
+            self.conns[index].send(("start", session.stream_id, session.track_id, session.client, track, dest, fec_group, nack,
+                                    start, codec, ladder))
+        return True
+
+    # Stop a session on its shard (see SessionTable.cancel); False if there is none.
+    # The table hears how it ended from the shard, as for any other session.
+    def cancel(self, stream_id, token):
+        if self.table.cancel(stream_id, token) is None:
+            return False
+        index = stream_id % self.shards
+        with self.send_locks[index]:
+            self.conns[index].send(("cancel", stream_id))
+        return True
+
+    def snapshot(self):
+        return {"engine": "shards", "shards": self.shards, "max_active": self.max_streams, **self.table.snapshot()}
+
+    # Apply the end-of-session reports of one shard to the table
+    def _collect(self, conn):
+        while True:
+            try:
+                (stream_id, state, packets_sent, bytes_sent, codec, codec_switches,
+                 lag_counts, lag_sum, error) = conn.recv()
+            except (EOFError, OSError):
+                print("Stream shard exited")
+                return
+            with self.table.lock:
+                session = self.table.sessions.get(stream_id)
+            if session is None:
+                continue
+            session.state = state
+            session.packets_sent = packets_sent
+            session.bytes_sent = bytes_sent
+            session.codec = codec
+            session.codec_switches = codec_switches
+            session.send_lag = Histogram(counts=lag_counts, total=lag_sum)
+            session.error = error
+            self.table.finish(session)
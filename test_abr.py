@@ -0,0 +1,93 @@
+import unittest
+from abr import (simulate, next_state, initial_state, pack_report, unpack_report, Report,
+                 UP_AFTER_REPORTS, MAX_UP_AFTER_REPORTS, BUFFER_LOW_MS)
+from protocol import unpack_packet
+
+RATIOS = [1.0, 0.7, 0.27]  # pcm, flac, adpcm
+GOOD = 1.2                 # Capacity that carries every level
+JUST_BELOW_TOP = 0.94      # Capacity a little short of the top level's bitrate
+
+# Lengths of the runs of reports spent at `level`, in order
+def runs_at(levels, level):
+    runs = []
+    count = 0
+    for current in levels:
+        if current == level:
+            count += 1
+        elif count:
+            runs.append(count)
+            count = 0
+    return runs
+
+# Tests for the control law in abr.py, run against simulate()'s link model
+class ControlLawTest(unittest.TestCase):
+    def test_steps_down_at_once_on_loss(self):
+        levels = simulate(RATIOS, [0.5, 0.2])
+        self.assertEqual(levels, [1, 2])
+
+    def test_steps_down_at_once_on_low_buffer(self):
+        levels = simulate(RATIOS, [GOOD] * 3, buffer_ms=BUFFER_LOW_MS - 1)
+        self.assertEqual(levels, [1, 2, 2])
+
+    def test_stays_at_bottom_level(self):
+        levels = simulate(RATIOS, [0.1] * 5)
+        self.assertEqual(levels, [1, 2, 2, 2, 2])
+
+    def test_steps_up_after_a_run_of_good_reports(self):
+        levels = simulate(RATIOS, [0.5] + [GOOD] * UP_AFTER_REPORTS * 2)
+        self.assertEqual(levels[0], 1)
+        self.assertEqual(levels[1:UP_AFTER_REPORTS], [1] * (UP_AFTER_REPORTS - 1))
+        self.assertEqual(levels[UP_AFTER_REPORTS:], [0] * (UP_AFTER_REPORTS + 1))
+
+    def test_one_level_at_a_time(self):
+        levels = simulate(RATIOS, [0.1] * 2 + [GOOD] * UP_AFTER_REPORTS * 3)
+        steps = [earlier - later for earlier, later in zip(levels, levels[1:])]
+        self.assertTrue(all(step <= 1 for step in steps))
+        self.assertEqual(levels[-1], 0)
+
+    def test_bad_jitter_holds_the_level(self):
+        state = initial_state(1)
+        for _ in range(UP_AFTER_REPORTS * 2):
+            state = next_state(state, len(RATIOS), Report(0.0, 50, 500))
+        self.assertEqual(state.level, 1)
+        self.assertEqual(state.good_reports, 0)
+
+    def test_failed_probe_doubles_the_wait(self):
+        levels = simulate(RATIOS, [JUST_BELOW_TOP] * 200)
+        runs = runs_at(levels, 1)
+        self.assertEqual(runs[:4], [UP_AFTER_REPORTS, UP_AFTER_REPORTS * 2, UP_AFTER_REPORTS * 4, UP_AFTER_REPORTS * 8])
+        self.assertEqual(runs_at(levels, 0), [1] * len(runs_at(levels, 0)))  # Every probe fails at once
+
+    def test_wait_is_capped(self):
+        levels = simulate(RATIOS, [JUST_BELOW_TOP] * 600)
+        runs = runs_at(levels, 1)
+        self.assertEqual(max(runs), MAX_UP_AFTER_REPORTS)
+        self.assertEqual(runs[-2], MAX_UP_AFTER_REPORTS)  # The last run may be cut short by the end of the simulation
+
+    def test_held_step_up_resets_the_wait(self):
+        # Two failed probes, then the link recovers for good
+        capacity = [JUST_BELOW_TOP] * (1 + UP_AFTER_REPORTS * 3 + 2) + [GOOD] * 40 + [0.5] + [GOOD] * UP_AFTER_REPORTS
+        levels = simulate(RATIOS, capacity)
+        self.assertEqual(levels[-UP_AFTER_REPORTS - 1:-1], [1] * UP_AFTER_REPORTS)
+        self.assertEqual(levels[-1], 0)
+
+    def test_no_flapping_just_below_a_level(self):
+        reports = 600
+        levels = simulate(RATIOS, [JUST_BELOW_TOP] * reports)
+        switches = sum(1 for earlier, later in zip(levels, levels[1:]) if earlier != later)
+        self.assertLess(switches, 2 * reports / MAX_UP_AFTER_REPORTS + 10)
+        self.assertLess(levels.count(0) / reports, 0.05)  # Almost all the time at the level the link carries
+        self.assertNotIn(2, levels)  # Never below it
+
+class ReportTest(unittest.TestCase):
+    def test_round_trip(self):
+        _, stream_id, _, _, payload = unpack_packet(pack_report(7, Report(0.0234, 12.4, 480)))
+        self.assertEqual(stream_id, 7)
+        self.assertEqual(unpack_report(payload), Report(0.023, 12, 480))
+
+    def test_values_are_clamped(self):
+        _, _, _, _, payload = unpack_packet(pack_report(1, Report(3.0, 1e6, 1e6)))
+        self.assertEqual(unpack_report(payload), Report(1.0, 0xFFFF, 0xFFFF))
+
+if __name__ == "__main__":
+    unittest.main()
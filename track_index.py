@@ -0,0 +1,148 @@
+import bisect
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+from collections import namedtuple
+from wav_utils import read_wav_info
+
+# One playlist entry with the WAV metadata the streaming code needs.
+# Has the same format fields as wav_utils.WavInfo, so byte_rate()/frame_bytes() accept it.
+Track = namedtuple("Track", [
+    "track_id", "path", "size", "mtime_ns", "channels", "sample_width", "frame_rate",
+    "duration", "data_offset", "data_size", "content_hash",
+])
+
+SCHEMA_VERSION = 4  # Bump when the table layout changes; older indexes are rebuilt
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    track_id TEXT NOT NULL UNIQUE,
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    channels INTEGER NOT NULL,
+    sample_width INTEGER NOT NULL,
+    frame_rate INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    data_offset INTEGER NOT NULL,
+    data_size INTEGER NOT NULL,
+    content_hash TEXT NOT NULL
+)
+"""
+
+# Stable identifier for a track: a hash of its path relative to the music folder.
+# It survives restarts and rescans and is the same on every replica serving the same library.
+def stable_track_id(folder, path):
+    relative = os.path.relpath(path, folder).replace(os.sep, "/")
+    return hashlib.sha1(relative.encode("utf-8")).hexdigest()[:16]
+
+# SHA-1 of a track's PCM data (the data chunk only, so rewriting tags does not change it).
+# Clients key their local copies by it and check what they received against it.
+def content_hash(path, data_offset, data_size, block_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        f.seek(data_offset)
+        remaining = data_size
+        while remaining > 0:
+            block = f.read(min(block_size, remaining))
+            if not block:
+                break
+            digest.update(block)
+            remaining -= len(block)
+    return digest.hexdigest()
+
+# Bring the on-disk index for `folder` up to date and return its tracks sorted by path.
+# Only files whose size or mtime changed since the last run have their headers parsed
+# and their audio hashed.
+def update_index(folder, db_path):
+    with contextlib.closing(sqlite3.connect(db_path)) as conn, conn:  # Commit, then close
+        if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            conn.execute("DROP TABLE IF EXISTS tracks")
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.execute(SCHEMA)
+        known = {path: (size, mtime_ns) for path, size, mtime_ns in conn.execute("SELECT path, size, mtime_ns FROM tracks")}
+
+        seen = set()
+        changed = []
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".wav") or not entry.is_file():
+                    continue
+                path = os.path.join(folder, entry.name)
+                st = entry.stat()
+                if known.get(path) == (st.st_size, st.st_mtime_ns):
+                    seen.add(path)
+                    continue  # Unchanged since it was indexed
+
+                try:
+                    info = read_wav_info(path)
+                    digest = content_hash(path, info.data_offset, info.data_size)
+                except (OSError, ValueError) as e:
+                    print(f"Skipping {path}: {e}")
+                    continue  # Not seen, so an older row of it is removed like that of a deleted file
+                seen.add(path)
+                duration = info.data_size / (info.channels * info.sample_width * info.frame_rate)
+                changed.append(Track(stable_track_id(folder, path), path, st.st_size, st.st_mtime_ns,
+                                     info.channels, info.sample_width, info.frame_rate, duration,
+                                     info.data_offset, info.data_size, digest))
+
+        removed = [(path,) for path in known if path not in seen]
+        conn.executemany("INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", changed)
+        conn.executemany("DELETE FROM tracks WHERE path = ?", removed)
+        if changed or removed:
+            print(f"Index updated: {len(changed)} new or changed, {len(removed)} removed")
+
+        return [Track(*row) for row in conn.execute("SELECT * FROM tracks ORDER BY path")]
+
+# Immutable view of the playlist. Servers publish a new one by rebinding a single
+# global, so request handlers read it without a lock and never see a half-built list.
+# Everything /tracks needs is precomputed here, once per playlist change:
+#   entries      JSON-ready {"id", "name", "duration", "hash"} dicts, in path order
+#   names        basenames in path order (sorted, so cursors can be bisected)
+#   prefix_index sorted (lowercase name, position) pairs for prefix search
+#   body, etag   the full track list as JSON bytes and its entity tag
+Library = namedtuple("Library", ["tracks", "by_id", "entries", "names", "prefix_index", "body", "etag"])
+
+# Build a Library from the tracks returned by update_index
+def make_library(tracks):
+    tracks = tuple(tracks)
+    entries = tuple(
+        {"id": track.track_id, "name": os.path.basename(track.path), "duration": track.duration,
+         "hash": track.content_hash}
+        for track in tracks
+    )
+    names = tuple(entry["name"] for entry in entries)
+    prefix_index = tuple(sorted((name.lower(), position) for position, name in enumerate(names)))
+    body = json.dumps(entries).encode("utf-8")
+    etag = hashlib.sha1(body).hexdigest()[:16]
+    return Library(tracks, {track.track_id: track for track in tracks}, entries, names, prefix_index, body, etag)
+
+# One page of the track list, optionally filtered by a name prefix or substring
+# (both case-insensitive). `cursor` is the name of the last track of the previous
+# page; since it is a name and not a position, it stays valid across reloads.
+def query_tracks(library, cursor=None, limit=100, prefix=None, search=None):
+    if prefix:
+        prefix = prefix.lower()
+        start = bisect.bisect_left(library.prefix_index, (prefix,))
+        positions = []
+        for name, position in library.prefix_index[start:]:
+            if not name.startswith(prefix):
+                break
+            positions.append(position)
+        positions.sort()
+    elif search:
+        search = search.lower()
+        positions = [i for i, name in enumerate(library.names) if search in name.lower()]
+    else:
+        positions = range(len(library.names))
+
+    first = 0
+    if cursor is not None:
+        first = bisect.bisect_right(positions, cursor, key=lambda position: library.names[position])
+    page = positions[first:first + limit]
+
+    next_cursor = None
+    if first + limit < len(positions):
+        next_cursor = library.names[page[-1]]
+    return {"tracks": [library.entries[position] for position in page], "next_cursor": next_cursor}
@@ -0,0 +1,60 @@
+import contextlib
+import mmap
+import threading
+
+# Shared read-only memory maps of the tracks being streamed.
+# Every listener of a track slices chunks out of the same mapping, so the audio
+# is read straight from the page cache and no Python buffer is allocated per
+# chunk. Mappings are refcounted and dropped once the last stream releases
+# them; the mmap itself is unmapped when the last slice still in use (for
+# example in a retransmission window) goes away.
+# Keyed by path, size and mtime, so a track replaced on disk gets a new mapping
+# while streams of the old one finish undisturbed. Files must be replaced (new
+# file, rename over), not truncated in place: touching a mapped page past the
+# end of a truncated file kills the process with SIGBUS.
+class TrackMaps:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.maps = {}  # (path, size, mtime_ns) -> [memoryview of the file, refcount]
+
+    # Memoryview of the whole file of `track`; pair every call with release(track)
+    def acquire(self, track):
+        key = (track.path, track.size, track.mtime_ns)
+        with self.lock:
+            entry = self.maps.get(key)
+            if entry is None:
+                entry = self.maps[key] = [map_file(track.path), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def release(self, track):
+        key = (track.path, track.size, track.mtime_ns)
+        with self.lock:
+            entry = self.maps.get(key)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self.maps[key]
+
+    # `with maps.open(track) as data:` for streams that live within one call
+    @contextlib.contextmanager
+    def open(self, track):
+        data = self.acquire(track)
+        try:
+            yield data
+        finally:
+            self.release(track)
+
+    # Number of tracks currently mapped, for monitoring
+    def __len__(self):
+        with self.lock:
+            return len(self.maps)
+
+# Map a file read-only; empty files cannot be mapped and get an empty view
+def map_file(path):
+    with open(path, "rb") as f:
+        try:
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except ValueError:
+            return memoryview(b"")
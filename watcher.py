@@ -0,0 +1,70 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import threading
+
+# inotify event masks (see <sys/inotify.h>)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# Open an inotify watch on `folder`; returns the file descriptor or None where inotify is unavailable
+def open_inotify(folder):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None  # Not Linux, or no inotify in this libc
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(folder), WATCH_MASK) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+# Background thread that calls on_change() whenever the music folder changes.
+# Uses inotify where available and otherwise falls back to calling on_change()
+# every poll_interval seconds (update_index only reparses files that changed).
+# Bursts of events, such as a large file being copied in, are coalesced until
+# the folder has been quiet for `debounce` seconds.
+class FolderWatcher(threading.Thread):
+    def __init__(self, folder, on_change, poll_interval=5.0, debounce=0.5):
+        super().__init__(daemon=True)
+        self.folder = folder
+        self.on_change = on_change
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.stopped = threading.Event()
+
+    def run(self):
+        fd = open_inotify(self.folder)
+        if fd is None:
+            print(f"inotify unavailable, polling {self.folder} every {self.poll_interval}s")
+            while not self.stopped.wait(self.poll_interval):
+                self._notify()
+            return
+
+        print(f"Watching {self.folder} for changes")
+        try:
+            while not self.stopped.is_set():
+                if not select.select([fd], [], [], 1.0)[0]:
+                    continue
+                # Drain events until the folder stays quiet for the debounce interval
+                while select.select([fd], [], [], self.debounce)[0]:
+                    os.read(fd, 64 * 1024)
+                self._notify()
+        finally:
+            os.close(fd)
+
+    def stop(self):
+        self.stopped.set()
+
+    def _notify(self):
+        try:
+            self.on_change()
+        except Exception as e:
+            print(f"Error reloading {self.folder}: {e}")
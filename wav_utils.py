@@ -0,0 +1,80 @@
+import os
+import struct
+from collections import namedtuple
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE  # Real format tag in the first two bytes of the SubFormat GUID
+
+# Format information parsed from a WAV file's RIFF chunks
+WavInfo = namedtuple("WavInfo", ["channels", "sample_width", "frame_rate", "data_offset", "data_size"])
+
+# Bytes per second of PCM audio described by a WavInfo
+def byte_rate(info):
+    return info.channels * info.sample_width * info.frame_rate
+
+# Bytes per sample frame (one sample for every channel)
+def frame_bytes(info):
+    return info.channels * info.sample_width
+
+# Largest packet payload of whole sample frames that fits in chunk_size bytes (at least one frame)
+def frame_chunk_size(info, chunk_size):
+    frame_size = frame_bytes(info)
+    return max(1, chunk_size // frame_size) * frame_size
+
+# Byte offset in the PCM data of the frame that plays `ms` milliseconds into the audio,
+# clamped to the data chunk. Needs the data_size of a WavInfo or Track.
+def seek_position(info, ms):
+    frame_size = frame_bytes(info)
+    offset = int(ms * byte_rate(info) / 1000) // frame_size * frame_size
+    return max(0, min(offset, info.data_size // frame_size * frame_size))
+
+# Walk the RIFF chunks of a WAV file and return its format and data chunk position.
+# Only integer PCM is accepted; the data size is clamped to what the file holds
+# (truncated downloads, streaming writers that never patched the header) and
+# rounded down to whole sample frames.
+def read_wav_info(path):
+    with open(path, "rb") as f:
+        return parse_wav_info(f, path, os.fstat(f.fileno()).st_size)
+
+# Same as read_wav_info, for an open binary file object (or io.BytesIO of a header);
+# without file_size the data size is taken from the header as is (in whole frames)
+def parse_wav_info(f, name="stream", file_size=None):
+    riff = f.read(12)
+    if len(riff) < 12 or riff[0:4] != b"RIFF" or riff[8:12] != b"WAVE":
+        raise ValueError(f"{name} is not a RIFF/WAVE file")
+
+    fmt = None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            break  # Ran out of chunks before finding the data chunk
+        chunk_id, chunk_size = struct.unpack("<4sI", header)
+
+        if chunk_id == b"fmt ":
+            body = f.read(chunk_size)
+            if len(body) < 16:
+                raise ValueError(f"{name} has a truncated fmt chunk")
+            format_tag, channels, frame_rate, _, _, bits = struct.unpack("<HHIIHH", body[:16])
+            if format_tag == WAVE_FORMAT_EXTENSIBLE and len(body) >= 26:
+                format_tag, = struct.unpack("<H", body[24:26])
+            if format_tag != WAVE_FORMAT_PCM:
+                raise ValueError(f"{name} is not PCM (format tag {format_tag:#06x})")
+            if not channels or not bits or not frame_rate:
+                raise ValueError(f"{name} has an empty format ({channels} channels, {bits} bits, {frame_rate} Hz)")
+            fmt = (channels, (bits + 7) // 8, frame_rate)
+        elif chunk_id == b"data":
+            if fmt is None:
+                raise ValueError(f"{name} has a data chunk before its fmt chunk")
+            data_offset = f.tell()
+            data_size = chunk_size
+            if file_size is not None:
+                data_size = max(0, min(data_size, file_size - data_offset))
+            frame_size = fmt[0] * fmt[1]
+            return WavInfo(fmt[0], fmt[1], fmt[2], data_offset, data_size // frame_size * frame_size)
+        else:
+            f.seek(chunk_size, 1)  # Skip chunks we don't care about (LIST, fact, ...)
+
+        if chunk_size % 2:
+            f.seek(1, 1)  # Chunks are padded to an even number of bytes
+
+    raise ValueError(f"{name} has no data chunk")